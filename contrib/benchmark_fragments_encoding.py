@@ -0,0 +1,78 @@
+"""
+Compare the storage formats of the fragments table: json (JSONB on postgres)
+versus zstd compressed orjson bytes, with and without a trained dictionary.
+Prints table size and write / iterate throughput.
+
+Set `TESTING_FRAGMENTS_PSQL_URI` to include postgres.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from shutil import rmtree
+
+from sqlalchemy import text
+
+from ftmq.io import smart_read_proxies
+from ftmq.store.fragments.store import Store
+
+DATASET = "ec_meetings"
+
+
+def get_proxies():
+    yield from smart_read_proxies("./tests/fixtures/ec_meetings.ftm.json")
+
+
+@contextmanager
+def measure(*msg: str):
+    start = time.time()
+    try:
+        yield None
+    finally:
+        end = time.time()
+        print(*msg, round(end - start, 2))
+
+
+def get_size(store: Store, table: str) -> int:
+    with store.engine.connect() as conn:
+        if store.is_postgres:
+            q = text(f"SELECT pg_total_relation_size('{table}')")
+        else:
+            q = text(f"SELECT SUM(pgsize) FROM dbstat WHERE name = '{table}'")
+        return conn.execute(q).scalar()
+
+
+def benchmark(uri: str, encoding: str):
+    store = Store(uri, encoding=encoding)
+    dataset = store.get(DATASET)
+    prefix = f"{store.engine.dialect.name} {encoding}"
+
+    with measure(prefix, "write"):
+        bulk = dataset.bulk()
+        for proxy in get_proxies():
+            bulk.put(proxy)
+        bulk.flush()
+    print(prefix, "size", get_size(store, dataset.table.name))
+    with measure(prefix, "iterate"):
+        _ = [e for e in dataset.iterate()]
+
+    if encoding == "zstd":
+        with measure(prefix, "migrate (train dictionary)"):
+            dataset.migrate("zstd")
+        print(prefix, "dictionary size", get_size(store, dataset.table.name))
+        with measure(prefix, "dictionary iterate"):
+            _ = [e for e in dataset.iterate()]
+
+    dataset.drop()
+    store.close()
+
+
+if __name__ == "__main__":
+    os.mkdir(".benchmark")
+    uris = ["sqlite:///.benchmark/fragments.db"]
+    if os.environ.get("TESTING_FRAGMENTS_PSQL_URI"):
+        uris.append(os.environ["TESTING_FRAGMENTS_PSQL_URI"])
+    for uri in uris:
+        benchmark(uri, "json")
+        benchmark(uri, "zstd")
+    rmtree(".benchmark", ignore_errors=True)
@@ -0,0 +1,66 @@
+"""
+Compare the iteration strategies of a fragments dataset: sorted id batches
+(`iterate_batched`, one keyset query plus one `IN` query per batch) versus
+one streamed query ordered by id (`iterate_streamed`, server-side cursor on
+postgres).
+
+Set `TESTING_FRAGMENTS_PSQL_URI` to include postgres.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from shutil import rmtree
+
+from ftmq.io import smart_read_proxies
+from ftmq.store.fragments import get_fragments
+
+DATASET = "ec_meetings"
+FRAGMENTS = 3  # split each entity into this many fragments
+
+
+def get_proxies():
+    yield from smart_read_proxies("./tests/fixtures/ec_meetings.ftm.json")
+
+
+@contextmanager
+def measure(*msg: str):
+    start = time.time()
+    try:
+        yield None
+    finally:
+        end = time.time()
+        print(*msg, round(end - start, 2))
+
+
+def benchmark(uri: str):
+    get_fragments.cache_clear()
+    dataset = get_fragments(DATASET, database_uri=uri)
+    dataset.drop()
+    prefix = dataset.store.engine.dialect.name
+
+    with measure(prefix, "write"):
+        bulk = dataset.bulk()
+        for proxy in get_proxies():
+            for ix, (prop, value) in enumerate(proxy.itervalues()):
+                fragment = {"id": proxy.id, "schema": proxy.schema.name}
+                fragment["properties"] = {prop.name: [value]}
+                bulk.put(fragment, fragment=str(ix % FRAGMENTS))
+        bulk.flush()
+
+    for batch_size in (1_000, 10_000):
+        with measure(prefix, "iterate_batched", batch_size):
+            _ = [e for e in dataset.iterate_batched(batch_size=batch_size)]
+    with measure(prefix, "iterate_streamed"):
+        _ = [e for e in dataset.iterate_streamed()]
+
+    dataset.drop()
+    dataset.store.close()
+
+
+if __name__ == "__main__":
+    os.mkdir(".benchmark")
+    benchmark("sqlite:///.benchmark/fragments.db")
+    if os.environ.get("TESTING_FRAGMENTS_PSQL_URI"):
+        benchmark(os.environ["TESTING_FRAGMENTS_PSQL_URI"])
+    rmtree(".benchmark", ignore_errors=True)
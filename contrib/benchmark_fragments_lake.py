@@ -0,0 +1,57 @@
+"""
+Move a fragments dataset into a LakeStore: aggregating the entities and
+writing them through `LakeWriter.add_entity` versus the statement pipeline
+of `Fragments.to_lake` (arrow tables from sorted id batches, written in the
+background).
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from shutil import rmtree
+
+from ftmq.io import smart_read_proxies
+from ftmq.store.fragments import get_fragments
+from ftmq.store.lake import LakeStore
+
+DATASET = "ec_meetings"
+URI = "./.benchmark/lake"
+
+
+def get_proxies():
+    yield from smart_read_proxies("./tests/fixtures/ec_meetings.ftm.json")
+
+
+@contextmanager
+def measure(*msg: str):
+    start = time.time()
+    try:
+        yield None
+    finally:
+        end = time.time()
+        print(*msg, round(end - start, 2))
+
+
+if __name__ == "__main__":
+    os.mkdir(".benchmark")
+    dataset = get_fragments(DATASET, database_uri="sqlite:///.benchmark/fragments.db")
+    with measure("write fragments"):
+        bulk = dataset.bulk()
+        for proxy in get_proxies():
+            bulk.put(proxy)
+        bulk.flush()
+
+    with measure("iterate + add_entity"):
+        store = LakeStore(uri=f"{URI}/entities", dataset=DATASET)
+        with store.writer() as writer:
+            for entity in dataset.iterate():
+                writer.add_entity(entity)
+
+    with measure("to_lake"):
+        store = LakeStore(uri=f"{URI}/statements", dataset=DATASET)
+        metrics = dataset.to_lake(store)
+    print(metrics.model_dump_json())
+
+    dataset.drop()
+    dataset.store.close()
+    rmtree(".benchmark", ignore_errors=True)
@@ -0,0 +1,59 @@
+"""
+Throughput of (re-)loading a fragments dataset into sqlite: the native
+upsert (INSERT ... ON CONFLICT DO UPDATE) versus the legacy fallback of one
+UPDATE per row after an IntegrityError, and writing the batches in a
+background thread while the proxies are parsed.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from shutil import rmtree
+
+from ftmq.io import smart_read_proxies
+from ftmq.store.fragments import get_fragments
+from ftmq.store.fragments import loader
+
+DATASET = "ec_meetings"
+RUNS = 3
+
+
+def get_proxies():
+    yield from smart_read_proxies("./tests/fixtures/ec_meetings.ftm.json")
+
+
+@contextmanager
+def measure(*msg: str):
+    start = time.time()
+    try:
+        yield None
+    finally:
+        end = time.time()
+        print(*msg, round(end - start, 2))
+
+
+def benchmark(uri: str, native: bool, background: bool = False):
+    loader.SQLITE_UPSERT = native
+    get_fragments.cache_clear()
+    dataset = get_fragments(DATASET, database_uri=uri)
+    prefix = "native" if native else "legacy"
+    if background:
+        prefix = f"{prefix} background"
+
+    for run in range(RUNS):
+        with measure(prefix, "load", run):
+            bulk = dataset.bulk(background=background)
+            for proxy in get_proxies():
+                bulk.put(proxy)
+            bulk.flush()
+
+    dataset.drop()
+    dataset.store.close()
+
+
+if __name__ == "__main__":
+    os.mkdir(".benchmark")
+    benchmark("sqlite:///.benchmark/native.db", native=True)
+    benchmark("sqlite:///.benchmark/legacy.db", native=False)
+    benchmark("sqlite:///.benchmark/background.db", native=True, background=True)
+    rmtree(".benchmark", ignore_errors=True)
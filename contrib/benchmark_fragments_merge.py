@@ -0,0 +1,68 @@
+"""
+Compare fragment merging for entities with very many fragments: building an
+`EntityProxy` per fragment and merging it into the entity (previous
+behaviour) versus collecting the property values of all fragments and
+building the proxy once (`Fragments.iterate`).
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from shutil import rmtree
+
+from followthemoney import EntityProxy
+
+from ftmq.store.fragments import get_fragments
+
+DATASET = "ec_meetings"
+ENTITIES = 10
+FRAGMENTS = 20_000  # per entity
+
+
+@contextmanager
+def measure(*msg: str):
+    start = time.time()
+    try:
+        yield None
+    finally:
+        end = time.time()
+        print(*msg, round(end - start, 2))
+
+
+def merge_partials(dataset):
+    entity = None
+    for fragment in dataset.fragments():
+        partial = EntityProxy.from_dict(fragment, cleaned=True)
+        if entity is not None and entity.id == partial.id:
+            entity.merge(partial)
+            continue
+        if entity is not None:
+            yield entity
+        entity = partial
+    if entity is not None:
+        yield entity
+
+
+if __name__ == "__main__":
+    os.mkdir(".benchmark")
+    dataset = get_fragments(DATASET, database_uri="sqlite:///.benchmark/fragments.db")
+    with measure("write", ENTITIES * FRAGMENTS, "fragments"):
+        bulk = dataset.bulk(size=10_000)
+        for ix in range(ENTITIES):
+            for fx in range(FRAGMENTS):
+                schema = "Person" if fx == FRAGMENTS - 1 else "LegalEntity"
+                data = {"id": f"e{ix}", "schema": schema, "properties": {}}
+                data["properties"]["name"] = [f"Name {ix}", f"Name {ix} {fx}"]
+                data["properties"]["email"] = [f"e{fx % 100}@example.org"]
+                bulk.put(data, fragment=str(fx))
+        bulk.flush()
+
+    with measure("merge partials"):
+        expected = [e.to_dict() for e in merge_partials(dataset)]
+    with measure("merge fragments"):
+        entities = [e.to_dict() for e in dataset.iterate(streamed=True)]
+    assert entities == expected
+
+    dataset.drop()
+    dataset.store.close()
+    rmtree(".benchmark", ignore_errors=True)
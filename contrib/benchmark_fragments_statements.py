@@ -0,0 +1,76 @@
+"""
+Statement export of a fragments dataset: building a `StatementEntity` per
+fragment and exploding it (previous behaviour) versus generating the
+statements directly from the fragment data (`fragment_statements`, used by
+`Fragments.statements`).
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from shutil import rmtree
+
+from followthemoney import StatementEntity
+
+from ftmq.io import smart_read_proxies
+from ftmq.store.fragments import get_fragments
+from ftmq.store.fragments.dataset import fragment_statements
+from ftmq.util import make_dataset
+
+DATASET = "ec_meetings"
+COPIES = 20
+RUNS = 3
+
+
+def get_proxies():
+    yield from smart_read_proxies("./tests/fixtures/ec_meetings.ftm.json")
+
+
+@contextmanager
+def measure(*msg: str):
+    start = time.time()
+    try:
+        yield None
+    finally:
+        end = time.time()
+        print(*msg, round(end - start, 2))
+
+
+def entity_statements(fragments):
+    default_dataset = make_dataset(DATASET)
+    for fragment in fragments:
+        entity = StatementEntity.from_dict(fragment, default_dataset=default_dataset)
+        for stmt in entity.statements:
+            stmt.last_seen = "2024-01-01T00:00:00"
+            yield stmt
+
+
+def direct_statements(fragments):
+    for fragment in fragments:
+        yield from fragment_statements(fragment, DATASET, "2024-01-01T00:00:00")
+
+
+if __name__ == "__main__":
+    os.mkdir(".benchmark")
+    dataset = get_fragments(DATASET, database_uri="sqlite:///.benchmark/fragments.db")
+    bulk = dataset.bulk(size=10_000)
+    for ix in range(COPIES):
+        for proxy in get_proxies():
+            data = proxy.to_dict()
+            data["id"] = f"{proxy.id}-{ix}"
+            bulk.put(data)
+    bulk.flush()
+    fragments = list(dataset.fragments(sort=False))
+
+    for run in range(RUNS):
+        with measure("entity statements", run):
+            expected = len(list(entity_statements(fragments)))
+        with measure("fragment statements", run):
+            statements = len(list(direct_statements(fragments)))
+        assert statements == expected
+    with measure("Fragments.statements", statements):
+        _ = [s for s in dataset.statements()]
+
+    dataset.drop()
+    dataset.store.close()
+    rmtree(".benchmark", ignore_errors=True)
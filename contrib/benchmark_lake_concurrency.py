@@ -0,0 +1,67 @@
+"""
+Run N parallel queries against a LakeStore with different DuckDB resource
+settings (cursor pool size, threads per query).
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from shutil import rmtree
+
+from ftmq.io import smart_read_proxies
+from ftmq.query import Query
+from ftmq.store.lake import DuckDBSettings, LakeStore
+
+DATASET = "ec_meetings"
+URI = "./.benchmark/lake"
+QUERIES = 200
+WORKERS = 16
+
+
+def get_proxies():
+    yield from smart_read_proxies("./tests/fixtures/ec_meetings.ftm.json")
+
+
+@contextmanager
+def measure(*msg: str):
+    start = time.time()
+    try:
+        yield None
+    finally:
+        end = time.time()
+        print(*msg, round(end - start, 2))
+
+
+def benchmark(settings: DuckDBSettings, ids: list[str]):
+    store = LakeStore(uri=URI, dataset=DATASET, duckdb_settings=settings)
+    prefix = f"cursors={settings.max_cursors} threads={settings.threads}"
+    view = store.view()
+    q = Query().where(dataset=DATASET, schema="Event", date__gte=2023)
+
+    def lookup(ix: int):
+        return view.get_entity(ids[ix % len(ids)])
+
+    def query(_: int):
+        return [p for p in view.query(q)]
+
+    with ThreadPoolExecutor(WORKERS) as pool:
+        with measure(prefix, "lookups", QUERIES):
+            _ = list(pool.map(lookup, range(QUERIES)))
+        with measure(prefix, "queries", QUERIES):
+            _ = list(pool.map(query, range(QUERIES)))
+
+
+if __name__ == "__main__":
+    os.mkdir(".benchmark")
+    store = LakeStore(uri=URI, dataset=DATASET)
+    with measure("write"):
+        with store.writer() as bulk:
+            for proxy in get_proxies():
+                bulk.add_entity(proxy)
+    ids = [p.id for p in get_proxies()]
+    benchmark(DuckDBSettings(max_cursors=1), ids)
+    benchmark(DuckDBSettings(max_cursors=4), ids)
+    benchmark(DuckDBSettings(max_cursors=WORKERS), ids)
+    benchmark(DuckDBSettings(max_cursors=WORKERS, threads=1), ids)
+    rmtree(".benchmark", ignore_errors=True)
@@ -0,0 +1,64 @@
+"""
+Compare append and upsert (merge-on-write) mode of the LakeWriter for a
+re-ingested dataset: upsert costs more on write, append doubles the scan
+volume for readers.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from shutil import rmtree
+
+from sqlalchemy import func, select
+
+from ftmq.io import smart_read_proxies
+from ftmq.query import Query
+from ftmq.store.lake import LakeStore
+
+DATASET = "ec_meetings"
+RUNS = 3
+
+
+def get_proxies():
+    yield from smart_read_proxies("./tests/fixtures/ec_meetings.ftm.json")
+
+
+@contextmanager
+def measure(*msg: str):
+    start = time.time()
+    try:
+        yield None
+    finally:
+        end = time.time()
+        print(*msg, round(end - start, 2))
+
+
+def benchmark(uri: str, upsert: bool):
+    store = LakeStore(uri=uri, dataset=DATASET)
+    prefix = "upsert" if upsert else "append"
+    print(prefix, uri)
+
+    for run in range(RUNS):
+        with measure(prefix, "write", run):
+            with store.writer(upsert=upsert) as bulk:
+                for proxy in get_proxies():
+                    bulk.add_entity(proxy)
+
+    q = select(func.count()).select_from(store.table)
+    print(prefix, "statements", next(store._execute_column(q)))
+    print(prefix, "files", len(store.deltatable.file_uris()))
+
+    with measure(prefix, "iterate"):
+        _ = [p for p in store.iterate()]
+
+    view = store.view()
+    q = Query().where(dataset=DATASET, schema="Event", date__gte=2023)
+    with measure(prefix, "query"):
+        _ = [p for p in view.query(q)]
+
+
+if __name__ == "__main__":
+    os.mkdir(".benchmark")
+    benchmark("./.benchmark/append", upsert=False)
+    benchmark("./.benchmark/upsert", upsert=True)
+    rmtree(".benchmark", ignore_errors=True)
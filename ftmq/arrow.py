@@ -0,0 +1,215 @@
+"""
+Arrow / Parquet export of entities, requires `pyarrow` (included in the `lake`
+extra)
+
+Two table layouts:
+    - long: one row per statement (the nomenklatura statement format)
+    - wide: one table per schema, one list-typed column per property
+"""
+
+from contextlib import ExitStack
+from typing import IO, Any, Generator, Iterable
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from anystore.io import smart_open
+from anystore.types import Uri
+from followthemoney import StatementEntity, model
+from followthemoney.schema import Schema
+
+from ftmq.types import Entities
+from ftmq.util import ensure_entity
+
+BATCH_SIZE = 10_000
+
+STATEMENT_SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("entity_id", pa.string()),
+        ("canonical_id", pa.string()),
+        ("schema", pa.string()),
+        ("prop", pa.string()),
+        ("prop_type", pa.string()),
+        ("value", pa.string()),
+        ("original_value", pa.string()),
+        ("lang", pa.string()),
+        ("dataset", pa.string()),
+        ("origin", pa.string()),
+        ("external", pa.bool_()),
+        ("first_seen", pa.string()),
+        ("last_seen", pa.string()),
+    ]
+)
+
+
+def get_wide_schema(schema: Schema | str) -> pa.Schema:
+    """
+    Get the arrow schema of the wide table for a followthemoney schema: the
+    entity `id`, `schema`, `caption` and `datasets`, followed by one
+    list-typed column per property.
+    """
+    resolved = model.get(schema) if isinstance(schema, str) else schema
+    if resolved is None:
+        raise ValueError("Invalid schema")
+    fields = [
+        ("id", pa.string()),
+        ("schema", pa.string()),
+        ("caption", pa.string()),
+        ("datasets", pa.list_(pa.string())),
+    ]
+    for prop in sorted(resolved.properties):
+        fields.append((prop, pa.list_(pa.string())))
+    return pa.schema(fields)
+
+
+def statement_batches(
+    entities: Entities, batch_size: int = BATCH_SIZE
+) -> Generator[pa.RecordBatch, None, None]:
+    """
+    Stream the statements of entities as arrow record batches in the long
+    table layout (`STATEMENT_SCHEMA`).
+
+    Args:
+        entities: The entities
+        batch_size: Maximum number of rows per batch
+
+    Yields:
+        Generator of `pyarrow.RecordBatch`
+    """
+    rows: list[dict[str, Any]] = []
+    for entity in entities:
+        entity = ensure_entity(entity, StatementEntity)
+        for stmt in entity.statements:
+            rows.append({**stmt.to_dict(), "prop_type": stmt.prop_type})
+        if len(rows) >= batch_size:
+            yield pa.RecordBatch.from_pylist(rows, schema=STATEMENT_SCHEMA)
+            rows = []
+    if rows:
+        yield pa.RecordBatch.from_pylist(rows, schema=STATEMENT_SCHEMA)
+
+
+def _wide_row(entity: StatementEntity, schema: pa.Schema) -> dict[str, Any]:
+    row: dict[str, Any] = {
+        "id": entity.id,
+        "schema": entity.schema.name,
+        "caption": entity.caption,
+        "datasets": sorted(entity.datasets),
+    }
+    for prop in schema.names[4:]:
+        row[prop] = entity.get(prop, quiet=True)
+    return row
+
+
+def entity_batches(
+    entities: Entities, schema: Schema | str, batch_size: int = BATCH_SIZE
+) -> Generator[pa.RecordBatch, None, None]:
+    """
+    Stream entities of one schema as arrow record batches in the wide table
+    layout (`get_wide_schema`). Entities of other schemata are skipped.
+
+    Args:
+        entities: The entities
+        schema: The followthemoney schema
+        batch_size: Maximum number of rows per batch
+
+    Yields:
+        Generator of `pyarrow.RecordBatch`
+    """
+    arrow_schema = get_wide_schema(schema)
+    name = schema if isinstance(schema, str) else schema.name
+    rows: list[dict[str, Any]] = []
+    for entity in entities:
+        if entity.schema.name != name:
+            continue
+        rows.append(_wide_row(ensure_entity(entity, StatementEntity), arrow_schema))
+        if len(rows) >= batch_size:
+            yield pa.RecordBatch.from_pylist(rows, schema=arrow_schema)
+            rows = []
+    if rows:
+        yield pa.RecordBatch.from_pylist(rows, schema=arrow_schema)
+
+
+def write_parquet(
+    uri: Uri,
+    entities: Entities,
+    wide: bool = False,
+    batch_size: int = BATCH_SIZE,
+) -> int:
+    """
+    Write entities to parquet, streaming with bounded memory.
+
+    Example:
+        ```python
+        from ftmq.arrow import write_parquet
+
+        # statements to one file
+        write_parquet("s3://data/entities.parquet", proxies)
+
+        # one file per schema: ./export/Person.parquet, ...
+        write_parquet("./export", proxies, wide=True)
+        ```
+
+    Args:
+        uri: The target file uri, or the target directory for the wide layout
+        entities: The entities
+        wide: Write one table per schema (`<uri>/<Schema>.parquet`) instead of
+            one statement table
+        batch_size: Number of rows per batch (row group)
+
+    Returns:
+        Number of written rows (statements, or entities for the wide layout)
+    """
+    if not wide:
+        rows = 0
+        with smart_open(uri, "wb") as fh:
+            with pq.ParquetWriter(fh, STATEMENT_SCHEMA) as writer:
+                for batch in statement_batches(entities, batch_size):
+                    writer.write_batch(batch)
+                    rows += batch.num_rows
+        return rows
+
+    return _write_wide(str(uri).rstrip("/"), entities, batch_size)
+
+
+def _write_wide(uri: str, entities: Entities, batch_size: int) -> int:
+    writers: dict[str, pq.ParquetWriter] = {}
+    rows: dict[str, list[dict[str, Any]]] = {}
+    schemata: dict[str, pa.Schema] = {}
+    ix = 0
+    with ExitStack() as stack:
+
+        def flush(name: str) -> None:
+            if name not in writers:
+                fh: IO[Any] = stack.enter_context(
+                    smart_open(f"{uri}/{name}.parquet", "wb")
+                )
+                writers[name] = stack.enter_context(
+                    pq.ParquetWriter(fh, schemata[name])
+                )
+            batch = pa.RecordBatch.from_pylist(rows[name], schema=schemata[name])
+            writers[name].write_batch(batch)
+            rows[name] = []
+
+        for entity in entities:
+            ix += 1
+            entity = ensure_entity(entity, StatementEntity)
+            name = entity.schema.name
+            if name not in schemata:
+                schemata[name] = get_wide_schema(entity.schema)
+                rows[name] = []
+            rows[name].append(_wide_row(entity, schemata[name]))
+            if len(rows[name]) >= batch_size:
+                flush(name)
+        for name in rows:
+            if rows[name]:
+                flush(name)
+    return ix
+
+
+def iter_reader(
+    schema: pa.Schema, batches: Iterable[pa.RecordBatch]
+) -> pa.RecordBatchReader:
+    """Wrap a stream of batches as a reader, casting them to `schema`"""
+    return pa.RecordBatchReader.from_batches(
+        schema, (b.cast(schema) for b in batches)
+    )
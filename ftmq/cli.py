@@ -1,3 +1,4 @@
+import time
 from datetime import datetime
 
 import click
@@ -8,7 +9,7 @@ from followthemoney import ValueEntity
 from nomenklatura import settings
 
 from ftmq.aggregate import aggregate
-from ftmq.io import smart_read_proxies, smart_write_proxies
+from ftmq.io import smart_get_store, smart_read_proxies, smart_write_proxies
 from ftmq.model.dataset import Catalog, Dataset
 from ftmq.model.stats import Collector
 from ftmq.query import Query
@@ -79,6 +80,19 @@ def cli() -> None:
     show_default=True,
     help="If specified, print aggregation information to this uri",
 )
+@click.option(
+    "--output-format",
+    type=click.Choice(["json", "parquet"]),
+    default=None,
+    help="Output format (default: parquet for `*.parquet` output, else json)",
+)
+@click.option(
+    "--wide",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Parquet: write one table per schema to the output directory",
+)
 @click.argument("properties", nargs=-1)
 def q(
     input_uri: str = "-",
@@ -99,6 +113,8 @@ def q(
     count: tuple[str, ...] = (),
     groups: tuple[str, ...] = (),
     aggregation_uri: str | None = None,
+    output_format: str | None = None,
+    wide: bool = False,
 ):
     """
     Apply ftmq filter to a json stream of ftm entities.
@@ -133,11 +149,31 @@ def q(
     if aggregation_uri and aggs:
         for func, props in aggs.items():
             q = q.aggregate(func, *props, groups=groups)
+    if output_format is None:
+        parquet = wide or output_uri.endswith(".parquet")
+        output_format = "parquet" if parquet else "json"
+    if wide:
+        if output_format != "parquet":
+            raise click.UsageError("--wide is only supported for parquet output")
+        if output_uri == "-":
+            raise click.BadParameter(
+                "--wide needs an output directory", param_hint="--output-uri"
+            )
+    if output_format == "parquet" and not stats_uri and not q.aggregator:
+        store = smart_get_store(input_uri, dataset=store_dataset)
+        if store is not None and output_uri != "-":
+            store.view().to_parquet(output_uri, q, wide=wide)
+            return
     proxies = smart_read_proxies(input_uri, dataset=store_dataset, query=q)
     stats = Collector()
     if stats_uri:
         proxies = stats.apply(proxies)
-    smart_write_proxies(output_uri, proxies, dataset=store_dataset)
+    if output_format == "parquet":
+        from ftmq.arrow import write_parquet
+
+        write_parquet(output_uri, proxies, wide=wide)
+    else:
+        smart_write_proxies(output_uri, proxies, dataset=store_dataset)
     if stats_uri:
         stats = stats.export()
         smart_write_model(stats_uri, stats)
@@ -316,6 +352,143 @@ def store_iterate(
     smart_write_proxies(output_uri, store.iterate())
 
 
+@store.command("changes")
+@click.option(
+    "-i",
+    "--input-uri",
+    default=settings.DB_URL,
+    show_default=True,
+    help="lake store input uri",
+)
+@click.option(
+    "-o", "--output-uri", default="-", show_default=True, help="output file or uri"
+)
+@click.option(
+    "--since-version",
+    type=int,
+    required=True,
+    help="Delta version of the previous run (exclusive)",
+)
+@click.option(
+    "--version-uri",
+    default=None,
+    show_default=True,
+    help="If specified, write the new high-water version to this uri",
+)
+def store_changes(
+    input_uri: str = settings.DB_URL,
+    output_uri: str = "-",
+    since_version: int = 0,
+    version_uri: str | None = None,
+):
+    """
+    Iterate entities of a lake store that changed since the given version
+    """
+    from ftmq.store.lake import LakeStore
+
+    store = get_store(input_uri)
+    if not isinstance(store, LakeStore):
+        raise click.BadParameter("Not a lake store", param_hint="--input-uri")
+    version, entities = store.changes(since_version)
+    smart_write_proxies(output_uri, entities)
+    log.info(f"Changes until version {version}", uri=input_uri)
+    if version_uri and version is not None:
+        smart_write(version_uri, f"{version}\n".encode())
+
+
+@store.command("compact")
+@click.option(
+    "-i",
+    "--input-uri",
+    default=settings.DB_URL,
+    show_default=True,
+    help="lake store input uri",
+)
+@click.option(
+    "-o",
+    "--output-uri",
+    default="-",
+    show_default=True,
+    help="output file or uri for the metrics",
+)
+@click.option(
+    "--max-files",
+    type=int,
+    default=100,
+    show_default=True,
+    help="Compact partitions with more data files",
+)
+@click.option(
+    "--small-file-size",
+    type=int,
+    default=32 * 1024 * 1024,
+    show_default=True,
+    help="Files below this size (bytes) count as small",
+)
+@click.option(
+    "--max-small-files",
+    type=int,
+    default=20,
+    show_default=True,
+    help="Compact partitions with more small files",
+)
+@click.option(
+    "--interval",
+    type=int,
+    default=None,
+    show_default=True,
+    help="If specified, keep running and check every n seconds",
+)
+def store_compact(
+    input_uri: str = settings.DB_URL,
+    output_uri: str = "-",
+    max_files: int = 100,
+    small_file_size: int = 32 * 1024 * 1024,
+    max_small_files: int = 20,
+    interval: int | None = None,
+):
+    """
+    Compact the partitions of a lake store that cross the thresholds
+    """
+    from ftmq.store.lake import CompactionPolicy, LakeStore
+
+    store = get_store(input_uri)
+    if not isinstance(store, LakeStore):
+        raise click.BadParameter("Not a lake store", param_hint="--input-uri")
+    policy = CompactionPolicy(
+        max_files=max_files,
+        small_file_size=small_file_size,
+        max_small_files=max_small_files,
+    )
+    while True:
+        metrics = store.compact(policy)
+        smart_write(output_uri, metrics.model_dump_json().encode() + b"\n")
+        if interval is None:
+            break
+        time.sleep(interval)
+
+
+@store.command("index")
+@click.option(
+    "-i",
+    "--input-uri",
+    default=settings.DB_URL,
+    show_default=True,
+    help="lake store input uri",
+)
+def store_index(input_uri: str = settings.DB_URL):
+    """
+    Rebuild the canonical id point lookup index of a lake store from all its
+    data files
+    """
+    from ftmq.store.lake import LakeStore
+
+    store = get_store(input_uri)
+    if not isinstance(store, LakeStore):
+        raise click.BadParameter("Not a lake store", param_hint="--input-uri")
+    store.update_index(rebuild=True)
+
+
 @cli.group()
 def fragments():
     pass
@@ -370,6 +543,34 @@ def fragments_list_datasets(
     default=None,
     help="Filter by timestamp (until), ISO format: YYYY-MM-DDTHH:MM:SS",
 )
+@click.option(
+    "--streamed/--batched",
+    default=False,
+    show_default=True,
+    help="Iterate with one streamed query (one long transaction) instead of "
+    "in id batches",
+)
+@click.option(
+    "--changed",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Yield the complete entities that changed in the --since / --until "
+    "window instead of only their fragments from that window",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Aggregate id batches in this many worker processes",
+)
+@click.option(
+    "--ordered/--unordered",
+    default=True,
+    show_default=True,
+    help="Parallel mode: keep the output sorted by id",
+)
 def fragments_iterate(
     input_uri: str = fragments_settings.database_uri,
     output_uri: str = "-",
@@ -377,6 +578,10 @@ def fragments_iterate(
     schema: str | None = None,
     since: str | None = None,
     until: str | None = None,
+    streamed: bool = False,
+    changed: bool = False,
+    workers: int = 1,
+    ordered: bool = True,
 ):
     """
     Iterate all entities from a fragments dataset
@@ -387,9 +592,23 @@ def fragments_iterate(
     since_dt = datetime.fromisoformat(since) if since else None
     until_dt = datetime.fromisoformat(until) if until else None
 
-    smart_write_proxies(
-        output_uri, fragments.iterate(schema=schema, since=since_dt, until=until_dt)
-    )
+    if changed:
+        if since_dt is None:
+            raise click.UsageError("--changed requires --since")
+        if workers > 1:
+            raise click.UsageError("--changed doesn't support --workers")
+        entities = fragments.iterate_changed(since_dt, until=until_dt, schema=schema)
+    elif workers > 1:
+        if streamed:
+            raise click.UsageError("--streamed doesn't support --workers")
+        entities = fragments.iterate_parallel(
+            workers, ordered=ordered, schema=schema, since=since_dt, until=until_dt
+        )
+    else:
+        entities = fragments.iterate(
+            schema=schema, since=since_dt, until=until_dt, streamed=streamed
+        )
+    smart_write_proxies(output_uri, entities)
 
 
 @fragments.command("iterate-fragments")
@@ -417,6 +636,99 @@ def fragments_iterate_unsorted(
     smart_write_json(output_uri, fragments.fragments(sort=False, include_fragment=True))
 
 
+@fragments.command("migrate")
+@click.option(
+    "-i",
+    "--input-uri",
+    default=fragments_settings.database_uri,
+    show_default=True,
+    help="fragments store uri",
+)
+@click.option("-d", "--dataset", required=True, help="Dataset name to migrate")
+@click.option(
+    "--encoding",
+    type=click.Choice(["json", "zstd"]),
+    default=None,
+    help="Re-write the fragments table with this storage format",
+)
+def fragments_migrate(
+    input_uri: str = fragments_settings.database_uri,
+    dataset: str = None,
+    encoding: str | None = None,
+):
+    """
+    Migrate a fragments table in place: add missing columns and indexes, or
+    re-write it with another storage format
+    """
+    fragments = get_fragments(dataset, database_uri=input_uri)
+    fragments.migrate(encoding)
+
+
+@fragments.command("export-lake")
+@click.option(
+    "-i",
+    "--input-uri",
+    default=fragments_settings.database_uri,
+    show_default=True,
+    help="fragments store input uri",
+)
+@click.option("-d", "--dataset", required=True, help="Dataset name to export")
+@click.option("-o", "--output-uri", required=True, help="lake store uri")
+@click.option(
+    "--batch-size",
+    type=int,
+    default=10_000,
+    show_default=True,
+    help="Number of entities per batch",
+)
+@click.option(
+    "--metrics-uri",
+    default="-",
+    show_default=True,
+    help="Write the export metrics (throughput) to this uri",
+)
+def fragments_export_lake(
+    input_uri: str = fragments_settings.database_uri,
+    dataset: str = None,
+    output_uri: str = None,
+    batch_size: int = 10_000,
+    metrics_uri: str = "-",
+):
+    """
+    Export a fragments dataset into a lake store, streaming its statements in
+    sorted id batches
+    """
+    from ftmq.store.lake import LakeStore
+
+    store = get_store(output_uri)
+    if not isinstance(store, LakeStore):
+        raise click.BadParameter("Not a lake store", param_hint="--output-uri")
+    fragments = get_fragments(dataset, database_uri=input_uri)
+    metrics = fragments.to_lake(store, batch_size=batch_size)
+    smart_write(metrics_uri, metrics.model_dump_json().encode() + b"\n")
+
+
+@fragments.command("rebuild-stats")
+@click.option(
+    "-i",
+    "--input-uri",
+    default=fragments_settings.database_uri,
+    show_default=True,
+    help="fragments store uri",
+)
+@click.option("-d", "--dataset", default=None, help="Dataset name (default: all)")
+def fragments_rebuild_stats(
+    input_uri: str = fragments_settings.database_uri,
+    dataset: str | None = None,
+):
+    """
+    Rebuild the entity and fragment counts of the datasets in a fragments
+    store, e.g. for tables written by an older version
+    """
+    store = get_fragments_store(input_uri)
+    store.rebuild_stats(dataset)
+
+
 @cli.command("aggregate")
 @click.option(
     "-i", "--input-uri", default="-", show_default=True, help="input file or uri"
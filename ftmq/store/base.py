@@ -1,8 +1,9 @@
 from functools import cache, wraps
-from typing import Generic, Iterable, TypeVar
+from typing import TYPE_CHECKING, Generic, Iterable, TypeVar
 from urllib.parse import urlparse
 
 from anystore.logging import get_logger
+from anystore.types import Uri
 from followthemoney.dataset.dataset import Dataset
 from nomenklatura import db as nk_db
 from nomenklatura import store as nk
@@ -18,6 +19,9 @@ from ftmq.query import Query
 from ftmq.types import StatementEntities, StatementEntity
 from ftmq.util import DEFAULT_DATASET, ensure_dataset
 
+if TYPE_CHECKING:
+    import pyarrow as pa
+
 log = get_logger(__name__)
 
 DEFAULT_ORIGIN = "default"
@@ -197,3 +201,63 @@ class View(nk.View):
             res = dict(query.aggregator.result)
             self._cache[key] = res
             return res
+
+    def to_arrow(
+        self,
+        query: Query | None = None,
+        schema: str | None = None,
+        batch_size: int = 10_000,
+    ) -> "pa.RecordBatchReader":
+        """
+        Stream the (filtered) entities as arrow record batches, requires
+        `pyarrow`.
+
+        Example:
+            ```python
+            df = view.to_arrow(Query().where(schema="Person")).read_pandas()
+            ```
+
+        Args:
+            query: The Query filter object
+            schema: Return the wide table for this schema (one list-typed
+                column per property) instead of the statement table
+            batch_size: Maximum number of rows per batch
+
+        Returns:
+            A `pyarrow.RecordBatchReader`
+        """
+        from ftmq.arrow import (
+            STATEMENT_SCHEMA,
+            entity_batches,
+            get_wide_schema,
+            iter_reader,
+            statement_batches,
+        )
+
+        if schema is not None:
+            return iter_reader(
+                get_wide_schema(schema),
+                entity_batches(self.query(query), schema, batch_size),
+            )
+        return iter_reader(
+            STATEMENT_SCHEMA, statement_batches(self.query(query), batch_size)
+        )
+
+    def to_parquet(
+        self, uri: Uri, query: Query | None = None, wide: bool = False
+    ) -> int:
+        """
+        Write the (filtered) entities to parquet, requires `pyarrow`. See
+        [`write_parquet`][ftmq.arrow.write_parquet]
+
+        Args:
+            uri: The target file uri, or the target directory for the wide layout
+            query: The Query filter object
+            wide: Write one table per schema instead of one statement table
+
+        Returns:
+            Number of written rows (statements, or entities for the wide layout)
+        """
+        from ftmq.arrow import write_parquet
+
+        return write_parquet(uri, self.query(query), wide=wide)
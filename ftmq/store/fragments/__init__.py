@@ -9,6 +9,7 @@ from ftmq.store.fragments.utils import NULL_ORIGIN
 @cache
 def get_store(database_uri: str | None = None, **config) -> Store:
     settings = Settings()
+    config.setdefault("encoding", settings.encoding)
     return Store(database_uri=database_uri or settings.database_uri, **config)
 
 
@@ -1,33 +1,71 @@
 import logging
+import time
+from collections import Counter, deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 from contextlib import contextmanager
 from datetime import datetime
-from typing import Generator, Iterable, TypeAlias
+from hashlib import sha1
+from itertools import groupby
+from typing import TYPE_CHECKING, Any, Generator, Iterable, TypeAlias
 
 from banal import ensure_list
-from followthemoney import EntityProxy, StatementEntity
+from followthemoney import EntityProxy, StatementEntity, model
 from followthemoney.dataset.util import dataset_name_check
+from followthemoney.exc import InvalidData
+from followthemoney.statement import Statement
+from followthemoney.statement.util import BASE_ID
+from followthemoney.util import HASH_ENCODING
+from followthemoney.value import string_list
 from normality import slugify
 from sqlalchemy import (
     JSON,
     Column,
     Connection,
     DateTime,
+    Delete,
+    Index,
+    LargeBinary,
+    MetaData,
     String,
     Table,
     UniqueConstraint,
+    bindparam,
     distinct,
     func,
+    insert,
     select,
+    text,
+    tuple_,
+    update,
 )
+from sqlalchemy import inspect as sqlalchemy_inspect
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.exc import OperationalError
 
 from ftmq.store.fragments.loader import BulkLoader
-from ftmq.store.fragments.utils import NULL_ORIGIN
+from ftmq.store.fragments.utils import (
+    ALL_ORIGINS,
+    ENCODING_JSON,
+    ENCODING_ZSTD,
+    ENCODINGS,
+    NULL_ORIGIN,
+    Codec,
+    train_zstd_dict,
+)
 from ftmq.types import Statements
 from ftmq.util import make_dataset
 
+if TYPE_CHECKING:
+    from ftmq.store.lake import LakeExportMetrics, LakeStore
+
 log = logging.getLogger(__name__)
+STATS_CHUNK = 1000  # entity ids per count query for the stats
 UNDEFINED = (OperationalError,)
 try:
     from psycopg.errors import UndefinedTable
@@ -71,7 +109,10 @@ class Fragments(object):
         self.store = store
         self.name = dataset_name_check(name)
         self.origin = origin
+        self._encoding = store.encoding
+        self._schema_column = True
         self._table = None
+        self._codec: Codec | None = None
 
     @property
     def table(self):
@@ -80,35 +121,381 @@ class Fragments(object):
         table_name = slugify("%s %s" % (self.store.PREFIX, self.name), sep="_")
         if not table_name:
             raise RuntimeError(f"Invalid table name: `{table_name}`")
-        json_type = JSONB if self.store.is_postgres else JSON
-        self._table = Table(
-            table_name,
-            self.store.meta,
+        exists = sqlalchemy_inspect(self.store.engine).has_table(table_name)
+        self._encoding, self._schema_column = self._inspect_table(table_name)
+        self._table = self._make_table(
+            table_name, self._encoding, schema_column=self._schema_column
+        )
+        self._table.create(bind=self.store.engine, checkfirst=True)
+        if not exists:
+            self.store.init_stats(self.name)
+        if not self._schema_column:
+            log.warning(
+                "Fragments table `%s` has no schema column, run "
+                "`ftmq fragments migrate` for indexed schema filters",
+                table_name,
+            )
+        return self._table
+
+    def _make_table(
+        self, table_name, encoding, meta=None, schema_column=True, indexes=True
+    ):
+        if encoding == ENCODING_ZSTD:
+            entity_type = LargeBinary
+        else:
+            entity_type = JSONB if self.store.is_postgres else JSON
+        columns = [
             Column("id", String, nullable=False),
             Column("origin", String, nullable=False),
             Column("fragment", String, nullable=False),
             Column("timestamp", DateTime, default=datetime.utcnow),
-            Column("entity", json_type),
+            Column("entity", entity_type),
+        ]
+        if schema_column:
+            columns.append(Column("schema", String, nullable=True))
+        table = Table(
+            table_name,
+            meta if meta is not None else self.store.meta,
+            *columns,
             UniqueConstraint("id", "origin", "fragment"),
             extend_existing=True,
         )
-        self._table.create(bind=self.store.engine, checkfirst=True)
-        return self._table
+        if schema_column and indexes:
+            # index-backed schema and since / until filters
+            existing = {i.name for i in table.indexes}
+            for column in ("schema", "timestamp"):
+                name = f"ix_{table_name}_{column}_id"
+                if name not in existing:
+                    Index(name, table.c[column], table.c.id)
+        return table
+
+    def _inspect_table(self, table_name) -> tuple[str, bool]:
+        """Existing tables keep their storage format (and may lack the schema
+        column), new ones get the format of the store"""
+        inspect = sqlalchemy_inspect(self.store.engine)
+        if not inspect.has_table(table_name):
+            return self.store.encoding, True
+        encoding = ENCODING_JSON
+        schema_column = False
+        for column in inspect.get_columns(table_name):
+            if column["name"] == "entity" and isinstance(column["type"], LargeBinary):
+                encoding = ENCODING_ZSTD
+            if column["name"] == "schema":
+                schema_column = True
+        return encoding, schema_column
+
+    @property
+    def has_schema_column(self) -> bool:
+        _ = self.table
+        return self._schema_column
+
+    @property
+    def encoding(self) -> str:
+        """The storage format of the table"""
+        _ = self.table
+        return self._encoding
+
+    @property
+    def codec(self) -> Codec:
+        if self._codec is None:
+            self._codec = Codec(self.store.get_zstd_dict(self.table.name))
+        return self._codec
+
+    def encode_entity(self, data):
+        """Encode fragment data for the storage format of the table"""
+        if self.encoding == ENCODING_ZSTD:
+            return self.codec.encode(data)
+        return data
+
+    def decode_entity(self, value):
+        """Decode stored fragment data (on the client for binary formats)"""
+        if self.encoding == ENCODING_ZSTD:
+            return self.codec.decode(value)
+        return value
+
+    def _filter_schema(self, stmt, schema):
+        if self.has_schema_column:
+            return stmt.where(self.table.c.schema == schema)
+        if self.encoding == ENCODING_ZSTD:
+            return stmt  # filtered after decoding
+        if self.store.is_postgres:
+            return stmt.where(self.table.c.entity["schema"].astext == schema)
+        # SQLite JSON support - use json_extract function
+        return stmt.where(func.json_extract(self.table.c.entity, "$.schema") == schema)
 
     def reset(self):
         self._table = None
+        self._codec = None
 
     def drop(self):
         log.debug("Dropping ftm-store: %s", self.table)
+        stats = self.store.stats
         try:
-            self.table.drop(self.store.engine)
+            with self.store.engine.begin() as conn:
+                self.table.drop(conn)
+                conn.execute(stats.delete().where(stats.c.dataset == self.name))
             self.reset()
         except UNDEFINED:
             self.reset()
             raise
 
+    def _count_fragments(
+        self, conn: Connection, entity_ids: Iterable[str]
+    ) -> dict[tuple[str, str], int]:
+        """Count the fragments of the given ids per (id, origin)"""
+        table = self.table
+        counts: dict[tuple[str, str], int] = {}
+        entity_ids = sorted(set(entity_ids))
+        for ix in range(0, len(entity_ids), STATS_CHUNK):
+            q = (
+                select(table.c.id, table.c.origin, func.count())
+                .where(table.c.id.in_(entity_ids[ix : ix + STATS_CHUNK]))
+                .group_by(table.c.id, table.c.origin)
+            )
+            for id_, origin, fragments in conn.execute(q):
+                counts[(id_, origin)] = fragments
+        return counts
+
+    def _update_stats(
+        self,
+        conn: Connection,
+        changed: list[tuple[str, str]],
+        origins: Iterable[str],
+        timestamp: datetime,
+        deleted: bool = False,
+    ) -> None:
+        """Update the stats after a write to `origins` that inserted (or
+        `deleted`) the fragments `changed`, given as (id, origin). Only the
+        ids of these fragments are counted afterwards, to find the entities
+        that are new (all of their fragments are) or gone (none are left)."""
+        sign = -1 if deleted else 1
+        fragments: Counter[tuple[str, str]] = Counter(changed)
+        totals: Counter[str] = Counter(id_ for id_, _ in changed)
+        counts = self._count_fragments(conn, totals) if changed else {}
+        left: Counter[str] = Counter()
+        for (id_, _), count in counts.items():
+            left[id_] += count
+        deltas: dict[str, list[int]] = {o: [0, 0] for o in {*origins, ALL_ORIGINS}}
+        for (id_, origin), count in fragments.items():
+            delta = deltas.setdefault(origin, [0, 0])
+            delta[1] += sign * count
+            remaining = counts.get((id_, origin), 0)
+            if remaining == (0 if deleted else count):
+                delta[0] += sign
+        for id_, count in totals.items():
+            deltas[ALL_ORIGINS][1] += sign * count
+            if left[id_] == (0 if deleted else count):
+                deltas[ALL_ORIGINS][0] += sign
+        self.store.update_stats(
+            conn, self.name, {o: (e, f) for o, (e, f) in deltas.items()}, timestamp
+        )
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """
+        Get the number of entities and fragments and the last write time per
+        origin, the dataset totals are keyed by `ALL_ORIGINS` (`*`).
+        """
+        return self.store.get_stats(self.name)
+
+    def rebuild_stats(self) -> None:
+        """Rebuild the stats of this dataset from its fragments table"""
+        table = self.table
+        stats = self.store.stats
+        columns = (
+            func.count(distinct(table.c.id)),
+            func.count(),
+            func.max(table.c.timestamp),
+        )
+        with self.store.engine.begin() as conn:
+            conn.execute(stats.delete().where(stats.c.dataset == self.name))
+            q = select(table.c.origin, *columns).group_by(table.c.origin)
+            rows = [(origin, *values) for origin, *values in conn.execute(q)]
+            rows.append((ALL_ORIGINS, *conn.execute(select(*columns)).one()))
+            for origin, entities, fragments, last_write in rows:
+                conn.execute(
+                    insert(stats).values(
+                        dataset=self.name,
+                        origin=origin,
+                        entities=entities,
+                        fragments=fragments,
+                        last_write=last_write,
+                    )
+                )
+
+    def upgrade(self, batch_size=10_000) -> int:
+        """
+        Add the indexed `schema` column to a table created before it existed,
+        in place, and fill it from the fragment data with one transaction per
+        batch. An interrupted upgrade continues with the fragments that have
+        no `schema` yet.
+
+        Returns:
+            Number of updated fragments
+        """
+        table = self.table
+        if not self._schema_column:
+            with self.store.engine.begin() as conn:
+                conn.execute(
+                    text(f'ALTER TABLE "{table.name}" ADD COLUMN schema VARCHAR')
+                )
+            self.store.meta.remove(table)
+            self.reset()
+            table = self.table
+        if self.encoding == ENCODING_ZSTD:
+            _ = self.codec
+        keys = tuple_(table.c.id, table.c.origin, table.c.fragment)
+        if self.encoding == ENCODING_JSON:
+            if self.store.is_postgres:
+                value = table.c.entity["schema"].astext
+            else:
+                value = func.json_extract(table.c.entity, "$.schema")
+        else:
+            stmt = (
+                update(table)
+                .where(table.c.id == bindparam("b_id"))
+                .where(table.c.origin == bindparam("b_origin"))
+                .where(table.c.fragment == bindparam("b_fragment"))
+                .values(schema=bindparam("b_schema"))
+            )
+        ix = 0
+        last = None
+        while True:
+            with self.store.engine.begin() as conn:
+                query = select(table.c.id, table.c.origin, table.c.fragment)
+                if self.encoding == ENCODING_ZSTD:
+                    query = query.add_columns(table.c.entity)
+                query = query.where(table.c.schema.is_(None))
+                if last is not None:
+                    query = query.where(keys > tuple_(*last))
+                query = query.order_by(*keys.clauses).limit(batch_size)
+                rows = conn.execute(query).fetchall()
+                if not rows:
+                    break
+                if self.encoding == ENCODING_JSON:
+                    batch = (
+                        update(table)
+                        .where(table.c.schema.is_(None))
+                        .where(keys <= tuple_(*rows[-1][:3]))
+                        .values(schema=value)
+                    )
+                    if last is not None:
+                        batch = batch.where(keys > tuple_(*last))
+                    conn.execute(batch)
+                else:
+                    values = [
+                        {
+                            "b_id": row.id,
+                            "b_origin": row.origin,
+                            "b_fragment": row.fragment,
+                            "b_schema": self.decode_entity(row.entity).get("schema"),
+                        }
+                        for row in rows
+                    ]
+                    conn.execute(stmt, values)
+            ix += len(rows)
+            last = rows[-1].id, rows[-1].origin, rows[-1].fragment
+        for index in table.indexes:
+            index.create(self.store.engine, checkfirst=True)
+        log.info("Upgraded %d fragments of `%s`", ix, self.name)
+        return ix
+
+    def _table_page(self, conn, table, batch_size, last=None):
+        keys = tuple_(table.c.id, table.c.origin, table.c.fragment)
+        stmt = select(table).order_by(*keys.clauses).limit(batch_size)
+        if last is not None:
+            stmt = stmt.where(keys > tuple_(*last))
+        return conn.execute(stmt).fetchall()
+
+    def _iter_table(self, conn, table, batch_size):
+        last = None
+        while True:
+            rows = self._table_page(conn, table, batch_size, last)
+            if not rows:
+                return
+            yield rows
+            last = rows[-1].id, rows[-1].origin, rows[-1].fragment
+
+    def migrate(self, encoding=None, batch_size=10_000) -> int:
+        """
+        Re-write the table in place with the given storage format (`json` or
+        `zstd`) and the current layout. For `zstd` a compression dictionary is
+        trained from a sample of the fragments. Without `encoding`, only
+        missing columns and indexes are added in place (`upgrade`).
+
+        The fragments are copied into a new table with one transaction per
+        batch, which then replaces the table. Fragments written to the dataset
+        while it is migrated are lost.
+
+        Returns:
+            Number of migrated fragments
+        """
+        if encoding is None:
+            return self.upgrade(batch_size)
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Invalid encoding: `{encoding}`")
+        table = self.table
+        target = self._make_table(
+            f"{table.name}_migrate", encoding, MetaData(), indexes=False
+        )
+        # set up before the write transaction (sqlite would lock otherwise)
+        _ = self.store.dicts
+        if self.encoding == ENCODING_ZSTD:
+            _ = self.codec
+        codec = None
+        zstd_dict = None
+        with self.store.engine.begin() as conn:
+            target.drop(conn, checkfirst=True)
+            target.create(conn)
+            if encoding == ENCODING_ZSTD:
+                sample = conn.execute(select(table.c.entity).limit(10_000))
+                zstd_dict = train_zstd_dict(self.decode_entity(r[0]) for r in sample)
+                codec = Codec(zstd_dict)
+        ix = 0
+        last = None
+        while True:
+            with self.store.engine.begin() as conn:
+                rows = self._table_page(conn, table, batch_size, last)
+                if not rows:
+                    break
+                values = []
+                for row in rows:
+                    entity = self.decode_entity(row.entity)
+                    values.append(
+                        {
+                            "id": row.id,
+                            "origin": row.origin,
+                            "fragment": row.fragment,
+                            "timestamp": row.timestamp,
+                            "entity": codec.encode(entity) if codec else entity,
+                            "schema": entity.get("schema"),
+                        }
+                    )
+                conn.execute(insert(target), values)
+            ix += len(rows)
+            last = rows[-1].id, rows[-1].origin, rows[-1].fragment
+            log.debug("Migrated %d fragments of `%s` ...", ix, self.name)
+        with self.store.engine.begin() as conn:
+            table.drop(conn)
+            conn.execute(text(f'ALTER TABLE "{target.name}" RENAME TO "{table.name}"'))
+            if self.store.is_postgres:
+                # the index of the unique constraint keeps the temporary name
+                conn.execute(
+                    text(
+                        f'ALTER INDEX IF EXISTS "{target.name}_id_origin_fragment_key" '
+                        f'RENAME TO "{table.name}_id_origin_fragment_key"'
+                    )
+                )
+            for index in self._make_table(table.name, encoding, MetaData()).indexes:
+                index.create(conn)
+            self.store.put_zstd_dict(table.name, zstd_dict, conn)
+        self.store.meta.remove(table)
+        self.reset()
+        log.info("Migrated %d fragments of `%s` to `%s`", ix, self.name, encoding)
+        return ix
+
     def delete(self, entity_id=None, fragment=None, origin=None):
         table = self.table
+        _ = self.store.stats
         stmt = table.delete()
         if entity_id is not None:
             stmt = stmt.where(table.c.id == entity_id)
@@ -118,36 +505,64 @@ class Fragments(object):
             stmt = stmt.where(table.c.origin == origin)
         try:
             with self.store.engine.connect() as conn:
-                conn.execute(stmt)
+                if entity_id is not None and conn.dialect.delete_returning:
+                    self._delete_returning(conn, stmt)
+                else:
+                    conn.execute(stmt)
                 conn.commit()
         except UNDEFINED:
             self.reset()
             raise
+        if entity_id is None or not self.store.engine.dialect.delete_returning:
+            self.rebuild_stats()
 
     def delete_many(self, entity_ids: list[str], origin: str | None = None):
         if not entity_ids:
             return
 
         table = self.table
+        _ = self.store.stats
         stmt = table.delete()
         stmt = stmt.where(table.c.id.in_(entity_ids))
         if origin is not None:
             stmt = stmt.where(table.c.origin == origin)
         try:
             with self.store.engine.connect() as conn:
-                conn.execute(stmt)
+                if conn.dialect.delete_returning:
+                    self._delete_returning(conn, stmt)
+                else:
+                    conn.execute(stmt)
                 conn.commit()
         except UNDEFINED:
             self.reset()
             raise
+        if not self.store.engine.dialect.delete_returning:
+            self.rebuild_stats()
+
+    def _delete_returning(self, conn: Connection, stmt: Delete) -> None:
+        table = self.table
+        res = conn.execute(stmt.returning(table.c.id, table.c.origin))
+        deleted = [(id_, origin) for id_, origin in res]
+        origins = {origin for _, origin in deleted}
+        self._update_stats(conn, deleted, origins, datetime.utcnow(), deleted=True)
 
     def put(self, entity, fragment=None, origin=None):
         bulk = self.bulk()
         bulk.put(entity, fragment=fragment, origin=origin)
         return bulk.flush()
 
-    def bulk(self, size=1000):
-        return BulkLoader(self, size)
+    def bulk(self, size=1000, copy=False, background=False, queue_size=2):
+        """
+        Get a bulk loader. With `copy` (postgres via psycopg 3 only, ignored
+        otherwise) batches are written with `COPY` into a staging table and
+        merged at once, use a larger `size` for initial loads (e.g.
+        `ftmq.store.postgres.COPY_BATCH`). With `background`, full batches are
+        written by a background thread (at most `queue_size` pending), call
+        `flush()` at the end to wait for them.
+        """
+        return BulkLoader(
+            self, size, copy=copy, background=background, queue_size=queue_size
+        )
 
     def fragments(
         self,
@@ -171,13 +586,7 @@ class Fragments(object):
         if origin is not None:
             stmt = stmt.where(self.table.c.origin == origin)
         if schema is not None:
-            if self.store.is_postgres:
-                stmt = stmt.where(self.table.c.entity["schema"].astext == schema)
-            else:
-                # SQLite JSON support - use json_extract function
-                stmt = stmt.where(
-                    func.json_extract(self.table.c.entity, "$.schema") == schema
-                )
+            stmt = self._filter_schema(stmt, schema)
         if since is not None:
             stmt = stmt.where(self.table.c.timestamp >= since)
         if until is not None:
@@ -191,7 +600,10 @@ class Fragments(object):
             with disable_timeout(conn, self.store) as conn:
                 conn = conn.execution_options(stream_results=True)
                 for ent in conn.execute(stmt):
-                    data = {"id": ent.id, "datasets": [self.name], **ent.entity}
+                    entity = self.decode_entity(ent.entity)
+                    if schema is not None and entity.get("schema") != schema:
+                        continue
+                    data = {"id": ent.id, "datasets": [self.name], **entity}
                     if ent.origin != NULL_ORIGIN:
                         data["origin"] = ent.origin
                     if include_fragment:
@@ -235,8 +647,24 @@ class Fragments(object):
         since=None,
         until=None,
         origin=None,
+        streamed=False,
     ) -> EntityFragments:
+        """
+        Iterate the aggregated entities, optionally filtered. The complete
+        dataset is iterated in sorted id batches, or with one streamed query if
+        `streamed` (see `iterate_streamed`).
+        """
         if entity_id is None:
+            if streamed:
+                log.info("Using streamed iteration for complete dataset.")
+                yield from self.iterate_streamed(
+                    skip_errors=skip_errors,
+                    schema=schema,
+                    since=since,
+                    until=until,
+                    origin=origin,
+                )
+                return
             log.info("Using batched iteration for complete dataset.")
             yield from self.iterate_batched(
                 skip_errors=skip_errors,
@@ -246,47 +674,55 @@ class Fragments(object):
                 origin=origin,
             )
             return
-        entity = None
-        invalid = None
-        fragments = 1
-        for partial in self.partials(
-            entity_id=entity_id,
+        yield from self._aggregate(
+            self.fragments(
+                entity_ids=entity_id,
+                schema=schema,
+                since=since,
+                until=until,
+                origin=origin,
+            ),
             skip_errors=skip_errors,
-            schema=schema,
-            since=since,
-            until=until,
-            origin=origin,
-        ):
-            if partial.id == invalid:
-                continue
-            if entity is not None:
-                if entity.id == partial.id:
-                    fragments += 1
-                    if fragments % 10000 == 0:
-                        log.warning(
-                            "[%s:%s] aggregated %d fragments...",
-                            entity.schema.name,
-                            entity.id,
-                            fragments,
-                        )
-                    try:
-                        entity.merge(partial)
-                    except Exception:
-                        if skip_errors:
-                            log.exception(
-                                "Invalid merge [%s]: %s", self.name, entity.id
-                            )
-                            invalid = entity.id
-                            entity = None
-                            fragments = 1
-                            continue
-                        raise
+        )
+
+    def _aggregate(
+        self, fragments: Iterable[dict], skip_errors=False
+    ) -> EntityFragments:
+        """Merge consecutive fragments (sorted by id) into entities"""
+        for entity_id, group in groupby(fragments, key=lambda f: f["id"]):
+            try:
+                entity = merge_fragments(group, skip_errors=skip_errors)
+            except Exception:
+                if skip_errors:
+                    log.exception("Invalid merge [%s]: %s", self.name, entity_id)
                     continue
+                raise
+            if entity is not None:
                 yield entity
-            entity = partial
-            fragments = 1
-        if entity is not None:
-            yield entity
+
+    def iterate_streamed(
+        self,
+        skip_errors=False,
+        schema=None,
+        since=None,
+        until=None,
+        origin=None,
+    ) -> EntityFragments:
+        """
+        Iterate the complete dataset with one query ordered by id, streamed
+        from a server-side cursor (postgres). Avoids the id batch queries and
+        their large `IN` parameter lists of `iterate_batched`, but keeps one
+        transaction open for the whole iteration.
+        """
+        yield from self._aggregate(
+            self.fragments(
+                schema=schema,
+                since=since,
+                until=until,
+                origin=origin,
+            ),
+            skip_errors=skip_errors,
+        )
 
     def iterate_batched(
         self,
@@ -313,6 +749,84 @@ class Fragments(object):
                 origin=origin,
             )
 
+    def iterate_changed(
+        self,
+        since: datetime,
+        until: datetime | None = None,
+        skip_errors=False,
+        batch_size=10_000,
+        schema=None,
+        origin=None,
+    ) -> EntityFragments:
+        """
+        Iterate the complete (merged from all their fragments) entities that
+        have at least one fragment written since the given timestamp, e.g. for
+        incremental exports. As opposed to `iterate(since=...)`, which filters
+        the fragments themselves and yields partial entities.
+
+        The changed ids are looked up via the `(timestamp, id)` index in sorted
+        batches, so the work is proportional to the number of changed entities.
+        """
+        for entity_ids in self.get_sorted_id_batches(
+            batch_size, schema=schema, since=since, until=until, origin=origin
+        ):
+            yield from self.iterate(
+                entity_id=entity_ids,
+                skip_errors=skip_errors,
+                schema=schema,
+                origin=origin,
+            )
+
+    def iterate_parallel(
+        self,
+        workers=4,
+        batch_size=10_000,
+        ordered=True,
+        skip_errors=False,
+        schema=None,
+        since=None,
+        until=None,
+        origin=None,
+    ) -> EntityFragments:
+        """
+        Iterate the complete dataset with the fragment aggregation spread
+        across worker processes. Each worker opens its own engine, fetches and
+        merges one sorted id batch and returns the serialized entities.
+
+        The database must be reachable from other processes (not an in-memory
+        sqlite database).
+
+        Args:
+            workers: Number of worker processes
+            batch_size: Number of entity ids per batch
+            ordered: Yield the entities sorted by id (in batch order), else as
+                soon as a batch is done
+        """
+        filters = dict(schema=schema, since=since, until=until, origin=origin)
+        batches = self.get_sorted_id_batches(batch_size, **filters)
+        initargs = (self.store.database_uri, self.name, self.origin)
+        with ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=initargs
+        ) as executor:
+            pending: deque[Future] = deque()
+
+            def _next() -> Future:
+                if ordered:
+                    return pending.popleft()
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                future = done.pop()
+                pending.remove(future)
+                return future
+
+            for entity_ids in batches:
+                pending.append(
+                    executor.submit(_iterate_batch, entity_ids, skip_errors, filters)
+                )
+                if len(pending) >= workers * 2:  # bounded prefetch
+                    yield from _load_entities(_next().result())
+            while pending:
+                yield from _load_entities(_next().result())
+
     def get_sorted_id_batches(
         self, batch_size=10_000, schema=None, since=None, until=None, origin=None
     ) -> Generator[list[str], None, None]:
@@ -320,6 +834,15 @@ class Fragments(object):
         Get sorted ID batches to speed up iteration and useful to parallelize
         processing of iterator Entities
         """
+        if (
+            schema is not None
+            and self.encoding == ENCODING_ZSTD
+            and not self.has_schema_column
+        ):
+            yield from self._get_sorted_id_batches_decoded(
+                batch_size, schema=schema, since=since, until=until, origin=origin
+            )
+            return
         last_id = None
         while True:
             stmt = select(self.table.c.id).distinct()
@@ -328,13 +851,7 @@ class Fragments(object):
             if last_id is not None:
                 stmt = stmt.where(self.table.c.id > last_id)
             if schema is not None:
-                if self.store.is_postgres:
-                    stmt = stmt.where(self.table.c.entity["schema"].astext == schema)
-                else:
-                    # SQLite JSON support - use json_extract function
-                    stmt = stmt.where(
-                        func.json_extract(self.table.c.entity, "$.schema") == schema
-                    )
+                stmt = self._filter_schema(stmt, schema)
             if since is not None:
                 stmt = stmt.where(self.table.c.timestamp >= since)
             if until is not None:
@@ -352,6 +869,23 @@ class Fragments(object):
             yield entity_ids
             last_id = entity_ids[-1]
 
+    def _get_sorted_id_batches_decoded(
+        self, batch_size, schema, since=None, until=None, origin=None
+    ) -> Generator[list[str], None, None]:
+        # the schema of binary encoded fragments is only known after decoding
+        batch: list[str] = []
+        for data in self.fragments(
+            schema=schema, since=since, until=until, origin=origin
+        ):
+            if batch and batch[-1] == data["id"]:
+                continue
+            batch.append(data["id"])
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
     def get_sorted_ids(
         self, batch_size=10_000, schema=None, since=None, until=None, origin=None
     ) -> Generator[str, None, None]:
@@ -382,26 +916,79 @@ class Fragments(object):
         if until is not None:
             stmt = stmt.where(self.table.c.timestamp <= until)
         conn = self.store.engine.connect()
-        default_dataset = make_dataset(self.name)
         try:
             conn = conn.execution_options(stream_results=True)
             for fragment in conn.execute(stmt):
-                data = {"id": fragment.id, "datasets": [self.name], **fragment.entity}
-                entity = StatementEntity.from_dict(
-                    data, default_dataset=default_dataset
+                data = {"id": fragment.id, **self.decode_entity(fragment.entity)}
+                yield from fragment_statements(
+                    data,
+                    self.name,
+                    last_seen=fragment.timestamp.isoformat(),
+                    origin=fragment.origin if fragment.origin != NULL_ORIGIN else None,
                 )
-                for statement in entity.statements:
-                    statement.last_seen = fragment.timestamp.isoformat()
-                    statement.origin = (
-                        fragment.origin if fragment.origin != NULL_ORIGIN else None
-                    )
-                    yield statement
         except Exception:
             self.reset()
             raise
         finally:
             conn.close()
 
+    def to_lake(
+        self, store: "LakeStore", batch_size=10_000, queue_size=2
+    ) -> "LakeExportMetrics":
+        """
+        Export the dataset into a `LakeStore`. The statements of sorted id
+        batches are built into arrow tables directly (without aggregating the
+        entities) and written by a background thread via
+        `LakeWriter.write_table` while the next batch is read. Statements keep
+        their fragment origin, the fragment timestamps become `last_seen`.
+
+        Args:
+            store: The target lake store
+            batch_size: Number of entity ids per batch
+            queue_size: Maximum number of batches waiting to be written
+
+        Returns:
+            The export metrics (including the throughput)
+        """
+        from ftmq.store.lake import LakeExportMetrics
+
+        metrics = LakeExportMetrics()
+        start = time.perf_counter()
+        writer = store.writer()
+
+        with ThreadPoolExecutor(1) as executor:
+            pending: deque[tuple[Future, int, int]] = deque()
+
+            def _done() -> None:
+                future, entities, statements = pending.popleft()
+                future.result()
+                metrics.batches += 1
+                metrics.entities += entities
+                metrics.statements += statements
+                metrics.seconds = time.perf_counter() - start
+                metrics.statements_per_second = metrics.statements / metrics.seconds
+                log.info(
+                    "Exported %d entities (%d statements) of `%s`: %d statements/s",
+                    metrics.entities,
+                    metrics.statements,
+                    self.name,
+                    metrics.statements_per_second,
+                )
+
+            for entity_ids in self.get_sorted_id_batches(batch_size):
+                table = writer.make_table(self.statements(entity_ids))
+                future = executor.submit(writer.write_table, table)
+                pending.append((future, len(entity_ids), table.num_rows))
+                if len(pending) > queue_size:
+                    _done()
+            while pending:
+                _done()
+        writer.flush()
+        metrics.seconds = time.perf_counter() - start
+        if metrics.seconds:
+            metrics.statements_per_second = metrics.statements / metrics.seconds
+        return metrics
+
     def get(self, entity_id) -> EntityProxy | None:
         for entity in self.iterate(entity_id=entity_id):
             return entity
@@ -410,11 +997,201 @@ class Fragments(object):
         return self.iterate()
 
     def __len__(self):
-        q = select(func.count(distinct(self.table.c.id)))
-        with self.store.engine.connect() as conn:
-            res = conn.execute(q)
-
-        return res.scalar()
+        stats = self.stats()
+        if ALL_ORIGINS not in stats:
+            # a table of an older version without stats, register it
+            self.rebuild_stats()
+            stats = self.stats()
+        return stats[ALL_ORIGINS]["entities"]
 
     def __repr__(self):
         return "<Dataset(%r, %r)>" % (self.store, self.name)
+
+
+def merge_fragments(
+    fragments: Iterable[dict[str, Any]], skip_errors=False
+) -> EntityProxy | None:
+    """
+    Merge the fragments of one entity into one proxy. The result is the same
+    as merging the `EntityProxy` of each fragment into the first one, but the
+    property values of all fragments are collected into (ordered) sets first,
+    the common schema is resolved on the way and the proxy is built once.
+
+    Args:
+        fragments: Fragment data of the same entity id (as from
+            `Fragments.fragments`)
+        skip_errors: Skip (and log) fragments without a valid schema
+
+    Returns:
+        The merged proxy, `None` if there were no valid fragments
+
+    Raises:
+        InvalidData: If the fragments have no common schema
+    """
+    schema = None
+    entity_id = None
+    properties: dict[str, dict[str, None]] = {}
+    first: dict[str, Any] = {}
+    context: dict[str, dict[Any, None]] = {}
+    size = 0
+    ix = 0
+    for data in fragments:
+        fragment_schema = model.get(data.get("schema") or "")
+        if fragment_schema is None:
+            if skip_errors:
+                log.error("Invalid data: No schema for entity %s", data.get("id"))
+                continue
+            raise InvalidData("No schema for entity.")
+        ix += 1
+        for key, value in data.items():
+            if key not in ("properties", "caption"):
+                values = context.setdefault(key, {})
+                values.update((v, None) for v in ensure_list(value) if v is not None)
+        if schema is None:
+            schema = fragment_schema
+            entity_id = str(data["id"]) if data.get("id") else None
+            first = data
+            for key, values in data.get("properties", {}).items():
+                if key in schema.properties:
+                    properties[key] = dict.fromkeys(values)
+                    size += sum(len(v) for v in properties[key])
+            continue
+        if ix % 10000 == 0:
+            log.warning(
+                "[%s:%s] aggregated %d fragments...", schema.name, entity_id, ix
+            )
+        entity_id = entity_id or (str(data["id"]) if data.get("id") else None)
+        try:
+            schema = model.common_schema(schema, fragment_schema)
+        except InvalidData as e:
+            raise InvalidData(f"Cannot merge entities with id {entity_id}: {e}")
+        for key, values in data.get("properties", {}).items():
+            if key not in fragment_schema.properties:
+                continue
+            prop = schema.properties[key]
+            if prop.stub:
+                continue
+            total_size = prop.type.total_size
+            for value in string_list(list(dict.fromkeys(values))):
+                # the size limit of `EntityProxy.unsafe_add`
+                if total_size is not None and size + len(value) > total_size:
+                    continue
+                size += len(value)
+                properties.setdefault(key, {})[value] = None
+    if schema is None:
+        return None
+    entity = EntityProxy(
+        schema,
+        {"id": entity_id, "properties": {k: list(v) for k, v in properties.items()}},
+    )
+    if ix == 1:
+        entity.context = {k: v for k, v in first.items() if k != "properties"}
+    else:
+        entity.context = {k: list(v) for k, v in context.items()}
+    return entity
+
+
+def fragment_statements(
+    data: dict[str, Any],
+    dataset: str,
+    last_seen: str | None = None,
+    origin: str | None = None,
+) -> Statements:
+    """
+    Generate the statements of a fragment, the same as the `statements` of a
+    `StatementEntity` built from it (including the checksum `id` statement),
+    but directly from the property values without building the entity. The
+    statement ids are computed as in `Statement.make_key`.
+
+    Args:
+        data: The fragment data (`id`, `schema` and `properties`)
+        dataset: The dataset name of the statements
+        last_seen: The `last_seen` timestamp of the statements
+        origin: The origin of the statements
+
+    Raises:
+        InvalidData: If the fragment has no valid schema
+    """
+    if data.get("statements"):
+        entity = StatementEntity.from_dict(
+            data, default_dataset=make_dataset(dataset)
+        )
+        for stmt in entity.statements:
+            stmt.last_seen = last_seen
+            stmt.origin = origin
+            yield stmt
+        return
+    schema = model.get(data.get("schema") or "")
+    if schema is None:
+        raise InvalidData("No schema for entity.")
+    entity_id = data["id"]
+    schema_name = schema.name
+    prefix = f"{dataset}.{entity_id}."
+    ids: list[str] = []
+    properties = data.get("properties")
+    if isinstance(properties, dict):
+        for name, values in properties.items():
+            prop = schema.properties.get(name)
+            if prop is None or prop.stub:
+                continue
+            if type(values) is not list:
+                values = string_list(values)
+            else:
+                for value in values:
+                    if type(value) is not str:
+                        values = string_list(values)
+                        break
+            for value in dict.fromkeys(values):
+                if not value:
+                    continue
+                key = f"{prefix}{name}.{value}"
+                id_ = sha1(key.encode(HASH_ENCODING)).hexdigest()
+                ids.append(id_)
+                yield Statement(
+                    entity_id=entity_id,
+                    prop=name,
+                    schema=schema_name,
+                    value=value,
+                    dataset=dataset,
+                    id=id_,
+                    last_seen=last_seen,
+                    origin=origin,
+                )
+    digest = sha1(schema.name.encode(HASH_ENCODING))
+    for id_ in sorted(ids):
+        digest.update(id_.encode(HASH_ENCODING))
+    yield Statement(
+        entity_id=entity_id,
+        prop=BASE_ID,
+        schema=schema.name,
+        value=digest.hexdigest(),
+        dataset=dataset,
+        first_seen=data.get("last_change"),
+        last_seen=last_seen,
+        origin=origin,
+    )
+
+
+_worker_dataset: Fragments | None = None
+
+
+def _init_worker(database_uri: str, name: str, origin: str) -> None:
+    global _worker_dataset
+    from ftmq.store.fragments.store import Store
+
+    _worker_dataset = Fragments(Store(database_uri), name, origin=origin)
+
+
+def _iterate_batch(
+    entity_ids: list[str], skip_errors: bool, filters: dict
+) -> list[dict]:
+    assert _worker_dataset is not None
+    entities = _worker_dataset.iterate(
+        entity_id=entity_ids, skip_errors=skip_errors, **filters
+    )
+    return [e.to_dict() for e in entities]
+
+
+def _load_entities(data: list[dict]) -> EntityFragments:
+    for item in data:
+        yield EntityProxy.from_dict(item, cleaned=True)
@@ -1,10 +1,15 @@
 import logging
+import queue
 import random
+import sqlite3
+import threading
 import time
 from datetime import datetime
 
 from normality import stringify
+from sqlalchemy import Boolean
 from sqlalchemy.dialects.postgresql import insert as upsert
+from sqlalchemy.dialects.sqlite import insert as sqlite_upsert
 from sqlalchemy.exc import (
     DatabaseError,
     DisconnectionError,
@@ -13,7 +18,10 @@ from sqlalchemy.exc import (
     ResourceClosedError,
     TimeoutError,
 )
-from sqlalchemy.sql.expression import insert, update
+from sqlalchemy.sql.expression import insert, literal_column, update
+
+from ftmq.store.fragments.utils import StoreException
+from ftmq.store.postgres import can_copy, copy_upsert
 
 # We have to cast null fragment values to some text to make the
 # UniqueConstraint work
@@ -37,17 +45,40 @@ except ImportError:
     except ImportError:
         pass
 
+# INSERT ... ON CONFLICT DO UPDATE ... RETURNING
+SQLITE_UPSERT = sqlite3.sqlite_version_info >= (3, 35, 0)
+
 log = logging.getLogger(__name__)
 
 
 class BulkLoader(object):
-    def __init__(self, dataset, size):
+    """
+    Buffer fragments and write them in batches of `size`.
+
+    With `background`, full buffers are handed to a queue of at most
+    `queue_size` batches and written by a background thread, so that the
+    caller can go on while the database is busy (`put` blocks when the queue
+    is full). After a write error, the batches still queued are discarded and
+    `put` refuses new fragments by raising that error; `flush`, which waits
+    until all queued batches are handled, then raises a `StoreException` with
+    the number of fragments that were not stored and resets the loader.
+    """
+
+    def __init__(self, dataset, size, copy=False, background=False, queue_size=2):
         self.dataset = dataset
         self.store = dataset.store
         self.size = size
+        self.copy = copy
+        self.background = background
         self.buffer = {}
+        self._queue: queue.Queue[dict | None] = queue.Queue(queue_size)
+        self._thread: threading.Thread | None = None
+        self._error: Exception | None = None
+        self._dropped = 0
 
     def put(self, entity, fragment=None, origin=None):
+        if self._error is not None:
+            raise self._error
         origin = origin or self.dataset.origin
         fragment = stringify(fragment) or DEFAULT_FRAGMENT
         if hasattr(entity, "to_dict"):
@@ -58,19 +89,28 @@ class BulkLoader(object):
         if id_:
             self.buffer[(id_, origin, fragment)] = entity
             if len(self.buffer) >= self.size:
-                self.flush()
+                if self.background:
+                    self._submit()
+                else:
+                    self.flush()
         else:
             log.warning("Entity has no ID!")
 
+    # The write methods return the (id, origin) of the newly inserted
+    # fragments for the stats, updates of existing fragments don't count.
+
     def _store_values(self, conn, values):
         table = self.dataset.table
         try:
             conn.execute(insert(table).values(values))
+            return [(v["id"], v["origin"]) for v in values]
         except IntegrityError:
             changing = (
                 "entity",
                 "timestamp",
             )
+            if self.dataset.has_schema_column:
+                changing = (*changing, "schema")
             for value in values:
                 stmt = update(table)
                 changed = {c: value.get(c, {}) for c in changing}
@@ -80,46 +120,151 @@ class BulkLoader(object):
                 stmt = stmt.where(table.c.fragment == value["fragment"])
                 stmt = stmt.where(table.c.timestamp < value["timestamp"])
                 conn.execute(stmt)
+            return []
+
+    def _get_updates(self, istmt):
+        updates = dict(
+            entity=istmt.excluded.entity,
+            timestamp=istmt.excluded.timestamp,
+        )
+        if self.dataset.has_schema_column:
+            updates["schema"] = istmt.excluded.schema
+        return updates
 
     def _upsert_values(self, conn, values):
         """Use postgres' upsert mechanism (ON CONFLICT TO UPDATE)."""
-        istmt = upsert(self.dataset.table).values(values)
+        table = self.dataset.table
+        istmt = upsert(table).values(values)
         stmt = istmt.on_conflict_do_update(
             index_elements=["id", "origin", "fragment"],
-            set_=dict(
-                entity=istmt.excluded.entity,
-                timestamp=istmt.excluded.timestamp,
-            ),
+            set_=self._get_updates(istmt),
+        )
+        # `xmax` is 0 for rows that were inserted instead of updated
+        is_new = literal_column("xmax = 0", Boolean)
+        res = conn.execute(stmt.returning(table.c.id, table.c.origin, is_new))
+        return [(id_, origin) for id_, origin, inserted in res if inserted]
+
+    def _copy_values(self, conn, values):
+        """Use postgres' COPY into a staging table, merged with the same
+        upsert semantics as `_upsert_values`."""
+        columns = [c.name for c in self.dataset.table.columns]
+        return copy_upsert(
+            conn,
+            self.dataset.table,
+            ([value[c] for c in columns] for value in values),
+            index_elements=["id", "origin", "fragment"],
+            update=[c for c in columns if c in ("entity", "timestamp", "schema")],
+            returning=["id", "origin"],
         )
-        conn.execute(stmt)
+
+    def _upsert_values_sqlite(self, conn, values):
+        """Use sqlite's upsert mechanism (ON CONFLICT DO UPDATE), only
+        updating fragments older than the new ones. The new fragments are
+        inserted first, as sqlite doesn't tell inserts and updates apart."""
+        table = self.dataset.table
+        keys = (table.c.id, table.c.origin, table.c.fragment)
+        stmt = sqlite_upsert(table).values(values).on_conflict_do_nothing()
+        inserted = {tuple(row) for row in conn.execute(stmt.returning(*keys))}
+        existing = [
+            v for v in values if (v["id"], v["origin"], v["fragment"]) not in inserted
+        ]
+        if existing:
+            istmt = sqlite_upsert(table).values(existing)
+            stmt = istmt.on_conflict_do_update(
+                index_elements=["id", "origin", "fragment"],
+                set_=self._get_updates(istmt),
+                where=table.c.timestamp < istmt.excluded.timestamp,
+            )
+            conn.execute(stmt)
+        return [(id_, origin) for id_, origin, _ in inserted]
 
     def flush(self):
-        if not len(self.buffer):
+        if not self.background:
+            self._flush(self.buffer)
+            return
+        if len(self.buffer):
+            if self._error is None:
+                self._submit()
+            else:
+                self._dropped += len(self.buffer)
+                self.buffer = {}
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, dropped = self._error, self._dropped
+            self._error, self._dropped = None, 0
+            raise StoreException(
+                "Could not store %d fragments of `%s`: %s"
+                % (dropped, self.dataset.name, error)
+            ) from error
+
+    def _submit(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._work, name="fragments-bulk", daemon=True
+            )
+            self._thread.start()
+        self._queue.put(self.buffer)  # blocks if the writer is behind
+        self.buffer = {}
+
+    def _work(self):
+        while True:
+            buffer = self._queue.get()
+            if buffer is None:
+                return
+            if self._error is not None:
+                self._dropped += len(buffer)  # discard queued batches
+                continue
+            try:
+                self._flush(buffer)
+                if len(buffer):
+                    raise StoreException(
+                        "Could not store %d fragments of `%s`"
+                        % (len(buffer), self.dataset.name)
+                    )
+            except Exception as e:
+                self._dropped += len(buffer)
+                self._error = e
+
+    def _flush(self, buffer):
+        if not len(buffer):
             return
         values = []
         now = datetime.utcnow()
-        for (id_, origin, fragment), entity in sorted(self.buffer.items()):
-            values.append(
-                {
-                    "id": id_,
-                    "origin": origin,
-                    "fragment": fragment,
-                    "timestamp": now,
-                    "entity": entity,
-                }
-            )
+        schema_column = self.dataset.has_schema_column
+        for (id_, origin, fragment), entity in sorted(buffer.items()):
+            value = {
+                "id": id_,
+                "origin": origin,
+                "fragment": fragment,
+                "timestamp": now,
+                "entity": self.dataset.encode_entity(entity),
+            }
+            if schema_column:
+                value["schema"] = entity.get("schema")
+            values.append(value)
 
+        origins = {v["origin"] for v in values}
+        _ = self.store.stats
         for attempt in range(10):
             conn = self.store.engine.connect()
             tx = conn.begin()
             try:
-                if self.store.is_postgres:
-                    self._upsert_values(conn, values)
+                inserted: list[tuple[str, str]]
+                if self.copy and can_copy(conn):
+                    inserted = self._copy_values(conn, values)
+                elif self.store.is_postgres:
+                    inserted = self._upsert_values(conn, values)
+                elif self.store.is_sqlite and SQLITE_UPSERT:
+                    inserted = self._upsert_values_sqlite(conn, values)
                 else:
-                    self._store_values(conn, values)
+                    inserted = self._store_values(conn, values)
+                self.dataset._update_stats(conn, inserted, origins, now)
                 tx.commit()
                 conn.close()
-                self.buffer = {}
+                buffer.clear()
                 return
             except EXCEPTIONS:
                 tx.rollback()
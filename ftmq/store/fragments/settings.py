@@ -8,3 +8,4 @@ class Settings(BaseSettings):
     database_uri: str = Field(
         default="sqlite:///ftm_fragments.db", alias="ftm_fragments_uri"
     )
+    encoding: str = Field(default="json", alias="ftm_fragments_encoding")
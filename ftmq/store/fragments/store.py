@@ -1,8 +1,31 @@
-from sqlalchemy import MetaData, create_engine
+from datetime import datetime
+from typing import Any, Generator
+
+from sqlalchemy import (
+    Column,
+    Connection,
+    DateTime,
+    Integer,
+    LargeBinary,
+    MetaData,
+    String,
+    Table,
+    create_engine,
+    delete,
+    func,
+    insert,
+    select,
+    update,
+)
 from sqlalchemy import inspect as sqlalchemy_inspect
 
 from ftmq.store.fragments.dataset import Fragments
-from ftmq.store.fragments.utils import NULL_ORIGIN
+from ftmq.store.fragments.utils import (
+    ALL_ORIGINS,
+    ENCODING_JSON,
+    ENCODINGS,
+    NULL_ORIGIN,
+)
 
 
 class Store(object):
@@ -10,6 +33,8 @@ class Store(object):
     FtM-store datasets."""
 
     PREFIX = "ftm"
+    DICTS_TABLE = "ftmq_zstd_dicts"  # not matching `PREFIX`
+    STATS_TABLE = "ftmq_fragments_stats"
 
     def _adjust_psycopg3_uri(self, database_uri: str) -> str:
         """Adjust PostgreSQL URI to use psycopg3 dialect if psycopg is available."""
@@ -34,9 +59,16 @@ class Store(object):
     def __init__(
         self,
         database_uri: str,
+        encoding: str = ENCODING_JSON,
         **config,
     ):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Invalid encoding: `{encoding}`")
         self.database_uri = self._adjust_psycopg3_uri(database_uri)
+        # storage format for new tables, existing tables keep theirs
+        self.encoding = encoding
+        self._dicts: Table | None = None
+        self._stats: Table | None = None
 
         # Configure connection pooling for psycopg3
         config.setdefault("pool_size", 1)
@@ -48,12 +80,141 @@ class Store(object):
 
         self.engine = create_engine(self.database_uri, future=True, **config)
         self.is_postgres = self.engine.dialect.name == "postgresql"
+        self.is_sqlite = self.engine.dialect.name == "sqlite"
         self.meta = MetaData()
 
+    @property
+    def dicts(self) -> Table:
+        """The zstd dictionaries per fragments table"""
+        if self._dicts is None:
+            self._dicts = Table(
+                self.DICTS_TABLE,
+                self.meta,
+                Column("table", String, primary_key=True),
+                Column("dict", LargeBinary, nullable=False),
+                extend_existing=True,
+            )
+            self._dicts.create(bind=self.engine, checkfirst=True)
+        return self._dicts
+
+    def get_zstd_dict(self, table_name: str) -> bytes | None:
+        q = select(self.dicts.c.dict).where(self.dicts.c.table == table_name)
+        with self.engine.connect() as conn:
+            return conn.execute(q).scalar()
+
+    def put_zstd_dict(
+        self, table_name: str, data: bytes | None, conn: Connection
+    ) -> None:
+        conn.execute(delete(self.dicts).where(self.dicts.c.table == table_name))
+        if data is not None:
+            conn.execute(insert(self.dicts).values(table=table_name, dict=data))
+
+    @property
+    def stats(self) -> Table:
+        """Entity and fragment counts and the last write per dataset and
+        origin (plus the dataset totals with origin `ALL_ORIGINS`), maintained
+        by the writes of the datasets. Built from the existing fragments
+        tables when created."""
+        if self._stats is None:
+            stats = Table(
+                self.STATS_TABLE,
+                self.meta,
+                Column("dataset", String, primary_key=True),
+                Column("origin", String, primary_key=True),
+                Column("entities", Integer, nullable=False, default=0),
+                Column("fragments", Integer, nullable=False, default=0),
+                Column("last_write", DateTime, nullable=True),
+                extend_existing=True,
+            )
+            exists = sqlalchemy_inspect(self.engine).has_table(self.STATS_TABLE)
+            stats.create(bind=self.engine, checkfirst=True)
+            self._stats = stats
+            if not exists:
+                self.rebuild_stats()
+        return self._stats
+
+    def get_stats(self, name: str) -> dict[str, dict[str, Any]]:
+        """Get the stats of a dataset per origin"""
+        q = select(self.stats).where(self.stats.c.dataset == name)
+        with self.engine.connect() as conn:
+            return {
+                row.origin: {
+                    "entities": row.entities,
+                    "fragments": row.fragments,
+                    "last_write": row.last_write,
+                }
+                for row in conn.execute(q)
+            }
+
+    def init_stats(self, name: str) -> None:
+        """Start the stats of a new (empty) dataset"""
+        stats = self.stats
+        q = select(stats.c.dataset).where(
+            stats.c.dataset == name, stats.c.origin == ALL_ORIGINS
+        )
+        with self.engine.begin() as conn:
+            if conn.execute(q).first() is None:
+                conn.execute(insert(stats).values(dataset=name, origin=ALL_ORIGINS))
+
+    def update_stats(
+        self,
+        conn: Connection,
+        name: str,
+        deltas: dict[str, tuple[int, int]],
+        timestamp: datetime,
+    ) -> None:
+        """Add the changes of entity and fragment counts per origin of a write.
+        Datasets without stats (written by an older version) are left to
+        `rebuild_stats`."""
+        stats = self.stats
+        for origin in sorted(deltas, key=lambda o: o != ALL_ORIGINS):
+            entities, fragments = deltas[origin]
+            res = conn.execute(
+                update(stats)
+                .where(stats.c.dataset == name, stats.c.origin == origin)
+                .values(
+                    entities=stats.c.entities + entities,
+                    fragments=stats.c.fragments + fragments,
+                    last_write=timestamp,
+                )
+            )
+            if res.rowcount:
+                continue
+            if origin == ALL_ORIGINS:
+                return
+            conn.execute(
+                insert(stats).values(
+                    dataset=name,
+                    origin=origin,
+                    entities=entities,
+                    fragments=fragments,
+                    last_write=timestamp,
+                )
+            )
+
+    def rebuild_stats(self, name: str | None = None) -> int:
+        """Rebuild the stats of the given or all datasets by counting their
+        fragments tables. Tables without stats (created by an older version)
+        are registered.
+
+        Returns:
+            Number of datasets
+        """
+        if name is not None:
+            self.get(name).rebuild_stats()
+            return 1
+        datasets = list(self._get_tables())
+        for dataset in datasets:
+            dataset.rebuild_stats()
+        names = [d.name for d in datasets]
+        with self.engine.begin() as conn:
+            conn.execute(delete(self.stats).where(self.stats.c.dataset.not_in(names)))
+        return len(datasets)
+
     def get(self, name, origin=NULL_ORIGIN):
         return Fragments(self, name, origin=origin)
 
-    def all(self, origin=NULL_ORIGIN):
+    def _get_tables(self, origin=NULL_ORIGIN):
         prefix = f"{self.PREFIX}_"
         inspect = sqlalchemy_inspect(self.engine)
         for table in inspect.get_table_names():
@@ -61,11 +222,30 @@ class Store(object):
                 name = table[len(prefix) :]
                 yield Fragments(self, name, origin=origin)
 
+    def all(self, origin: str = NULL_ORIGIN) -> Generator[Fragments, None, None]:
+        """Iterate the datasets with stats. Tables of an older version are
+        registered by `rebuild_stats`."""
+        stats = self.stats
+        q = (
+            select(stats.c.dataset)
+            .where(stats.c.origin == ALL_ORIGINS)
+            .order_by(stats.c.dataset)
+        )
+        with self.engine.connect() as conn:
+            names = [r.dataset for r in conn.execute(q)]
+        for name in names:
+            yield Fragments(self, name, origin=origin)
+
     def close(self):
         self.engine.dispose()
+        self._dicts = None
+        self._stats = None
 
     def __len__(self):
-        return len(list(self.all()))
+        stats = self.stats
+        q = select(func.count()).where(stats.c.origin == ALL_ORIGINS)
+        with self.engine.connect() as conn:
+            return conn.execute(q).scalar_one()
 
     def __repr__(self):
         return "<Store(%r)>" % self.engine
@@ -2,10 +2,26 @@ import json
 import logging
 from hashlib import sha1
 from itertools import count
+from typing import Any, Iterable
 
+import orjson
 from normality import stringify
 
+try:
+    from compression import zstd  # type: ignore[import-not-found]  # python >= 3.14
+except ImportError:
+    try:
+        from backports import zstd
+    except ImportError:
+        zstd = None
+
 NULL_ORIGIN = "null"
+ALL_ORIGINS = "*"  # dataset totals in the stats table
+ENCODING_JSON = "json"
+ENCODING_ZSTD = "zstd"  # orjson compressed with zstd, optional dictionary
+ENCODINGS = (ENCODING_JSON, ENCODING_ZSTD)
+ZSTD_LEVEL = 3
+ZSTD_DICT_SIZE = 112_640
 
 log = logging.getLogger("ftmq.store.fragments")
 
@@ -14,6 +30,49 @@ class StoreException(Exception):
     pass
 
 
+class Codec:
+    """Encode fragment data for the `zstd` storage format: orjson bytes
+    compressed with zstd, using a trained dictionary if available."""
+
+    def __init__(self, zstd_dict: bytes | None = None) -> None:
+        if zstd is None:
+            raise ImportError(
+                "Install `backports.zstd` (python < 3.14) for the zstd encoding"
+            )
+        self.zstd_dict = zstd.ZstdDict(zstd_dict) if zstd_dict else None
+        self.compressor = zstd.ZstdCompressor(ZSTD_LEVEL, zstd_dict=self.zstd_dict)
+
+    def encode(self, data: dict[str, Any]) -> bytes:
+        frame: bytes = self.compressor.compress(
+            orjson.dumps(data), zstd.ZstdCompressor.FLUSH_FRAME
+        )
+        return frame
+
+    def decode(self, data: bytes) -> dict[str, Any]:
+        zstd_dict = self.zstd_dict
+        if zstd_dict is not None:
+            # frames written before the dictionary was trained
+            if zstd.get_frame_info(data).dictionary_id != zstd_dict.dict_id:
+                zstd_dict = None
+        value: dict[str, Any] = orjson.loads(
+            zstd.decompress(data, zstd_dict=zstd_dict)
+        )
+        return value
+
+
+def train_zstd_dict(samples: Iterable[dict[str, Any]]) -> bytes | None:
+    """Train a zstd dictionary from sample fragment data, `None` if there are
+    not enough samples"""
+    if zstd is None:
+        return None
+    try:
+        data = [orjson.dumps(s) for s in samples]
+        content: bytes = zstd.train_dict(data, ZSTD_DICT_SIZE).dict_content
+        return content
+    except zstd.ZstdError:
+        return None
+
+
 def safe_fragment(fragment):
     """Make a hashed fragment."""
     fragment = stringify(fragment)
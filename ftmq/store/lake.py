@@ -18,20 +18,28 @@ Layout:
     ```
 """
 
-from contextlib import contextmanager
+import base64
+import hashlib
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from functools import cache, cached_property
 from pathlib import Path
-from typing import Any, Callable, Generator, Iterator, cast
-from urllib.parse import urlparse
+from typing import Any, Callable, Generator, Iterable, Iterator, cast
+from urllib.parse import unquote, urlparse
 
 import duckdb
 import pyarrow as pa
 import pyarrow.compute as pc
 from anystore.interface.lock import Lock
 from anystore.logging import get_logger
+from anystore.model import BaseModel
 from anystore.store import Store as FSStore
-from anystore.types import SDict
-from anystore.util import clean_dict
+from anystore.types import SDict, Uri
+from anystore.util import clean_dict, make_data_checksum
+from banal import ensure_list
 from deltalake import (
     BloomFilterProperties,
     ColumnProperties,
@@ -41,23 +49,32 @@ from deltalake import (
 )
 from deltalake._internal import TableNotFoundError
 from deltalake.table import FilterConjunctionType
-from followthemoney import EntityProxy, StatementEntity, model
+from followthemoney import EntityProxy, StatementEntity, model, registry
 from followthemoney.dataset.dataset import Dataset
 from followthemoney.statement import Statement, StatementDict
 from nomenklatura import settings as nks
 from nomenklatura import store as nk
 from nomenklatura.db import get_metadata
-from pydantic import AliasChoices, Field
+from pydantic import AliasChoices, Field, PrivateAttr
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from rigour.time import datetime_iso
 from sqlalchemy import Boolean, DateTime, column, select, table
 from sqlalchemy.sql import Select
 from sqlalchemy.sql.elements import ColumnElement
 
+from ftmq.enums import Comparators
+from ftmq.filters import CanonicalIdFilter, F
+from ftmq.model.stats import DatasetStats
 from ftmq.query import Query
 from ftmq.store.base import DEFAULT_ORIGIN, Store
 from ftmq.store.sql import SQLQueryView, SQLStore
 from ftmq.types import StatementEntities
-from ftmq.util import apply_dataset, ensure_entity, get_scope_dataset
+from ftmq.util import (
+    apply_dataset,
+    ensure_dataset,
+    ensure_entity,
+    get_scope_dataset,
+)
 
 log = get_logger(__name__)
 
@@ -69,6 +86,28 @@ BUCKET_PAGE = "page"  # abstract schema
 BUCKET_DOCUMENT = "document"
 BUCKET_INTERVAL = "interval"
 BUCKET_THING = "thing"
+REFRESH_INTERVAL = 5  # seconds until the cached table handle gets updated
+STATS_PREFIX = "_ftmq_stats"  # precomputed statistics per dataset partition
+INDEX_KEY = "_ftmq_index/filters.json"  # canonical id point lookup index
+INDEX_BITS = 10  # filter bits per canonical id, about 1% false positives
+INDEX_HASHES = 7  # filter bits set per canonical id
+EXPORT_COLUMNS = (  # long export layout, see `ftmq.arrow.STATEMENT_SCHEMA`
+    "id",
+    "entity_id",
+    "canonical_id",
+    "schema",
+    "prop",
+    "prop_type",
+    "value",
+    "original_value",
+    "lang",
+    "dataset",
+    "origin",
+    "external",
+    "first_seen",
+    "last_seen",
+)
+TIMESTAMPS = ("first_seen", "last_seen")
 _STATS_BLOOM = ColumnProperties(
     bloom_filter_properties=BloomFilterProperties(
         set_bloom_filter_enabled=True, fpp=0.01
@@ -81,7 +120,7 @@ _STATS_NO_DICT = ColumnProperties(statistics_enabled="CHUNK", dictionary_enabled
 
 _COMMON_COLUMNS = {
     "id": _STATS,
-    "canonical_id": _STATS,
+    "canonical_id": _STATS_BLOOM,  # point lookups
     "entity_id": _STATS,
     "schema": _STATS,
     "prop": _STATS_BLOOM,
@@ -141,6 +180,14 @@ ARROW_SCHEMA = pa.schema(
     [(col.name, SA_TO_ARROW.get(type(col.type), pa.string())) for col in TABLE.columns]
 )
 
+SA_TO_DUCKDB: dict[type, str] = {Boolean: "BOOLEAN", DateTime: "TIMESTAMP"}
+
+# statement view without any lake: no rows, but the columns of the table
+EMPTY_VIEW_SQL = "SELECT %s WHERE false" % ", ".join(
+    f'CAST(NULL AS {SA_TO_DUCKDB.get(type(col.type), "VARCHAR")}) AS "{col.name}"'
+    for col in TABLE.columns
+)
+
 
 class LakeStatement(Statement):
     """A :class:`followthemoney.statement.Statement` extended with the lake
@@ -232,6 +279,94 @@ class StorageSettings(BaseSettings):
 storage_settings = StorageSettings()
 
 
+class DuckDBSettings(BaseSettings):
+    """Resource settings for the DuckDB connection of a `LakeStore`, unset
+    values use the DuckDB defaults. Env vars are prefixed `FTMQ_DUCKDB_`."""
+
+    model_config = SettingsConfigDict(
+        env_prefix="ftmq_duckdb_", env_file=".env", extra="ignore"
+    )
+
+    threads: int | None = None
+    memory_limit: str | None = None  # e.g. "4GB"
+    temp_directory: str | None = None  # for spilling larger-than-memory queries
+    enable_object_cache: bool = True  # cache parquet metadata across queries
+    max_cursors: int = 8  # size of the cursor pool
+
+    def to_config(self) -> dict[str, str]:
+        config = {
+            "threads": self.threads,
+            "memory_limit": self.memory_limit,
+            "temp_directory": self.temp_directory,
+            "enable_object_cache": self.enable_object_cache,
+        }
+        return {k: str(v).lower() for k, v in config.items() if v is not None}
+
+
+class CursorPool:
+    """A bounded pool of reusable cursors on a DuckDB connection.
+
+    At most `size` threads use cursors at the same time, further callers
+    block until one is returned. Nested use within a thread that already
+    holds a cursor (e.g. a point lookup while streaming a query) gets another
+    cursor without waiting, so it can't deadlock on the pool. Cursors are
+    returned to the pool after use unless the query failed.
+    """
+
+    def __init__(self, con: duckdb.DuckDBPyConnection, size: int) -> None:
+        self.con = con
+        self.size = size
+        self._idle: queue.LifoQueue[duckdb.DuckDBPyConnection] = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._depth: dict[int, int] = {}  # cursors in use by thread id
+        self._lock = threading.Lock()
+
+    def _enter(self, ident: int) -> bool:
+        with self._lock:
+            depth = self._depth.get(ident, 0)
+            self._depth[ident] = depth + 1
+        return depth > 0
+
+    def _exit(self, ident: int) -> None:
+        with self._lock:
+            depth = self._depth.pop(ident) - 1
+            if depth:
+                self._depth[ident] = depth
+
+    def _release(self, cur: duckdb.DuckDBPyConnection) -> None:
+        if self._idle.qsize() < self.size:
+            self._idle.put(cur)
+        else:
+            cur.close()
+
+    @contextmanager
+    def cursor(self) -> Iterator[duckdb.DuckDBPyConnection]:
+        # remember the thread, a streaming consumer may close us elsewhere
+        ident = threading.get_ident()
+        nested = self._enter(ident)
+        try:
+            with nullcontext() if nested else self._slots:
+                try:
+                    cur = self._idle.get_nowait()
+                except queue.Empty:
+                    cur = self.con.cursor()
+                try:
+                    yield cur
+                except GeneratorExit:  # a consumer stopped streaming early
+                    self._release(cur)
+                    raise
+                except BaseException:
+                    cur.close()
+                    raise
+                self._release(cur)
+        finally:
+            self._exit(ident)
+
+    def close(self) -> None:
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+
+
 @cache
 def storage_options() -> SDict:
     return clean_dict(
@@ -282,6 +417,11 @@ def pack_statement(stmt: Statement, source: str | None = None) -> SDict:
     return data
 
 
+def sql_literal(value: str) -> str:
+    """Quote a string for a deltalake (datafusion) SQL predicate"""
+    return "'%s'" % value.replace("'", "''")
+
+
 ViewSqlBuilder = Callable[[DeltaTable], str]
 """Returns the SELECT body for a view registered on the LakeStore
 connection. The body will be wrapped as ``CREATE OR REPLACE VIEW <name>
@@ -310,18 +450,95 @@ class Row:
 
     Wraps a dict of column → value with both attribute and index access
     so downstream code (built around sqlalchemy ``Row`` objects) keeps
-    working unchanged.
+    working unchanged. Rows of one result share their column index, the
+    values are a plain tuple.
     """
 
+    __slots__ = ("_fields", "_values")
+
     def __init__(self, data: SDict) -> None:
-        for key, value in data.items():
-            setattr(self, key, value)
+        self._fields = {key: ix for ix, key in enumerate(data)}
+        self._values = tuple(data.values())
 
-    def __iter__(self) -> Generator[Any, None, None]:
-        yield from self.__dict__.values()
+    @classmethod
+    def from_values(cls, fields: dict[str, int], values: tuple[Any, ...]) -> "Row":
+        row = cls.__new__(cls)
+        row._fields = fields
+        row._values = values
+        return row
+
+    def __getattr__(self, name: str) -> Any:
+        try:
+            return self._values[self._fields[name]]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._values)
 
     def __getitem__(self, i: int) -> Any:
-        return list(self.__iter__())[i]
+        return self._values[i]
+
+
+def _iso_column(column: pa.Array | pa.ChunkedArray) -> list[str | None]:
+    """Render a timestamp column the way ``Statement.from_db_row`` does"""
+    if pa.types.is_timestamp(column.type) and column.type.tz is None:
+        # arrow's `%S` includes the fractional seconds of the column unit
+        column = column.cast(pa.timestamp("s"), safe=False)
+        return pc.strftime(column, "%Y-%m-%dT%H:%M:%S").to_pylist()
+    return [datetime_iso(v) for v in column.to_pylist()]
+
+
+def statements_from_batch(
+    batch: pa.RecordBatch,
+) -> Generator[LakeStatement, None, None]:
+    """Build :class:`LakeStatement` objects straight from a columnar batch of
+    statement rows, without an intermediate row object per statement."""
+    names = batch.schema.names
+    empty = [None] * batch.num_rows
+
+    def col(name: str) -> list[Any]:
+        if name in names:
+            return batch.column(name).to_pylist()
+        return empty
+
+    def iso(name: str) -> list[Any]:
+        if name in names:
+            return _iso_column(batch.column(name))
+        return empty
+
+    for values in zip(
+        col("id"),
+        col("canonical_id"),
+        col("entity_id"),
+        col("prop"),
+        col("schema"),
+        col("value"),
+        col("dataset"),
+        col("lang"),
+        col("original_value"),
+        iso("first_seen"),
+        col("external"),
+        iso("last_seen"),
+        col("origin"),
+        col("fragment"),
+    ):
+        yield LakeStatement(
+            id=values[0],
+            canonical_id=values[1],
+            entity_id=values[2],
+            prop=values[3],
+            schema=values[4],
+            value=values[5],
+            dataset=values[6],
+            lang=values[7],
+            original_value=values[8],
+            first_seen=values[9],
+            external=values[10],
+            last_seen=values[11],
+            origin=values[12],
+            fragment=values[13],
+        )
 
 
 def ensure_schema_buckets(q: Query) -> Select:
@@ -333,16 +550,343 @@ def ensure_schema_buckets(q: Query) -> Select:
     return q.sql.statements.where(TABLE.c.bucket.in_(buckets))
 
 
+PRUNE_COMPARATORS = (Comparators["eq"], Comparators["in"])
+
+
+class PruningMetrics(BaseModel):
+    """Data files of the current Delta version a query has to read"""
+
+    files_considered: int = 0
+    files_scanned: int = 0
+
+
+def get_filter_values(filters: Iterable[F]) -> set[str] | None:
+    """Get the exact values a set of (OR-ed) query filters restricts their
+    column to, or `None` if any of them can't be expressed as an `IN` list"""
+    values: set[str] = set()
+    for f in filters:
+        if f.comparator not in PRUNE_COMPARATORS:
+            return None
+        values.update(ensure_list(f.value))
+    return values or None
+
+
+def get_partition_values(
+    q: Query, partition_by: Iterable[str] = PARTITION_BY
+) -> dict[str, set[str]]:
+    """Get the partition values a query is restricted to, per partition column"""
+    partitions: dict[str, set[str]] = {}
+    if q.schemata_names:
+        partitions["bucket"] = {get_schema_bucket(s) for s in q.schemata_names}
+    for key, filters in (("dataset", q.datasets), ("origin", q.origins)):
+        if key in partition_by:
+            values = get_filter_values(filters)
+            if values is not None:
+                partitions[key] = values
+    return partitions
+
+
+def get_canonical_ids(q: Query) -> set[str] | None:
+    """Get the canonical ids of a point lookup query"""
+    if q.ids and all(isinstance(f, CanonicalIdFilter) for f in q.ids):
+        return get_filter_values(q.ids)
+    return None
+
+
+def ensure_partition_filters(
+    q: Query, partition_by: Iterable[str] = PARTITION_BY
+) -> Select:
+    """Add the partition and canonical id restrictions of a query as top-level
+    `IN` predicates to its statements query.
+
+    The query's own clause can end up in a sub-query (for property filters,
+    reverse lookups or slicing) where DuckDB can't push it down into
+    `delta_scan`. Top-level predicates on partition columns let the scan skip
+    whole partitions, and a canonical id list is checked against the parquet
+    statistics and bloom filters of the remaining files.
+    """
+    sql = ensure_schema_buckets(q)
+    partitions = get_partition_values(q, partition_by)
+    for key in ("dataset", "origin"):
+        if key in partitions:
+            sql = sql.where(TABLE.c[key].in_(sorted(partitions[key])))
+    canonical_ids = get_canonical_ids(q)
+    if canonical_ids:
+        sql = sql.where(TABLE.c.canonical_id.in_(sorted(canonical_ids)))
+    return sql
+
+
+class StatsSidecar(BaseModel):
+    """Precomputed statistics of a dataset partition at a Delta version.
+
+    They are valid as long as the partition consists of the same data files,
+    tracked via a checksum of the file uris (`fingerprint`).
+    """
+
+    dataset: str
+    version: int
+    fingerprint: str
+    stats: DatasetStats
+
+
+def get_stats_datasets(q: Query) -> set[str] | None:
+    """Get the datasets of a stats query that only filters by dataset, `None`
+    for any other query"""
+    if q.filters != q.datasets:
+        return None
+    return get_filter_values(q.datasets)
+
+
+def get_id_hashes(canonical_id: str) -> tuple[int, int]:
+    """Get the two base hashes of a canonical id for the point lookup index"""
+    digest = hashlib.blake2b(canonical_id.encode(), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+
+
+class IdFilter(BaseModel):
+    """Bloom filter of the canonical ids of a data file, sized to their number
+    (`INDEX_BITS` per id) so that it stays selective for large files"""
+
+    size: int  # number of bits
+    bits: str  # base64 encoded
+    _data: bytes | None = PrivateAttr(None)
+
+    @classmethod
+    def build(cls, hashes: list[tuple[int, int]]) -> "IdFilter":
+        size = max(64, len(hashes) * INDEX_BITS)
+        data = bytearray((size + 7) // 8)
+        for h1, h2 in hashes:
+            for ix in range(INDEX_HASHES):
+                pos = (h1 + ix * h2) % size
+                data[pos >> 3] |= 1 << (pos & 7)
+        return cls(size=size, bits=base64.b64encode(data).decode())
+
+    def contains(self, hashes: tuple[int, int]) -> bool:
+        if self._data is None:
+            self._data = base64.b64decode(self.bits)
+        h1, h2 = hashes
+        for ix in range(INDEX_HASHES):
+            pos = (h1 + ix * h2) % self.size
+            if not self._data[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class IdIndex(BaseModel):
+    """Point lookup index of the lake: a filter of the canonical ids occurring
+    in each data file (`IdFilter`) by file path relative to the table root.
+    This complements the min/max statistics of the files, which can't skip
+    files whose id ranges overlap (e.g. of separate appends).
+
+    Files of the table that are not in the index can't be skipped, files in
+    the index that are not in the table anymore are ignored, so an outdated
+    index is less selective but never wrong.
+    """
+
+    version: int
+    files: dict[str, IdFilter] = {}
+
+    def get_mask(self, paths: Iterable[str], canonical_ids: Iterable[str]) -> pa.Array:
+        """Get the files (of the given paths) that may contain any of the
+        canonical ids"""
+        hashes = [get_id_hashes(i) for i in canonical_ids]
+        mask: list[bool] = []
+        for path in paths:
+            filter_ = self.files.get(path)
+            mask.append(filter_ is None or any(map(filter_.contains, hashes)))
+        return pa.array(mask, pa.bool_())
+
+
+class CompactionPolicy(BaseModel):
+    """Thresholds for compacting a partition of the lake.
+
+    A partition is compacted if it has more than `max_files` data files or
+    more than `max_small_files` files below `small_file_size` bytes.
+    """
+
+    max_files: int = 100
+    small_file_size: int = 32 * 1024 * 1024  # 32 MB
+    max_small_files: int = 20
+
+    def check(self, files: int, small_files: int) -> bool:
+        return files > self.max_files or small_files > self.max_small_files
+
+
+class CompactionMetrics(BaseModel):
+    """Result of a compaction run"""
+
+    partitions_checked: int = 0
+    partitions_compacted: int = 0
+    files_removed: int = 0
+    files_added: int = 0
+    seconds: float = 0
+    lock_seconds: float = 0
+
+
+class LakeExportMetrics(BaseModel):
+    """Result of an export into the lake"""
+
+    batches: int = 0
+    entities: int = 0
+    statements: int = 0
+    seconds: float = 0
+    statements_per_second: float = 0
+
+
 class LakeQueryView(SQLQueryView):
+    store: "LakeStore"
+
+    def count(self, query: Query | None = None) -> int:
+        if query is not None:
+            for count in self.store._execute_column(query.sql.count):
+                return count
+        return 0
+
     def query(self, query: Query | None = None) -> StatementEntities:
         if query:
             query.table = self.store.table
             query = self.ensure_scoped_query(query)
-            sql = ensure_schema_buckets(query)
-            yield from self.store._iterate(sql)
+            sql = ensure_partition_filters(query, self.store._partition_by)
+            files: list[str] | None = None
+            canonical_ids = get_canonical_ids(query)
+            if canonical_ids and self.store.get_id_index() is not None:
+                files = self.store.get_lookup_files(
+                    get_partition_values(query, self.store._partition_by),
+                    canonical_ids,
+                )
+            yield from self.store._iterate(sql, files=files)
         else:
             yield from super().query(query)
 
+    def get_entities(self, ids: Iterable[str]) -> StatementEntities:
+        """Get the entities of the given canonical ids with one (indexed)
+        point lookup query"""
+        ids = sorted(set(ids))
+        if ids:
+            yield from self.query(Query().where(canonical_id__in=ids))
+
+    def get_entity(self, id: str) -> StatementEntity | None:
+        for proxy in self.get_entities([id]):
+            return proxy
+        return None
+
+    def get_adjacents(
+        self, proxies: Iterable[StatementEntity], inverted: bool | None = False
+    ) -> set[StatementEntity]:
+        """Get the adjacent entities of the given entities, the referenced ones
+        are fetched with one point lookup for all of them"""
+        proxies = list(proxies)
+        ids: set[str] = set()
+        for proxy in proxies:
+            for prop, value in proxy.itervalues():
+                if prop.type == registry.entity:
+                    ids.add(value)
+        adjacents = set(self.get_entities(ids))
+        if inverted:
+            for proxy in proxies:
+                if proxy.id is not None:
+                    for _, adjacent in self.get_inverted(proxy.id):
+                        adjacents.add(adjacent)
+        return adjacents
+
+    def stats(self, query: Query | None = None) -> DatasetStats:
+        """
+        Get the statistics for the given query. Queries for a single dataset
+        without other filters are answered from its precomputed sidecar if it
+        is up to date, anything else falls back to scanning the lake (entity
+        counts are distinct across datasets and can't be added up).
+        """
+        query = self.ensure_scoped_query(query or Query())
+        datasets = get_stats_datasets(query)
+        if datasets is not None and len(datasets) == 1:
+            sidecar = self.store.get_stats_sidecar(datasets.pop())
+            if sidecar is not None:
+                return sidecar.stats
+        return super().stats(query)
+
+    def _export_sql(self, query: Query | None = None) -> str:
+        """The statements of the query projected to the long export layout
+        (`ftmq.arrow.STATEMENT_SCHEMA`)"""
+        if query:
+            query = self.ensure_scoped_query(query)
+        else:  # like `query()`, which falls back to all entities of the view
+            query = Query()
+        query.table = self.store.table
+        inner = self.store._compile(
+            ensure_partition_filters(query, self.store._partition_by)
+        )
+        columns = ", ".join(
+            f"strftime({c}, '%Y-%m-%dT%H:%M:%S') AS {c}" if c in TIMESTAMPS else c
+            for c in EXPORT_COLUMNS
+        )
+        return f"SELECT {columns} FROM ({inner}) AS statements"
+
+    def to_arrow(
+        self,
+        query: Query | None = None,
+        schema: str | None = None,
+        batch_size: int = 10_000,
+    ) -> pa.RecordBatchReader:
+        """
+        Stream the (filtered) entities as arrow record batches. The statement
+        table is read straight from DuckDB, the wide table for a `schema` is
+        assembled from the entities.
+        """
+        if schema is not None:
+            return super().to_arrow(query, schema, batch_size)
+        from ftmq.arrow import STATEMENT_SCHEMA, iter_reader
+
+        def _batches() -> Generator[pa.RecordBatch, None, None]:
+            if not self.store.exists:
+                return
+            sql = self._export_sql(query)
+            with self.store.cursor() as cur:
+                yield from cur.execute(sql).to_arrow_reader(batch_size)
+
+        return iter_reader(STATEMENT_SCHEMA, _batches())
+
+    def to_parquet(
+        self, uri: Uri, query: Query | None = None, wide: bool = False
+    ) -> int:
+        """
+        Write the (filtered) entities to parquet. The statement table is
+        written by DuckDB (`COPY ... TO`) without passing through python, the
+        wide layout streams the entities.
+
+        Returns:
+            Number of written rows (statements, or entities for the wide layout)
+        """
+        if wide or not self.store.exists:
+            return super().to_parquet(uri, query, wide)
+        sql = self._export_sql(query)
+        with self.store.cursor() as cur:
+            res = cur.execute(
+                f"COPY ({sql}) TO {sql_literal(str(uri))} (FORMAT parquet)"
+            ).fetchone()
+        return res[0] if res else 0
+
+    def scan_stats(self, query: Query | None = None) -> DatasetStats:
+        """Compute the statistics for the given query from the lake"""
+        return super().stats(query)
+
+    def pruning(self, query: Query | None = None) -> PruningMetrics:
+        """
+        Get the number of data files considered versus actually scanned for
+        the given query after partition pruning and (for canonical id lookups)
+        min/max statistics skipping.
+
+        Args:
+            query: The Query filter object
+
+        Returns:
+            The metrics for the current Delta version
+        """
+        query = self.ensure_scoped_query(query or Query())
+        return self.store.get_pruning_metrics(
+            get_partition_values(query, self.store._partition_by),
+            get_canonical_ids(query),
+        )
+
 
 class LakeStore(SQLStore[LakeQueryView]):
     def __init__(self, *args, **kwargs) -> None:
@@ -356,6 +900,20 @@ class LakeStore(SQLStore[LakeQueryView]):
             nks.STATEMENT_TABLE: default_view_sql,
         }
         self._duckdb_config: dict[str, str] = kwargs.pop("duckdb_config", None) or {}
+        self._duckdb_settings: DuckDBSettings = (
+            kwargs.pop("duckdb_settings", None) or DuckDBSettings()
+        )
+        self._refresh_interval: float = kwargs.pop(
+            "refresh_interval", REFRESH_INTERVAL
+        )
+        self._deltatable: DeltaTable | None = None
+        self._deltatable_checked: float | None = None
+        self._deltatable_lock = threading.Lock()
+        self._stats_sidecars: bool = kwargs.pop("stats_sidecars", False)
+        self._compaction: CompactionPolicy | None = kwargs.pop("compaction", None)
+        self._id_index: bool = kwargs.pop("id_index", True)
+        self._id_index_cache: IdIndex | None = None
+        self._id_index_loaded: int | None = None  # table version at load time
         kwargs["uri"] = "sqlite:///:memory:"  # fake it till you make it
         get_metadata.cache_clear()
         super().__init__(*args, **kwargs)
@@ -363,17 +921,53 @@ class LakeStore(SQLStore[LakeQueryView]):
         self.uri = self._backend.uri
         setup_duckdb_storage()
 
+    def _get_deltatable(self) -> DeltaTable | None:
+        """Get the cached table handle, or `None` if the table doesn't exist.
+
+        The handle is loaded once and brought to the latest version via
+        `update_incremental` (which only reads the new log entries) when it
+        was invalidated or is older than `refresh_interval` seconds.
+        """
+        with self._deltatable_lock:
+            now = time.monotonic()
+            checked = self._deltatable_checked
+            if checked is not None and now - checked < self._refresh_interval:
+                return self._deltatable
+            if self._deltatable is None:
+                try:
+                    self._deltatable = DeltaTable(
+                        self.uri, storage_options=storage_options()
+                    )
+                except TableNotFoundError:
+                    pass
+            else:
+                self._deltatable.update_incremental()
+            self._deltatable_checked = now
+            return self._deltatable
+
+    def refresh(self) -> None:
+        """Mark the cached table handle as stale, e.g. after a write"""
+        with self._deltatable_lock:
+            self._deltatable_checked = None
+
     @property
     def deltatable(self) -> DeltaTable:
-        return DeltaTable(self.uri, storage_options=storage_options())
+        dt = self._get_deltatable()
+        if dt is None:
+            raise TableNotFoundError(f"No table at `{self.uri}`")
+        return dt
 
     @property
     def exists(self) -> bool:
-        try:
-            self.deltatable.version()
-            return True
-        except TableNotFoundError:
-            return False
+        return self._get_deltatable() is not None
+
+    @property
+    def version(self) -> int | None:
+        """The current table version, `None` if the table doesn't exist"""
+        dt = self._get_deltatable()
+        if dt is None:
+            return None
+        return dt.version()
 
     @cached_property
     def _duckdb(self) -> duckdb.DuckDBPyConnection:
@@ -392,34 +986,45 @@ class LakeStore(SQLStore[LakeQueryView]):
         The session timezone is forced to UTC – DuckDB otherwise renders
         TIMESTAMPTZ in the host timezone, leaking local-time datetimes to
         consumers. Set GLOBAL so :meth:`cursor` sessions inherit it.
+
+        Resource limits come from :class:`DuckDBSettings`, a raw
+        ``duckdb_config`` takes precedence.
         """
         config = {
             "autoinstall_known_extensions": "true",
             "autoload_known_extensions": "true",
+            **self._duckdb_settings.to_config(),
             **self._duckdb_config,
         }
         con = duckdb.connect(":memory:", config=config)
         # icu ships bundled with the duckdb wheel, so this works offline
         con.execute("LOAD icu; SET GLOBAL TimeZone='UTC'")
+        self._register_views(con)
+        return con
+
+    def _register_views(self, con: duckdb.DuckDBPyConnection) -> None:
         dt = self.deltatable
         for name, builder in self._view_sqls.items():
             con.sql(f"CREATE OR REPLACE VIEW {name} AS {builder(dt)}")
-        return con
+
+    @cached_property
+    def _cursors(self) -> CursorPool:
+        return CursorPool(self._duckdb, self._duckdb_settings.max_cursors)
 
     @contextmanager
     def cursor(self) -> Iterator[duckdb.DuckDBPyConnection]:
-        """Yield a thread-isolated cursor on :attr:`_duckdb`.
+        """Yield a thread-isolated cursor on :attr:`_duckdb` from the pool.
 
         Use as ``with store.cursor() as cur:`` for any synchronous
         query. Generators that need the cursor alive while streaming
-        must pin it in their closure so it isn't closed before
-        consumption finishes.
+        must pin it in their closure so it isn't returned before
+        consumption finishes. Cursors are reused, so temporary objects
+        must be dropped before leaving the context. At most
+        ``max_cursors`` threads use cursors at a time, nested use within
+        a thread doesn't wait for the pool.
         """
-        cur = self._duckdb.cursor()
-        try:
+        with self._cursors.cursor() as cur:
             yield cur
-        finally:
-            cur.close()
 
     def _apply_filters(self, q: Select) -> Select:
         """Hook for subclasses to inject additional WHERE clauses.
@@ -430,23 +1035,79 @@ class LakeStore(SQLStore[LakeQueryView]):
         """
         return q
 
-    def _execute(self, q: Select, stream: bool = True) -> Generator[Any, None, None]:
-        if not self.exists:
-            return
+    def _compile(self, q: Select) -> str:
+        """Compile a read query to DuckDB SQL with all filters applied"""
         q = self._apply_filters(q)
         if self._view_filter is not None:
             q = q.where(self._view_filter)
-        sql = str(q.compile(compile_kwargs={"literal_binds": True}))
+        return str(q.compile(compile_kwargs={"literal_binds": True}))
+
+    def _execute_arrow(
+        self,
+        q: Select,
+        batch_size: int = 100_000,
+        files: list[str] | None = None,
+    ) -> Generator[pa.RecordBatch, None, None]:
+        """Execute a read query and stream the result as arrow record batches.
+
+        If `files` is given, the statement table is read from these data files
+        (e.g. from a point lookup via the id index) instead of the whole table.
+        """
+        if not self.exists or files == []:
+            return
+        sql = self._compile(q)
         with self.cursor() as cur:
-            res = cur.execute(sql)
-            cols = (
-                res.columns
-                if hasattr(res, "columns")
-                else [d[0] for d in res.description]
+            if files is None:
+                yield from cur.execute(sql).to_arrow_reader(batch_size)
+                return
+            # a temporary view shadows the table view for this cursor only
+            uris = ", ".join(sql_literal(f) for f in files)
+            cur.execute(
+                f"CREATE TEMP VIEW {nks.STATEMENT_TABLE} AS SELECT * "
+                f"FROM read_parquet([{uris}], hive_partitioning = true, "
+                "hive_types_autocast = false, union_by_name = true)"
             )
-            while rows := res.fetchmany(100_000):
-                for row in rows:
-                    yield Row(dict(zip(cols, row)))
+            try:
+                yield from cur.execute(sql).to_arrow_reader(batch_size)
+            finally:
+                cur.execute(f"DROP VIEW IF EXISTS temp.{nks.STATEMENT_TABLE}")
+
+    def _execute(self, q: Select, stream: bool = True) -> Generator[Any, None, None]:
+        for batch in self._execute_arrow(q):
+            fields = {name: ix for ix, name in enumerate(batch.schema.names)}
+            columns = [c.to_pylist() for c in batch.columns]
+            for values in zip(*columns):
+                yield Row.from_values(fields, values)
+
+    def _execute_column(self, q: Select) -> Generator[Any, None, None]:
+        """Yield the values of the first result column, for projections"""
+        for batch in self._execute_arrow(q):
+            yield from batch.column(0).to_pylist()
+
+    def _iterate_stmts(
+        self, q: Select, stream: bool = True, files: list[str] | None = None
+    ) -> Generator[LakeStatement, None, None]:
+        for batch in self._execute_arrow(q, files=files):
+            yield from statements_from_batch(batch)
+
+    def _iterate(
+        self, q: Select, stream: bool = True, files: list[str] | None = None
+    ) -> StatementEntities:
+        """Assemble entities from statements ordered by `canonical_id`"""
+        current_id: str | None = None
+        current: list[Statement] = []
+        for stmt in self._iterate_stmts(q, files=files):
+            if current and stmt.canonical_id != current_id:
+                proxy = self.assemble(current)
+                if proxy is not None:
+                    yield proxy
+                current = []
+            current_id = stmt.canonical_id
+            current.append(stmt)
+        if current:
+            proxy = self.assemble(current)
+            if proxy is not None:
+                yield proxy
 
     def get_scope(self) -> Dataset:
         if "dataset" not in self._partition_by:
@@ -465,31 +1126,449 @@ class LakeStore(SQLStore[LakeQueryView]):
         return LakeQueryView(self, scope, external)
 
     def writer(
-        self, origin: str | None = DEFAULT_ORIGIN, source: str | None = None
+        self,
+        origin: str | None = DEFAULT_ORIGIN,
+        source: str | None = None,
+        flush_workers: int | None = None,
+        buffer_pops: bool = False,
+        upsert: bool = False,
     ) -> "LakeWriter":
-        return LakeWriter(self, origin=origin or DEFAULT_ORIGIN, source=source)
+        return LakeWriter(
+            self,
+            origin=origin or DEFAULT_ORIGIN,
+            source=source,
+            flush_workers=flush_workers,
+            buffer_pops=buffer_pops,
+            upsert=upsert,
+        )
+
+    def _get_file_mask(
+        self,
+        partitions: dict[str, set[str]],
+        canonical_ids: set[str] | None = None,
+    ) -> tuple[pa.Table, pa.Array]:
+        """Get the add actions of the current version and the mask of the
+        files matching the given partition values, canonical id statistics
+        ranges and id index"""
+        actions = pa.table(self.deltatable.get_add_actions(flatten=True))
+        mask = pa.array([True] * actions.num_rows)
+        for key, values in partitions.items():
+            column = f"partition.{key}"
+            if column in actions.column_names:
+                mask = pc.and_(
+                    mask, pc.is_in(actions[column], pa.array(sorted(values)))
+                )
+        if canonical_ids and "min.canonical_id" in actions.column_names:
+            lower, upper = actions["min.canonical_id"], actions["max.canonical_id"]
+            hits = pa.array([False] * actions.num_rows)
+            for canonical_id in canonical_ids:
+                hit = pc.and_kleene(
+                    pc.less_equal(lower, canonical_id),
+                    pc.greater_equal(upper, canonical_id),
+                )
+                hits = pc.or_kleene(hits, hit)
+            # files without statistics can't be skipped
+            mask = pc.and_(mask, pc.fill_null(hits, True))
+        if canonical_ids:
+            index = self.get_id_index()
+            if index is not None:
+                paths = [unquote(p) for p in actions["path"].to_pylist()]
+                mask = pc.and_(mask, index.get_mask(paths, canonical_ids))
+        return actions, mask
+
+    def get_pruning_metrics(
+        self,
+        partitions: dict[str, set[str]],
+        canonical_ids: set[str] | None = None,
+    ) -> PruningMetrics:
+        """Count the data files of the current version that match the given
+        partition values, canonical id statistics ranges and id index"""
+        if not self.exists:
+            return PruningMetrics()
+        actions, mask = self._get_file_mask(partitions, canonical_ids)
+        return PruningMetrics(
+            files_considered=actions.num_rows,
+            files_scanned=pc.sum(mask).as_py() or 0,
+        )
+
+    def get_lookup_files(
+        self, partitions: dict[str, set[str]], canonical_ids: set[str]
+    ) -> list[str]:
+        """Get the uris of the data files a point lookup has to read"""
+        actions, mask = self._get_file_mask(partitions, canonical_ids)
+        base = self.deltatable.table_uri.rstrip("/")
+        paths = actions.filter(mask)["path"].to_pylist()
+        return [f"{base}/{unquote(p)}" for p in paths]
+
+    @property
+    def _use_id_index(self) -> bool:
+        # custom views (e.g. deduplication) need to read through delta_scan
+        view_sql = self._view_sqls.get(nks.STATEMENT_TABLE)
+        return self._id_index and view_sql is default_view_sql
+
+    def get_id_index(self) -> IdIndex | None:
+        """Get the point lookup index, `None` if there is none (yet) or the
+        store doesn't use it. The index is re-loaded when the table changed."""
+        if not self._use_id_index:
+            return None
+        version = self.version
+        if version is None:
+            return None
+        if self._id_index_loaded != version:
+            index = self._backend.get(
+                INDEX_KEY, model=IdIndex, raise_on_nonexist=False
+            )
+            if index is not None:
+                self._id_index_cache = index
+            self._id_index_loaded = version
+        return self._id_index_cache
+
+    def update_index(self, rebuild: bool = False) -> None:
+        """Update the point lookup index for the current version: drop the
+        removed data files and read the canonical ids of the new ones only.
+        This is done by the writer after each flush, `optimize` and `compact`
+        (files written otherwise, e.g. by `pop`, are read by lookups until the
+        next update).
+
+        Args:
+            rebuild: Read the canonical ids of all data files (`ftmq store
+                index`)
+        """
+        if not self._use_id_index or not self.exists:
+            return
+        dt = self.deltatable
+        version = dt.version()
+        index = None if rebuild else self.get_id_index()
+        indexed = index.files if index is not None else {}
+        actions = pa.table(dt.get_add_actions(flatten=True))
+        files: dict[str, IdFilter] = {}
+        hashes: dict[str, list[tuple[int, int]]] = {}
+        for path in actions["path"].to_pylist():
+            path = unquote(path)
+            if path in indexed:
+                files[path] = indexed[path]
+            else:
+                hashes[path] = []
+        if index is not None and not hashes and len(files) == len(indexed):
+            return  # unchanged
+        if hashes:
+            base = dt.table_uri.rstrip("/")
+            uris = ", ".join(sql_literal(f"{base}/{p}") for p in hashes)
+            # duckdb normalizes the uris, data file names are unique though
+            names = {p.rsplit("/", 1)[-1]: p for p in hashes}
+            sql = (
+                "SELECT DISTINCT filename, canonical_id "
+                f"FROM read_parquet([{uris}], filename = true)"
+            )
+            with self.cursor() as cur:
+                for batch in cur.execute(sql).to_arrow_reader(100_000):
+                    for uri, canonical_id in zip(
+                        batch.column(0).to_pylist(), batch.column(1).to_pylist()
+                    ):
+                        if canonical_id is not None:
+                            path = names[uri.rsplit("/", 1)[-1]]
+                            hashes[path].append(get_id_hashes(canonical_id))
+            files.update({p: IdFilter.build(h) for p, h in hashes.items()})
+        index = IdIndex(version=version, files=files)
+        self._backend.put(INDEX_KEY, index, model=IdIndex)
+        self._id_index_cache = index
+        self._id_index_loaded = version
+        log.info(
+            f"Updated id index at version {version}",
+            uri=self.uri,
+            files=len(files),
+            new_files=len(hashes),
+        )
+
+    def get_changed_ids(
+        self, since_version: int, until_version: int | None = None
+    ) -> set[str]:
+        """
+        Get the canonical ids of all statements inserted, updated or deleted
+        after `since_version` up to `until_version` (default: current version)
+        from the Delta change data feed.
+
+        Args:
+            since_version: Exclusive lower version bound
+            until_version: Inclusive upper version bound
+
+        Returns:
+            The set of touched canonical ids
+        """
+        dt = self.deltatable
+        if until_version is None:
+            until_version = dt.version()
+        if since_version >= until_version:
+            return set()
+        reader = pa.RecordBatchReader.from_stream(
+            dt.load_cdf(
+                starting_version=since_version + 1,
+                ending_version=until_version,
+                columns=["canonical_id"],
+            )
+        )
+        ids: set[str] = set()
+        for batch in reader:
+            ids.update(pc.unique(batch.column("canonical_id")).to_pylist())
+        ids.discard(None)
+        return ids
+
+    def changes(
+        self,
+        since_version: int,
+        dataset: str | Dataset | None = None,
+        batch_size: int = 10_000,
+    ) -> tuple[int | None, StatementEntities]:
+        """
+        Get the entities touched since a Delta version for incremental
+        processing (e.g. indexing). Entities are assembled from the current
+        state of the store, so they are complete; entities that were deleted
+        entirely are not part of the result.
+
+        Example:
+            ```python
+            version, entities = store.changes(last_version)
+            for entity in entities:
+                index(entity)
+            last_version = version
+            ```
+
+        Args:
+            since_version: The version returned by the previous run
+            dataset: `Dataset` instance or name to limit scope to
+            batch_size: Number of canonical ids to fetch per query
+
+        Returns:
+            The new high-water version (`None` if the table doesn't exist yet)
+            and a generator of the changed entities within the store scope
+        """
+        version = self.version
+        if version is None:
+            return None, (e for e in ())
+        ids = sorted(self.get_changed_ids(since_version, version))
+
+        def _entities() -> StatementEntities:
+            if dataset is not None:
+                view = self.view(ensure_dataset(dataset))
+            else:
+                view = self.view(self.get_scope())
+            for ix in range(0, len(ids), batch_size):
+                q = Query().where(canonical_id__in=ids[ix : ix + batch_size])
+                yield from view.query(q)
+
+        return version, _entities()
+
+    def get_dataset_fingerprint(self, dataset: str) -> str:
+        """Checksum of the current data files of a dataset partition"""
+        uris = self.deltatable.file_uris([("dataset", "=", dataset)])
+        return make_data_checksum("\n".join(sorted(uris)))
+
+    def get_stats_sidecar(self, dataset: str) -> StatsSidecar | None:
+        """
+        Get the precomputed statistics of a dataset partition.
+
+        Args:
+            dataset: Name of the dataset
+
+        Returns:
+            The sidecar, or `None` if there is none or it is stale
+        """
+        if not self._stats_sidecars or "dataset" not in self._partition_by:
+            return None
+        if not self.exists:
+            return None
+        sidecar = self._backend.get(
+            f"{STATS_PREFIX}/{dataset}.json",
+            model=StatsSidecar,
+            raise_on_nonexist=False,
+        )
+        if sidecar is None:
+            return None
+        if sidecar.fingerprint != self.get_dataset_fingerprint(dataset):
+            return None
+        return sidecar
+
+    def _put_stats_sidecar(self, sidecar: StatsSidecar) -> None:
+        key = f"{STATS_PREFIX}/{sidecar.dataset}.json"
+        self._backend.put(key, sidecar, model=StatsSidecar)
+
+    def _restamp_stats_sidecar(self, sidecar: StatsSidecar) -> None:
+        """Carry over a sidecar to the current files of its partition, after
+        a rewrite that didn't change the content (compaction)"""
+        sidecar.version = self.deltatable.version()
+        sidecar.fingerprint = self.get_dataset_fingerprint(sidecar.dataset)
+        self._put_stats_sidecar(sidecar)
+
+    def update_stats(self, datasets: Iterable[str] | None = None) -> None:
+        """
+        Compute and store the statistics sidecars of dataset partitions. This
+        scans the partitions and is called by the writer after a flush if the
+        store is created with `stats_sidecars=True` (off by default, as every
+        flush then rescans the dataset partitions it touched).
+
+        Args:
+            datasets: Names of the datasets (default: all in the store)
+        """
+        if not self._stats_sidecars or "dataset" not in self._partition_by:
+            return
+        if not self.exists:
+            return
+        if datasets is None:
+            datasets = self.get_scope().leaf_names
+        for name in datasets:
+            # take the fingerprint before scanning: if a concurrent write
+            # changes the partition meanwhile, the sidecar is stale
+            version = self.deltatable.version()
+            fingerprint = self.get_dataset_fingerprint(name)
+            view = self.view(ensure_dataset(name))
+            stats = view.scan_stats(Query().where(dataset=name))
+            self._put_stats_sidecar(
+                StatsSidecar(
+                    dataset=name, version=version, fingerprint=fingerprint, stats=stats
+                )
+            )
+            log.info(
+                f"Updated statistics of `{name}` at version {version}",
+                uri=self.uri,
+                dataset=name,
+            )
+
+    def get_compaction_candidates(
+        self, policy: CompactionPolicy | None = None
+    ) -> tuple[int, list[dict[str, str]]]:
+        """
+        Find the partitions that cross the compaction thresholds, based on the
+        file sizes in the Delta log (no data files are read).
+
+        Args:
+            policy: The thresholds (default: the store's policy)
+
+        Returns:
+            The number of partitions checked and the partition values of the
+            partitions to compact
+        """
+        policy = policy or self._compaction or CompactionPolicy()
+        if not self.exists:
+            return 0, []
+        actions = pa.table(self.deltatable.get_add_actions(flatten=True))
+        keys = [f"partition.{k}" for k in self._partition_by]
+        small = pc.less(actions["size_bytes"], policy.small_file_size)
+        groups = (
+            actions.select([*keys, "path"])
+            .append_column("small", pc.cast(small, pa.int64()))
+            .group_by(keys)
+            .aggregate([("path", "count"), ("small", "sum")])
+        )
+        candidates: list[dict[str, str]] = []
+        for group in groups.to_pylist():
+            if policy.check(group["path_count"], group["small_sum"]):
+                candidates.append(
+                    {k: group[f"partition.{k}"] for k in self._partition_by}
+                )
+        return groups.num_rows, candidates
+
+    def compact(self, policy: CompactionPolicy | None = None) -> CompactionMetrics:
+        """
+        Z-Order and compact the partitions that cross the thresholds of the
+        compaction policy. The store lock is held per partition only, so
+        writers can proceed in between.
+
+        Args:
+            policy: The thresholds (default: the store's policy)
+
+        Returns:
+            The metrics of this run
+        """
+        start = time.perf_counter()
+        checked, candidates = self.get_compaction_candidates(policy)
+        metrics = CompactionMetrics(partitions_checked=checked)
+        for partition in candidates:
+            filters: FilterConjunctionType = [
+                (k, "=", v) for k, v in partition.items()
+            ]
+            with self._lock:
+                locked = time.perf_counter()
+                self.refresh()
+                sidecar = None
+                if "dataset" in partition:
+                    sidecar = self.get_stats_sidecar(partition["dataset"])
+                res = self.deltatable.optimize.z_order(
+                    Z_ORDER,
+                    writer_properties=writer_for_bucket(partition.get("bucket", "")),
+                    target_size=TARGET_SIZE,
+                    partition_filters=filters,
+                )
+                self.refresh()
+                if sidecar is not None:
+                    self._restamp_stats_sidecar(sidecar)
+                metrics.lock_seconds += time.perf_counter() - locked
+            metrics.partitions_compacted += 1
+            metrics.files_removed += res["numFilesRemoved"]
+            metrics.files_added += res["numFilesAdded"]
+        if metrics.partitions_compacted:
+            self.update_index()
+        metrics.seconds = time.perf_counter() - start
+        log.info(
+            f"Compacted {metrics.partitions_compacted} of "
+            f"{metrics.partitions_checked} partitions",
+            uri=self.uri,
+            **metrics.model_dump(),
+        )
+        return metrics
 
     def get_origins(self) -> set[str]:
         q = select(self.table.c.origin).distinct()
-        return set([r.origin for r in self._execute(q)])
+        return set(self._execute_column(q))
 
 
 class LakeWriter(nk.Writer):
     store: LakeStore
     BATCH_STATEMENTS = 1_000_000
+    BATCH_POPS = 10_000
+    FLUSH_WORKERS = 4
 
     def __init__(
         self,
         store: Store,
         origin: str | None = DEFAULT_ORIGIN,
         source: str | None = None,
+        flush_workers: int | None = None,
+        buffer_pops: bool = False,
+        upsert: bool = False,
     ):
+        """
+        Bulk writer for a [LakeStore][ftmq.store.lake.LakeStore]
+
+        Args:
+            store: The lake store to write into
+            origin: Default origin for statements without one
+            source: Default source for statements without one
+            flush_workers: Number of buckets written in parallel on `flush`
+                (defaults to `FLUSH_WORKERS`)
+            buffer_pops: Defer the deletes of `pop` and apply them in batches
+            upsert: Merge statements into the table instead of appending them,
+                so re-written statements are updated instead of duplicated
+        """
         super().__init__(store)
         self.batch: dict[str, tuple[Statement, str | None]] = {}
         self.origin = origin or DEFAULT_ORIGIN
         self.source = source
+        self.flush_workers = max(1, flush_workers or self.FLUSH_WORKERS)
+        self.flush_timings: dict[str, float] = {}
+        self.buffer_pops = buffer_pops
+        self.pending_pops: set[str] = set()
+        self.touched_datasets: set[str] = set()
+        self.upsert = upsert
 
     def add_statement(self, stmt: Statement, source: str | None = None) -> None:
+        self._add_statement(self.batch, stmt, source)
+
+    def _add_statement(
+        self,
+        batch: dict[str, tuple[Statement, str | None]],
+        stmt: Statement,
+        source: str | None = None,
+    ) -> None:
         if stmt.entity_id is None:
             return
         stmt.origin = stmt.origin or self.origin
@@ -497,7 +1576,7 @@ class LakeWriter(nk.Writer):
         stmt.canonical_id = canonical_id
         dedupe = stmt.dedupe_key if isinstance(stmt, LakeStatement) else stmt.id
         key = f"{canonical_id}\t{dedupe}"
-        self.batch[key] = (stmt, source or self.source)
+        batch[key] = (stmt, source or self.source)
 
     def add_entity(
         self,
@@ -517,51 +1596,228 @@ class LakeWriter(nk.Writer):
         if len(self.batch) >= self.BATCH_STATEMENTS:
             self.flush()
 
-    def _build_table(self) -> pa.Table:
+    def _build_table(
+        self, batch: dict[str, tuple[Statement, str | None]] | None = None
+    ) -> pa.Table:
+        batch = self.batch if batch is None else batch
         rows: list[SDict] = []
-        for key in sorted(self.batch):
-            stmt, source = self.batch[key]
+        for key in sorted(batch):
+            stmt, source = batch[key]
             rows.append(pack_statement(stmt, source))
         return pa.Table.from_pylist(rows, schema=ARROW_SCHEMA)
 
+    def make_table(
+        self, statements: Iterable[Statement], source: str | None = None
+    ) -> pa.Table:
+        """Build the arrow table (`ARROW_SCHEMA`) of the given statements the
+        same way as a batch of `add_statement` (canonical ids, default
+        origin and source, deduplicated), without buffering them. To be
+        written with `write_table`."""
+        batch: dict[str, tuple[Statement, str | None]] = {}
+        for stmt in statements:
+            self._add_statement(batch, stmt, source)
+        return self._build_table(batch)
+
+    def _write_bucket(self, table: pa.Table, bucket: str) -> float:
+        """Sort and write the statements of one bucket, return elapsed seconds.
+
+        The parquet encoding and compression in `write_deltalake` happens
+        outside of the GIL, so buckets can be written concurrently from a
+        thread pool.
+        """
+        start = time.perf_counter()
+        split = table.filter(pc.equal(table.column("bucket"), bucket)).sort_by(
+            [
+                ("entity_id", "ascending"),
+                ("prop", "ascending"),
+            ]
+        )
+        if self.upsert and self.store.exists:
+            self._merge_bucket(split, bucket)
+        else:
+            write_deltalake(
+                str(self.store.uri),
+                split,
+                partition_by=self.store._partition_by,
+                mode="append",
+                schema_mode="merge",
+                writer_properties=writer_for_bucket(bucket),
+                target_file_size=TARGET_SIZE,
+                storage_options=storage_options(),
+                configuration={"delta.enableChangeDataFeed": "true"},
+            )
+        return time.perf_counter() - start
+
+    def _merge_bucket(self, split: pa.Table, bucket: str) -> None:
+        """Upsert the statements of one bucket via a Delta `MERGE` on
+        `(canonical_id, id, fragment)`, restricted to the affected partitions.
+        Only the files of these partitions that contain matches are
+        rewritten."""
+        predicate = [
+            "t.canonical_id = s.canonical_id",
+            "t.id = s.id",
+            "coalesce(t.fragment, '') = s.fragment",
+        ]
+        if "bucket" in self.store._partition_by:
+            predicate.append(f"t.bucket = {sql_literal(bucket)}")
+        for key in ("dataset", "origin"):
+            if key in self.store._partition_by:
+                values = pc.unique(split.column(key)).to_pylist()
+                values = ", ".join(sql_literal(v) for v in sorted(values))
+                predicate.append(f"t.{key} IN ({values})")
+        (
+            self.store.deltatable.merge(
+                split,
+                " AND ".join(predicate),
+                source_alias="s",
+                target_alias="t",
+                merge_schema=True,
+                writer_properties=writer_for_bucket(bucket),
+            )
+            .when_matched_update_all()
+            .when_not_matched_insert_all()
+            .execute()
+        )
+
     def flush(self) -> None:
+        """
+        Write the current batch to the deltalake, one append per bucket.
+
+        Buckets are written in parallel by up to `flush_workers` threads
+        (delta-rs resolves the concurrent blind appends), in `upsert` mode
+        they are merged one after another. If the table doesn't exist yet, the
+        first bucket is written alone to create it. The elapsed seconds per
+        bucket are available in `flush_timings` afterwards.
+
+        Afterwards, the statistics sidecars of the written (and popped)
+        datasets are updated (if enabled), partitions that cross the
+        thresholds of the store's compaction policy (if any) are compacted and
+        the new data files are added to the id index.
+        """
+        popped = bool(self.pending_pops)
+        self.flush_pops()
         if not self.batch:
             self.batch = {}
+            self.flush_stats()
+            if popped:
+                self.store.update_index()
+            return
+        self.write_table(self._build_table())
+        self.batch = {}
+        self.flush_stats()
+        if self.store._compaction is not None:
+            self.store.compact()
+        self.store.update_index()
+
+    def write_table(self, table: pa.Table) -> None:
+        """
+        Write an arrow table of statements (`ARROW_SCHEMA`, e.g. from
+        `make_table`) to the deltalake, one append (or merge) per bucket
+        written in parallel as on `flush`. The statistics sidecars (if
+        enabled) are updated on the next `flush`.
+        """
+        if not table.num_rows:
             return
         log.info(
-            f"Write {len(self.batch)} statements to deltalake ...",
+            f"Write {table.num_rows} statements to deltalake ...",
             uri=self.store.uri,
         )
-        table = self._build_table()
+        buckets: list[str] = table.column("bucket").unique().to_pylist()
+        self.touched_datasets.update(table.column("dataset").unique().to_pylist())
+        timings: dict[str, float] = {}
         with self.store._lock:
-            for bucket in table.column("bucket").unique().to_pylist():
-                split = table.filter(pc.equal(table.column("bucket"), bucket)).sort_by(
-                    [
-                        ("entity_id", "ascending"),
-                        ("prop", "ascending"),
-                    ]
-                )
-                write_deltalake(
-                    str(self.store.uri),
-                    split,
-                    partition_by=self.store._partition_by,
-                    mode="append",
-                    schema_mode="merge",
-                    writer_properties=writer_for_bucket(bucket),
-                    target_file_size=TARGET_SIZE,
-                    storage_options=storage_options(),
-                    configuration={"delta.enableChangeDataFeed": "true"},
-                )
-        self.batch = {}
+            self.store.refresh()
+            try:
+                if not self.store.exists:
+                    # initial commit creates the table, can't run concurrently
+                    bucket = buckets.pop(0)
+                    timings[bucket] = self._write_bucket(table, bucket)
+                if buckets:
+                    workers = min(self.flush_workers, len(buckets))
+                    if self.upsert:
+                        # merges read the table, don't run them concurrently
+                        workers = 1
+                    with ThreadPoolExecutor(max_workers=workers) as pool:
+                        results = pool.map(
+                            lambda b: self._write_bucket(table, b), buckets
+                        )
+                        timings.update(zip(buckets, results))
+            finally:
+                self.store.refresh()
+        for bucket, seconds in timings.items():
+            log.info(
+                f"Wrote bucket `{bucket}` in {seconds:.2f}s",
+                uri=self.store.uri,
+                bucket=bucket,
+            )
+        self.flush_timings = timings
+
+    def flush_stats(self) -> None:
+        """Update the statistics sidecars of the datasets changed by this
+        writer"""
+        if self.touched_datasets:
+            self.store.update_stats(sorted(self.touched_datasets))
+        self.touched_datasets = set()
+
+    def _delete(self, entity_ids: list[str]) -> None:
+        """Delete all statements of the given canonical ids in one commit"""
+        if not entity_ids or not self.store.exists:
+            return
+        values = ", ".join(sql_literal(i) for i in entity_ids)
+        with self.store._lock:
+            self.store.deltatable.delete(f"canonical_id IN ({values})")
+
+    def flush_pops(self) -> None:
+        """Apply the buffered deletes of `pop` (if `buffer_pops` is enabled)"""
+        ids = sorted(self.pending_pops)
+        for ix in range(0, len(ids), self.BATCH_POPS):
+            self._delete(ids[ix : ix + self.BATCH_POPS])
+        self.pending_pops = set()
 
     def pop(self, entity_id: str) -> list[Statement]:
-        q = select(TABLE)
-        q = q.where(TABLE.c.canonical_id == entity_id)
-        statements: list[Statement] = []
-        for row in self.store._execute(q):
-            statements.append(LakeStatement.from_db_row(row))
+        """
+        Get and remove all statements of the given canonical id.
+
+        With `buffer_pops` enabled, the deletion is deferred until the next
+        `flush` (or until `BATCH_POPS` ids are pending) and applied as one
+        delete commit for all pending ids. Until then, readers still see the
+        popped statements, but this writer doesn't return them again.
+        """
+        if not self.buffer_pops:
+            return self.pop_many([entity_id]).get(entity_id, [])
+        if entity_id in self.pending_pops:
+            return []
+        q = select(TABLE).where(TABLE.c.canonical_id == entity_id)
+        statements: list[Statement] = list(self.store._iterate_stmts(q))
+        self.touched_datasets.update(s.dataset for s in statements)
+        self.pending_pops.add(entity_id)
+        if len(self.pending_pops) >= self.BATCH_POPS:
+            self.flush_pops()
+        return statements
+
+    def pop_many(self, entity_ids: Iterable[str]) -> dict[str, list[Statement]]:
+        """
+        Get and remove all statements of the given canonical ids.
+
+        The statements are read with one scan and deleted with one delete
+        commit per `BATCH_POPS` ids, instead of a read and a commit (which
+        rewrites the affected files) per entity.
+
+        Args:
+            entity_ids: The canonical ids to pop
 
-        self.store.deltatable.delete(f"canonical_id = '{entity_id}'")
+        Returns:
+            The popped statements by canonical id
+        """
+        ids = sorted(set(entity_ids) - self.pending_pops)
+        statements: dict[str, list[Statement]] = {i: [] for i in ids}
+        for ix in range(0, len(ids), self.BATCH_POPS):
+            chunk = ids[ix : ix + self.BATCH_POPS]
+            q = select(TABLE).where(TABLE.c.canonical_id.in_(chunk))
+            for stmt in self.store._iterate_stmts(q):
+                statements[stmt.canonical_id].append(stmt)
+                self.touched_datasets.add(stmt.dataset)
+            self._delete(chunk)
         return statements
 
     def optimize(
@@ -575,6 +1831,10 @@ class LakeWriter(nk.Writer):
         """
         Optimize the storage: Z-Ordering and compacting
 
+        Compaction doesn't change the content, so up to date statistics
+        sidecars of the optimized datasets are carried over to the new data
+        files, stale or missing ones are computed.
+
         Args:
             vacuum: Run vacuum after optimization
             vacuum_keep_hours: Retention hours for vacuum
@@ -589,6 +1849,12 @@ class LakeWriter(nk.Writer):
             base_filters.append(("origin", "=", origin))
 
         with self.store._lock:
+            self.store.refresh()
+            if dataset is not None:
+                datasets = [dataset]
+            else:
+                datasets = sorted(self.store.get_scope().leaf_names)
+            sidecars = {d: self.store.get_stats_sidecar(d) for d in datasets}
             if bucket is not None:
                 filters = list(base_filters) + [("bucket", "=", bucket)]
                 self.store.deltatable.optimize.z_order(
@@ -619,3 +1885,140 @@ class LakeWriter(nk.Writer):
                     dry_run=False,
                     full=True,
                 )
+            self.store.refresh()
+            self._restamp_stats(sidecars)
+            self.store.update_index()
+
+    def _restamp_stats(self, sidecars: dict[str, StatsSidecar | None]) -> None:
+        stale = [d for d, sidecar in sidecars.items() if sidecar is None]
+        for sidecar in sidecars.values():
+            if sidecar is not None:
+                self.store._restamp_stats_sidecar(sidecar)
+        self.store.update_stats(stale)
+
+
+class ReadOnlyError(RuntimeError):
+    """Raised for operations that a read-only store doesn't support"""
+
+
+class FederatedLakeStore(LakeStore):
+    """
+    Read-only store over several lakes, queried through one DuckDB connection.
+
+    The statement view of each lake (built by its own `view_sqls`) is
+    registered on a shared connection, and the statement view of this store
+    is their `UNION ALL`. Each ftmq `Query`, including stats and
+    aggregations, runs as one query across all lakes, and DuckDB pushes the
+    filters down into each lake's scan. View filters and filter hooks of the
+    member stores are not applied. Lakes that don't exist yet are left out of
+    the union until they are created. Writing, compaction and `changes` raise
+    a `ReadOnlyError`, use the member stores for that.
+
+    Example:
+        ```python
+        store = FederatedLakeStore(stores=["s3://lakes/a", "s3://lakes/b"])
+        stats = store.view().stats()
+        ```
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        stores: list[LakeStore | str] = kwargs.pop("stores", None) or []
+        self.stores: list[LakeStore] = [
+            s if isinstance(s, LakeStore) else LakeStore(uri=s) for s in stores
+        ]
+        if not self.stores:
+            raise ValueError("No lakes to federate")
+        self._members: tuple[int, ...] | None = None  # lakes in the union view
+        self._members_lock = threading.Lock()
+        kwargs["uri"] = self.stores[0].uri
+        kwargs["stats_sidecars"] = False
+        kwargs["id_index"] = False
+        super().__init__(*args, **kwargs)
+        self.uri = ",".join(str(s.uri) for s in self.stores)
+
+    def _get_deltatable(self) -> DeltaTable | None:
+        return None
+
+    def refresh(self) -> None:
+        for store in self.stores:
+            store.refresh()
+
+    @property
+    def exists(self) -> bool:
+        return any(s.exists for s in self.stores)
+
+    def _get_members(self) -> tuple[int, ...]:
+        return tuple(ix for ix, s in enumerate(self.stores) if s.exists)
+
+    def _register_views(self, con: duckdb.DuckDBPyConnection) -> None:
+        members = self._get_members()
+        views: list[str] = []
+        for ix in members:
+            store = self.stores[ix]
+            name = f"{nks.STATEMENT_TABLE}_{ix}"
+            builder = store._view_sqls.get(nks.STATEMENT_TABLE, default_view_sql)
+            con.sql(f"CREATE OR REPLACE VIEW {name} AS {builder(store.deltatable)}")
+            views.append(f"SELECT * FROM {name}")
+        union = " UNION ALL BY NAME ".join(views) or EMPTY_VIEW_SQL
+        con.sql(f"CREATE OR REPLACE VIEW {nks.STATEMENT_TABLE} AS {union}")
+        self._members = members
+
+    @contextmanager
+    def cursor(self) -> Iterator[duckdb.DuckDBPyConnection]:
+        # lakes created after the views were registered join the union
+        con = self._duckdb
+        if self._get_members() != self._members:
+            with self._members_lock:
+                if self._get_members() != self._members:
+                    self._register_views(con)
+        with super().cursor() as cur:
+            yield cur
+
+    def get_scope(self) -> Dataset:
+        names: set[str] = set()
+        for store in self.stores:
+            if store.exists:
+                names.update(store.get_scope().leaf_names)
+        return get_scope_dataset(*names)
+
+    def get_pruning_metrics(
+        self,
+        partitions: dict[str, set[str]],
+        canonical_ids: set[str] | None = None,
+    ) -> PruningMetrics:
+        metrics = PruningMetrics()
+        for store in self.stores:
+            res = store.get_pruning_metrics(partitions, canonical_ids)
+            metrics.files_considered += res.files_considered
+            metrics.files_scanned += res.files_scanned
+        return metrics
+
+    def changes(
+        self,
+        since_version: int,
+        dataset: str | Dataset | None = None,
+        batch_size: int = 10_000,
+    ) -> tuple[int | None, StatementEntities]:
+        """Not supported, the Delta versions are tracked per lake"""
+        raise ReadOnlyError("Changes are tracked per lake, use its store")
+
+    def writer(
+        self,
+        origin: str | None = DEFAULT_ORIGIN,
+        source: str | None = None,
+        flush_workers: int | None = None,
+        buffer_pops: bool = False,
+        upsert: bool = False,
+    ) -> "LakeWriter":
+        """Not supported, write to the member lakes instead"""
+        raise ReadOnlyError("Federated lakes are read-only")
+
+    def get_compaction_candidates(
+        self, policy: CompactionPolicy | None = None
+    ) -> tuple[int, list[dict[str, str]]]:
+        """Not supported, compact the member lakes instead"""
+        raise ReadOnlyError("Federated lakes are read-only")
+
+    def compact(self, policy: CompactionPolicy | None = None) -> CompactionMetrics:
+        """Not supported, compact the member lakes instead"""
+        raise ReadOnlyError("Federated lakes are read-only")
@@ -0,0 +1,82 @@
+"""
+Bulk ingest helpers for postgres (psycopg 3)
+"""
+
+from datetime import datetime
+from typing import Any, Iterable, Sequence
+
+import orjson
+from sqlalchemy import Connection, Table
+
+COPY_BATCH = 100_000
+
+
+def _copy_value(value: Any) -> Any:
+    if isinstance(value, (dict, list)):
+        return orjson.dumps(value).decode()
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def can_copy(conn: Connection) -> bool:
+    """Check if the connection is a postgres connection via psycopg 3"""
+    return conn.dialect.name == "postgresql" and conn.dialect.driver == "psycopg"
+
+
+def copy_upsert(
+    conn: Connection,
+    table: Table,
+    rows: Iterable[Sequence[Any]],
+    index_elements: Sequence[str],
+    update: Sequence[str],
+    returning: Sequence[str] = (),
+) -> list[tuple[Any, ...]]:
+    """
+    Upsert rows via `COPY` into a temporary (unlogged) staging table that is
+    merged into `table` with one `INSERT ... ON CONFLICT DO UPDATE`. Rows have
+    the column order of `table`, json values are serialized. Runs within the
+    current transaction of `conn`, the staging table is created for each call
+    (never reused by a pooled connection) so it always has the current columns
+    of `table`.
+
+    Args:
+        conn: A postgres (psycopg 3) connection
+        table: The target table
+        rows: The values in column order
+        index_elements: The unique index for the conflict resolution
+        update: The columns to update on conflict
+        returning: Columns to return for the newly inserted (not updated) rows
+
+    Returns:
+        The `returning` values of the inserted rows
+    """
+    staging = f"_staging_{table.name}"
+    columns = ", ".join(f'"{c.name}"' for c in table.columns)
+    conflict = ", ".join(f'"{c}"' for c in index_elements)
+    updates = ", ".join(f'"{c}" = EXCLUDED."{c}"' for c in update)
+    raw = conn.connection.driver_connection
+    with raw.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS pg_temp."{staging}"')
+        cursor.execute(
+            f'CREATE TEMP TABLE "{staging}" '
+            f'(LIKE "{table.name}" INCLUDING DEFAULTS) ON COMMIT DROP'
+        )
+        with cursor.copy(f'COPY "{staging}" ({columns}) FROM STDIN') as copy:
+            for row in rows:
+                copy.write_row([_copy_value(v) for v in row])
+        merge = (
+            f'INSERT INTO "{table.name}" ({columns}) '
+            f'SELECT {columns} FROM "{staging}" '
+            f"ON CONFLICT ({conflict}) DO UPDATE SET {updates}"
+        )
+        inserted: list[tuple[Any, ...]] = []
+        if returning:
+            # `xmax` is 0 for rows that were inserted instead of updated
+            values = ", ".join(f'"{c}"' for c in returning)
+            cursor.execute(f"{merge} RETURNING {values}, (xmax = 0)")
+            inserted = [tuple(row[:-1]) for row in cursor.fetchall() if row[-1]]
+        else:
+            cursor.execute(merge)
+        cursor.execute(f'DROP TABLE pg_temp."{staging}"')
+    return inserted
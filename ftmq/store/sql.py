@@ -15,12 +15,22 @@ from ftmq.enums import Fields
 from ftmq.model.stats import DatasetStats, compile_stats
 from ftmq.query import Query
 from ftmq.store.base import Store, View
+from ftmq.store.postgres import COPY_BATCH, can_copy, copy_upsert
 from ftmq.types import StatementEntities
 from ftmq.util import get_scope_dataset
 
 V = TypeVar("V", bound=View, default="SQLQueryView")
 
 MAX_SQL_AGG_GROUPS = int(os.environ.get("MAX_SQL_AGG_GROUPS", 10))
+# updated on conflict, like `nomenklatura.store.sql.SQLWriter`
+UPSERT_COLUMNS = [
+    "canonical_id",
+    "schema",
+    "prop_type",
+    "lang",
+    "original_value",
+    "last_seen",
+]
 
 
 def clean_agg_value(value: str | Decimal) -> str | float | int | None:
@@ -130,3 +140,36 @@ class SQLStore(Store[V], nk.SQLStore, Generic[V]):
     def view(self, scope: Dataset | None = None, external: bool = False) -> V:
         scope = scope or self.dataset
         return SQLQueryView(self, scope, external=external)  # type: ignore[return-value]
+
+    def writer(self, copy: bool = False) -> "SQLWriter":
+        """
+        Get a bulk writer. With `copy` (postgres via psycopg 3 only, ignored
+        otherwise) statement batches are written with `COPY` into a staging
+        table and merged with one upsert, which is much faster for initial
+        loads.
+        """
+        return SQLWriter(self, copy=copy)
+
+
+class SQLWriter(nk.SQLWriter):
+    def __init__(self, store: SQLStore, copy: bool = False) -> None:
+        super().__init__(store)
+        self.copy = copy and can_copy(self.conn)
+        if self.copy:
+            self.batch_limit = COPY_BATCH
+
+    def _upsert_batch(self) -> None:
+        if not self.copy or not len(self.batch):
+            return super()._upsert_batch()
+        if self.tx is None:
+            self.tx = self.conn.begin()
+        columns = [c.name for c in self.store.table.columns]
+        rows = (s.to_db_row() for s in self.batch)
+        copy_upsert(
+            self.conn,
+            self.store.table,
+            ([row[c] for c in columns] for row in rows),
+            index_elements=["id"],
+            update=UPSERT_COLUMNS,
+        )
+        self.batch = set()
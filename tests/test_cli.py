@@ -303,3 +303,181 @@ def test_cli_fragments_iterate_fragments(tmp_path: Path):
     key1 = next(e for e in entities if e["id"] == "key1")
     assert key1["properties"].get("name") == ["Alice"]
     assert key1["properties"].get("lastName") == ["Smith"]
+
+    get_fragments.cache_clear()
+    result = runner.invoke(
+        cli, ["fragments", "iterate", "-i", uri, "-d", "my_dataset", "--streamed"]
+    )
+    assert result.exit_code == 0, result.output
+    streamed = [li for li in _get_lines(result.output) if li.startswith("{")]
+    assert [orjson.loads(li) for li in streamed] == entities
+
+    get_fragments.cache_clear()
+    result = runner.invoke(
+        cli, ["fragments", "iterate", "-i", uri, "-d", "my_dataset", "--workers", "2"]
+    )
+    assert result.exit_code == 0, result.output
+    parallel = [li for li in _get_lines(result.output) if li.startswith("{")]
+    assert [orjson.loads(li) for li in parallel] == entities
+    result = runner.invoke(
+        cli,
+        [
+            "fragments",
+            "iterate",
+            "-i",
+            uri,
+            "-d",
+            "my_dataset",
+            "--streamed",
+            "--workers",
+            "2",
+        ],
+    )
+    assert result.exit_code == 2
+    assert "--streamed" in result.output and "--workers" in result.output
+
+    get_fragments.cache_clear()
+    args = ["fragments", "iterate", "-i", uri, "-d", "my_dataset", "--changed"]
+    result = runner.invoke(cli, args)
+    assert result.exit_code != 0
+    result = runner.invoke(cli, [*args, "--since", "2000-01-01T00:00:00"])
+    assert result.exit_code == 0, result.output
+    changed = [li for li in _get_lines(result.output) if li.startswith("{")]
+    assert [orjson.loads(li) for li in changed] == entities
+    result = runner.invoke(
+        cli, [*args, "--since", "2000-01-01T00:00:00", "--workers", "2"]
+    )
+    assert result.exit_code == 2
+    assert "--workers" in result.output
+
+    get_fragments.cache_clear()
+    result = runner.invoke(
+        cli,
+        ["fragments", "migrate", "-i", uri, "-d", "my_dataset", "--encoding", "zstd"],
+    )
+    assert result.exit_code == 0, result.output
+    get_fragments.cache_clear()
+    assert get_fragments("my_dataset", database_uri=uri).encoding == "zstd"
+    result = runner.invoke(cli, ["fragments", "iterate", "-i", uri, "-d", "my_dataset"])
+    assert result.exit_code == 0, result.output
+    migrated = [li for li in _get_lines(result.output) if li.startswith("{")]
+    assert [orjson.loads(li) for li in migrated] == entities
+
+    get_fragments.cache_clear()
+    result = runner.invoke(cli, ["fragments", "rebuild-stats", "-i", uri])
+    assert result.exit_code == 0, result.output
+    result = runner.invoke(cli, ["fragments", "list-datasets", "-i", uri])
+    assert result.exit_code == 0, result.output
+    assert "my_dataset" in _get_lines(result.output)
+
+    lake_uri = f"lake+{tmp_path / 'lake'}"
+    args = ["fragments", "export-lake", "-i", uri, "-d", "my_dataset"]
+    result = runner.invoke(cli, [*args, "-o", lake_uri])
+    assert result.exit_code == 0, result.output
+    metrics = orjson.loads(_get_lines(result.output)[-1])
+    assert metrics["entities"] == 3
+    result = runner.invoke(cli, [*args, "-o", str(tmp_path / "out.json")])
+    assert result.exit_code != 0
+
+
+def test_cli_store_changes(tmp_path: Path, fixtures_path: Path):
+    uri = f"lake+{tmp_path / 'lake'}"
+    in_uri = str(fixtures_path / "eu_authorities.ftm.json")
+    result = runner.invoke(cli, ["-i", in_uri, "-o", uri])
+    assert result.exit_code == 0, result.output
+
+    version_uri = tmp_path / "version"
+    result = runner.invoke(
+        cli,
+        [
+            "store",
+            "changes",
+            "-i",
+            uri,
+            "--since-version",
+            "-1",
+            "--version-uri",
+            str(version_uri),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    ids = set()
+    for li in _get_lines(result.output):
+        try:
+            ids.add(orjson.loads(li)["id"])
+        except orjson.JSONDecodeError:
+            continue  # skip interleaved log lines
+    assert len(ids) == 151
+    version = int(version_uri.read_text())
+
+    result = runner.invoke(
+        cli, ["store", "changes", "-i", uri, "--since-version", str(version)]
+    )
+    assert result.exit_code == 0, result.output
+    assert "eu-authorities" not in result.output
+
+    result = runner.invoke(
+        cli, ["store", "changes", "-i", "memory://", "--since-version", "0"]
+    )
+    assert result.exit_code != 0
+
+
+def test_cli_store_compact(tmp_path: Path, fixtures_path: Path):
+    uri = f"lake+{tmp_path / 'lake'}"
+    in_uri = str(fixtures_path / "eu_authorities.ftm.json")
+    for _ in range(3):
+        result = runner.invoke(cli, ["-i", in_uri, "-o", uri])
+        assert result.exit_code == 0, result.output
+
+    out = tmp_path / "metrics.json"
+    result = runner.invoke(
+        cli,
+        ["store", "compact", "-i", uri, "-o", str(out), "--max-small-files", "2"],
+    )
+    assert result.exit_code == 0, result.output
+    metrics = orjson.loads(out.read_bytes())
+    assert metrics["partitions_checked"] == 1
+    assert metrics["partitions_compacted"] == 1
+    assert metrics["files_removed"] == 3
+
+    result = runner.invoke(cli, ["store", "compact", "-i", "memory://"])
+    assert result.exit_code != 0
+
+    result = runner.invoke(cli, ["store", "index", "-i", uri])
+    assert result.exit_code == 0, result.output
+    result = runner.invoke(cli, ["store", "index", "-i", "memory://"])
+    assert result.exit_code != 0
+
+
+def test_cli_parquet(tmp_path: Path, fixtures_path: Path):
+    import pyarrow.parquet as pq
+
+    in_uri = str(fixtures_path / "eu_authorities.ftm.json")
+    out = tmp_path / "out.parquet"
+    result = runner.invoke(cli, ["-i", in_uri, "-o", str(out)])
+    assert result.exit_code == 0, result.output
+    table = pq.read_table(out)
+    assert len(set(table.column("canonical_id").to_pylist())) == 151
+
+    result = runner.invoke(cli, ["-i", in_uri, "-o", str(tmp_path / "wide"), "--wide"])
+    assert result.exit_code == 0, result.output
+    assert pq.read_table(tmp_path / "wide" / "PublicBody.parquet").num_rows == 151
+    result = runner.invoke(cli, ["-i", in_uri, "--wide"])
+    assert result.exit_code != 0
+    assert not Path("-").exists()
+    out = str(tmp_path / "wide")
+    result = runner.invoke(
+        cli, ["-i", in_uri, "-o", out, "--wide", "--output-format", "json"]
+    )
+    assert result.exit_code != 0
+
+    # native export from a lake store
+    uri = f"lake+{tmp_path / 'lake'}"
+    result = runner.invoke(cli, ["-i", in_uri, "-o", uri])
+    assert result.exit_code == 0, result.output
+    out = tmp_path / "lake.out"
+    result = runner.invoke(
+        cli, ["-i", uri, "-o", str(out), "--output-format", "parquet"]
+    )
+    assert result.exit_code == 0, result.output
+    assert pq.read_table(out).num_rows == table.num_rows
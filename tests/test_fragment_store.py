@@ -4,8 +4,10 @@ from datetime import datetime
 
 import pytest
 from followthemoney import EntityProxy
+from followthemoney.exc import InvalidData
 
 from ftmq.store.fragments import get_fragments
+from ftmq.store.fragments.utils import StoreException
 
 
 def test_fragment_store_settings(monkeypatch):
@@ -92,8 +94,23 @@ def test_fragment_store_postgres():
     assert len(list(dataset.iterate(entity_id="key1"))) == 1
     assert len(list(dataset.fragments(entity_ids="key1"))) == 2
 
+    # COPY into a staging table with the same upsert semantics
+    bulk = dataset.bulk(copy=True)
+    entity1["properties"] = {"name": ["Copy Man"]}
+    bulk.put(entity1)
+    bulk.put({"id": "key4", "schema": "Person", "properties": {}})
+    bulk.flush()
+    assert len(list(dataset.fragments(entity_ids="key1"))) == 2
+    assert dataset.get("key1").get("name") == ["Copy Man"]
+    dataset.delete(entity_id="key4")
+
     assert len(list(dataset.iterate_batched(batch_size=2))) == 3
     assert next(dataset.get_sorted_id_batches()) == ["key1", "key2", "key3"]
+    streamed = [e.to_dict() for e in dataset.iterate_streamed()]
+    batched = [e.to_dict() for e in dataset.iterate_batched(batch_size=2)]
+    assert streamed == batched
+    assert [e.id for e in dataset.iterate(streamed=True)] == ["key1", "key2", "key3"]
+    assert len(list(dataset.iterate_streamed(schema="LegalEntity"))) == 1
 
     entity = dataset.get("key3")
     assert entity.context.get("origin") == "test_o"
@@ -103,6 +120,52 @@ def test_fragment_store_postgres():
     dataset.store.close()
 
 
+def test_fragment_store_postgres_copy_upsert():
+    uri = os.environ.get("TESTING_FRAGMENTS_PSQL_URI")
+    if not uri:
+        print("Skipping psql test (no `TESTING_FRAGMENTS_PSQL_URI` env)")
+        return
+
+    from sqlalchemy import Column, MetaData, String, Table, create_engine, text
+
+    from ftmq.store.postgres import copy_upsert
+
+    engine = create_engine(uri, pool_size=1, max_overflow=0)
+    meta = MetaData()
+    table = Table(
+        "test_copy_upsert",
+        meta,
+        Column("id", String, primary_key=True),
+        Column("name", String),
+    )
+    meta.drop_all(engine)
+    meta.create_all(engine)
+    with engine.begin() as conn:
+        copy_upsert(conn, table, [("a", "Alice")], ["id"], ["name"])
+        # several calls within the same transaction
+        copy_upsert(conn, table, [("b", "Bob")], ["id"], ["name"])
+
+    # the pooled connection gets the new columns of the target table
+    with engine.begin() as conn:
+        conn.execute(text('ALTER TABLE "test_copy_upsert" ADD COLUMN "schema" text'))
+    table.append_column(Column("schema", String))
+    with engine.begin() as conn:
+        inserted = copy_upsert(
+            conn,
+            table,
+            [("a", "Alice", "Person"), ("c", "Carol", "Person")],
+            ["id"],
+            ["name", "schema"],
+            returning=["id"],
+        )
+        assert inserted == [("c",)]
+        rows = conn.execute(text('SELECT id, schema FROM "test_copy_upsert"'))
+        assert dict(rows.all()) == {"a": "Person", "b": None, "c": "Person"}
+
+    meta.drop_all(engine)
+    engine.dispose()
+
+
 def test_fragment_store_sqlite():
     uri = "sqlite://"
     with pytest.raises(ValueError):
@@ -148,6 +211,11 @@ def test_fragment_store_sqlite():
 
     assert len(list(dataset.iterate_batched(batch_size=2))) == 3
     assert next(dataset.get_sorted_id_batches()) == ["key1", "key2", "key3"]
+    streamed = [e.to_dict() for e in dataset.iterate_streamed()]
+    batched = [e.to_dict() for e in dataset.iterate_batched(batch_size=2)]
+    assert streamed == batched
+    assert [e.id for e in dataset.iterate(streamed=True)] == ["key1", "key2", "key3"]
+    assert len(list(dataset.iterate_streamed(schema="LegalEntity"))) == 1
 
     entity = dataset.get("key3")
     assert entity.context.get("origin") == "test_o"
@@ -290,6 +358,25 @@ def test_fragment_store_timestamp_filter_sqlite():
     entity2_statements = [s for s in statements_until if s.entity_id == "key2"]
     assert len(entity2_statements) == 0
 
+    # Test: iterate_changed() yields complete entities changed since
+    time.sleep(0.01)
+    changed = datetime.utcnow()
+    time.sleep(0.01)
+    dataset.put(
+        {"id": "key1", "schema": "Person", "properties": {"alias": ["Late"]}},
+        fragment="late",
+    )
+    partial = list(dataset.iterate(since=changed))
+    assert len(partial) == 1
+    assert partial[0].get("name") == []
+    entities_changed = list(dataset.iterate_changed(changed, batch_size=1))
+    assert len(entities_changed) == 1
+    assert entities_changed[0].id == "key1"
+    assert entities_changed[0].get("name") == ["First"]
+    assert entities_changed[0].get("alias") == ["Late"]
+    assert [e.id for e in dataset.iterate_changed(before)] == ["key1", "key2"]
+    assert list(dataset.iterate_changed(datetime.utcnow())) == []
+
     dataset.drop()
     dataset.store.close()
 
@@ -379,3 +466,393 @@ def test_fragment_store_timestamp_filter_postgres():
 
     dataset.drop()
     dataset.store.close()
+
+
+def test_fragment_store_iterate_parallel(tmp_path):
+    uri = f"sqlite:///{tmp_path / 'fragments.db'}"
+    dataset = get_fragments("test_parallel", database_uri=uri)
+    bulk = dataset.bulk()
+    for ix in range(100):
+        entity_id = f"key{ix:03d}"
+        for prop in ("name", "alias"):
+            data = {"id": entity_id, "schema": "Person", "properties": {}}
+            data["properties"][prop] = [f"{prop} {ix}"]
+            bulk.put(data, fragment=prop)
+    bulk.flush()
+
+    expected = [e.to_dict() for e in dataset.iterate(streamed=False)]
+    assert len(expected) == 100
+    res = dataset.iterate_parallel(workers=2, batch_size=7)
+    assert [e.to_dict() for e in res] == expected
+    res = dataset.iterate_parallel(workers=3, batch_size=7, ordered=False)
+    res = sorted((e.to_dict() for e in res), key=lambda e: e["id"])
+    assert res == expected
+    assert all(len(e["properties"]) == 2 for e in res)
+    res = list(dataset.iterate_parallel(workers=2, schema="Company"))
+    assert res == []
+
+    dataset.drop()
+    dataset.store.close()
+
+
+def test_fragment_store_merge(donations):
+    from ftmq.store.fragments.dataset import merge_fragments
+
+    dataset = get_fragments("test_merge", database_uri="sqlite://")
+    dataset.drop()
+    bulk = dataset.bulk()
+    for proxy in donations[:200]:
+        for ix, (prop, value) in enumerate(proxy.itervalues()):
+            fragment = {"id": proxy.id, "schema": proxy.schema.name}
+            fragment["properties"] = {prop.name: [value]}
+            bulk.put(fragment, fragment=str(ix))
+    # common schema resolved across fragments
+    for name in ("A", "B"):
+        data = {"id": "le", "schema": "LegalEntity", "properties": {"name": [name]}}
+        bulk.put(data, fragment=name)
+    bulk.put({"id": "le", "schema": "Company", "caption": "A"}, fragment="C")
+    bulk.flush()
+
+    # same result as merging the partial proxies
+    expected = []
+    for partial in dataset.partials():
+        if expected and expected[-1].id == partial.id:
+            expected[-1].merge(partial)
+        else:
+            expected.append(partial)
+    entities = list(dataset.iterate(streamed=False))
+    assert [e.to_dict() for e in entities] == [e.to_dict() for e in expected]
+    entity = dataset.get("le")
+    assert entity.schema.name == "Company"
+    assert sorted(entity.get("name")) == ["A", "B"]
+    assert "caption" not in entity.context
+
+    assert merge_fragments([]) is None
+    fragments = [{"id": "x", "schema": "Person"}, {"id": "x", "schema": "Vessel"}]
+    with pytest.raises(InvalidData):
+        merge_fragments(fragments)
+    dataset.put({"id": "x", "schema": "Vessel"}, fragment="vessel")
+    dataset.put({"id": "x", "schema": "Person"}, fragment="person")
+    dataset.put({"id": "y", "schema": "Person"})
+    with pytest.raises(InvalidData):
+        list(dataset.iterate(entity_id=["x", "y"]))
+    assert [e.id for e in dataset.iterate(["x", "y"], skip_errors=True)] == ["y"]
+
+    dataset.drop()
+    dataset.store.close()
+
+
+def test_fragment_store_bulk_background(tmp_path, monkeypatch):
+    from ftmq.store.fragments.loader import BulkLoader
+
+    uri = f"sqlite:///{tmp_path / 'fragments.db'}"
+    dataset = get_fragments("test_background", database_uri=uri)
+    bulk = dataset.bulk(size=10, background=True, queue_size=1)
+    for ix in range(255):
+        data = {"id": f"key{ix}", "schema": "Person", "properties": {}}
+        bulk.put(data, fragment=str(ix % 2))
+    assert bulk._thread is not None
+    bulk.flush()
+    assert bulk._thread is None
+    assert len(dataset) == 255
+    assert len(list(dataset.fragments())) == 255
+
+    # write errors are raised in the caller
+    def _fail(*args, **kwargs):
+        raise ValueError("Write failed")
+
+    monkeypatch.setattr(BulkLoader, "_upsert_values_sqlite", _fail)
+    bulk = dataset.bulk(size=10, background=True)
+    with pytest.raises(ValueError):
+        for ix in range(1000):
+            bulk.put({"id": f"new{ix}", "schema": "Person"})
+    # the loader refuses new data until the failure is reported by `flush`
+    with pytest.raises(ValueError):
+        bulk.put({"id": "refused", "schema": "Person"})
+    with pytest.raises(StoreException, match="Could not store") as exc:
+        bulk.flush()
+    assert isinstance(exc.value.__cause__, ValueError)
+    bulk.flush()  # the loader is usable again
+    bulk.put({"id": "new", "schema": "Person"})
+    with pytest.raises(StoreException):
+        bulk.flush()
+    assert len(dataset) == 255
+
+    dataset.drop()
+    dataset.store.close()
+
+
+def test_fragment_store_stats(tmp_path):
+    from ftmq.store.fragments import get_store
+
+    def _counts(stats):
+        return {k: (v["entities"], v["fragments"]) for k, v in stats.items()}
+
+    uri = f"sqlite:///{tmp_path / 'fragments.db'}"
+    store = get_store(uri)
+    dataset = store.get("test_stats")
+    assert len(dataset) == 0
+    bulk = dataset.bulk(size=7)
+    for ix in range(20):
+        data = {"id": f"key{ix}", "schema": "Person"}
+        bulk.put(data, fragment="a")
+        bulk.put(data, fragment="b", origin="crawl" if ix % 2 else None)
+    bulk.flush()
+    bulk.put({"id": "key1", "schema": "Person"}, fragment="a")  # update
+    bulk.flush()
+    assert len(dataset) == 20
+    stats = dataset.stats()
+    assert _counts(stats) == {"*": (20, 40), "null": (20, 30), "crawl": (10, 10)}
+    assert stats["*"]["last_write"] is not None
+
+    dataset.delete(entity_id="key1", origin="null")
+    dataset.delete_many(["key2", "key3"], origin="crawl")
+    assert _counts(dataset.stats()) == {
+        "*": (20, 38),
+        "null": (19, 29),
+        "crawl": (9, 9),
+    }
+    dataset.delete(fragment="b")
+    assert _counts(dataset.stats()) == {"*": (19, 19), "null": (19, 19)}
+    maintained = _counts(dataset.stats())
+    store.rebuild_stats()
+    assert _counts(dataset.stats()) == maintained
+
+    assert [d.name for d in store.all()] == ["test_stats"]
+    assert len(store) == 1
+    store.get("test_other").put({"id": "o", "schema": "Person"})
+    assert [d.name for d in store.all()] == ["test_other", "test_stats"]
+    assert len(store) == 2
+    store.get("test_other").drop()
+    assert len(store) == 1
+
+    # tables without stats (of older versions) are registered by rebuilding
+    with store.engine.begin() as conn:
+        conn.execute(store.stats.delete())
+    assert dataset.stats() == {}
+    assert list(store.all()) == []
+    assert len(store) == 0
+    assert store.rebuild_stats() == 1
+    assert [d.name for d in store.all()] == ["test_stats"]
+    assert _counts(dataset.stats()) == maintained
+    with store.engine.begin() as conn:
+        conn.execute(store.stats.delete())
+    assert len(dataset) == 19
+    assert _counts(dataset.stats()) == maintained
+    assert store.rebuild_stats() == 1
+    assert _counts(dataset.stats()) == maintained
+    store.close()
+
+
+def test_fragment_store_to_lake(tmp_path, eu_authorities):
+    from ftmq.store.lake import LakeStore
+
+    uri = f"sqlite:///{tmp_path / 'fragments.db'}"
+    dataset = get_fragments("eu_authorities", database_uri=uri)
+    bulk = dataset.bulk()
+    for proxy in eu_authorities:
+        data = proxy.to_dict()
+        names = {"id": proxy.id, "schema": proxy.schema.name}
+        names["properties"] = {"name": data["properties"].pop("name", [])}
+        bulk.put(data, origin="crawl")
+        bulk.put(names, fragment="names")
+    bulk.flush()
+
+    lake = LakeStore(uri=tmp_path / "lake", dataset="eu_authorities")
+    metrics = dataset.to_lake(lake, batch_size=50, queue_size=1)
+    assert metrics.batches == 4
+    assert metrics.entities == 151
+    assert metrics.statements == len(list(dataset.statements()))
+    assert metrics.statements_per_second > 0
+
+    expected = {e.id: e.to_dict()["properties"] for e in dataset.iterate()}
+    entities = {e.id: e.to_dict()["properties"] for e in lake.iterate()}
+    assert entities == expected
+    statements = [s for e in lake.iterate() for s in e.statements if s.prop != "id"]
+    assert {s.origin for s in statements} == {"crawl", "default"}
+    assert all(s.last_seen for s in statements)
+
+    dataset.drop()
+    dataset.store.close()
+
+
+def test_fragment_store_statements(proxies):
+    from followthemoney import StatementEntity
+
+    from ftmq.util import make_dataset
+
+    dataset = get_fragments("test_statements", database_uri="sqlite://")
+    dataset.drop()
+    bulk = dataset.bulk()
+    for ix, proxy in enumerate(proxies):
+        data = proxy.to_dict()
+        data["properties"]["name"] = [*proxy.get("name", quiet=True), ""]
+        bulk.put(data, origin="crawl" if ix % 2 else None)
+        bulk.put({"id": proxy.id, "schema": proxy.schema.name}, fragment="schema")
+    bulk.put({"id": "x", "schema": "Person", "last_change": "2024-01-01"})
+    bulk.flush()
+
+    # same statements as exploding a StatementEntity per fragment
+    expected = []
+    for fragment in dataset.fragments(sort=False):
+        entity = StatementEntity.from_dict(
+            fragment, default_dataset=make_dataset(dataset.name)
+        )
+        expected.extend(entity.statements)
+    statements = list(dataset.statements())
+
+    def _key(stmt):
+        data = stmt.to_dict()
+        data.pop("last_seen")
+        data.pop("origin")
+        return tuple(sorted(data.items()))
+
+    assert sorted(map(_key, statements)) == sorted(map(_key, expected))
+    checksums = {s.entity_id: s for s in statements if s.prop == "id"}
+    assert {(s.origin, s.dataset) for s in statements} == {
+        (None, "test_statements"),
+        ("crawl", "test_statements"),
+    }
+    assert all(s.last_seen for s in statements)
+    assert checksums["x"].first_seen == "2024-01-01"
+
+    dataset.drop()
+    dataset.store.close()
+
+
+def test_fragment_store_upsert_sqlite(monkeypatch):
+    from sqlalchemy import update
+
+    from ftmq.store.fragments.loader import BulkLoader
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("Legacy update per row used")
+
+    monkeypatch.setattr(BulkLoader, "_store_values", _fail)
+    dataset = get_fragments("test_upsert", database_uri="sqlite://")
+    dataset.drop()
+    entity = {"id": "key1", "schema": "Person", "properties": {"name": ["Alice"]}}
+    dataset.put(entity)
+    dataset.put(entity, fragment="f")
+    entity["properties"]["name"] = ["Bob"]
+    dataset.put(entity)
+    assert len(list(dataset.fragments())) == 2
+    assert set(dataset.get("key1").get("name")) == {"Alice", "Bob"}
+
+    # fragments with a newer timestamp are kept
+    table = dataset.table
+    with dataset.store.engine.connect() as conn:
+        conn.execute(update(table).values(timestamp=datetime(2100, 1, 1)))
+        conn.commit()
+    entity["properties"]["name"] = ["Charlie"]
+    dataset.put(entity)
+    assert "Charlie" not in dataset.get("key1").get("name")
+
+    dataset.drop()
+    dataset.store.close()
+
+
+def test_fragment_store_encoding(tmp_path):
+    from ftmq.store.fragments import get_store
+
+    uri = f"sqlite:///{tmp_path / 'fragments.db'}"
+    store = get_store(uri, encoding="zstd")
+    dataset = store.get("test_zstd")
+    bulk = dataset.bulk()
+    for ix in range(500):
+        name = {"id": f"p{ix}", "schema": "Person", "properties": {"name": [f"P {ix}"]}}
+        bulk.put(name, fragment="name")
+        bulk.put({"id": f"p{ix}", "schema": "LegalEntity"}, fragment="schema")
+    bulk.put({"id": "c1", "schema": "Company", "properties": {"name": ["ACME"]}})
+    bulk.flush()
+    assert dataset.encoding == "zstd"
+    with store.engine.connect() as conn:
+        value = conn.execute(dataset.table.select().limit(1)).fetchone().entity
+    assert isinstance(value, bytes)
+
+    entities = [e.to_dict() for e in dataset.iterate()]
+    assert len(entities) == 501
+    assert dataset.get("p1").get("name") == ["P 1"]
+    assert dataset.get("p1").schema.name == "Person"
+    assert len(list(dataset.iterate(schema="Company"))) == 1
+    assert list(dataset.get_sorted_ids(schema="Company")) == ["c1"]
+    assert len(list(dataset.statements())) == 1502
+
+    # migrate with a trained dictionary, and back to json
+    assert dataset.migrate("zstd") == 1001
+    assert store.get_zstd_dict(dataset.table.name) is not None
+    assert [e.to_dict() for e in dataset.iterate()] == entities
+    dataset.put({"id": "c2", "schema": "Company"})
+    assert len(list(dataset.iterate(schema="Company"))) == 2
+    # committed in batches
+    assert dataset.migrate("json", batch_size=300) == 1002
+    assert dataset.encoding == "json"
+    assert store.get_zstd_dict(dataset.table.name) is None
+    assert len(list(dataset.iterate(schema="Company"))) == 2
+    assert [e.to_dict() for e in dataset.iterate() if e.id != "c2"] == entities
+
+    # existing tables keep their format
+    store.close()
+    get_store.cache_clear()
+    store = get_store(uri, encoding="zstd")
+    assert store.get("test_zstd").encoding == "json"
+    with pytest.raises(ValueError):
+        get_store(uri, encoding="xml")
+
+
+def test_fragment_store_schema_column(tmp_path):
+    from sqlalchemy import MetaData, inspect, text
+
+    from ftmq.store.fragments import get_store
+
+    uri = f"sqlite:///{tmp_path / 'fragments.db'}"
+    store = get_store(uri)
+    dataset = store.get("test_schema")
+    dataset.put({"id": "p1", "schema": "Person"})
+    dataset.put({"id": "c1", "schema": "Company"})
+    assert dataset.has_schema_column
+    indexes = {i["name"] for i in inspect(store.engine).get_indexes("ftm_test_schema")}
+    assert indexes == {
+        "ix_ftm_test_schema_schema_id",
+        "ix_ftm_test_schema_timestamp_id",
+    }
+    with store.engine.connect() as conn:
+        plan = conn.execute(
+            text("EXPLAIN QUERY PLAN SELECT id FROM ftm_test_schema WHERE schema = 'x'")
+        ).fetchall()
+    assert "ix_ftm_test_schema_schema_id" in str(plan)
+    assert [e.id for e in dataset.iterate(schema="Company")] == ["c1"]
+    assert list(dataset.get_sorted_ids(schema="Person")) == ["p1"]
+
+    # tables created before the schema column are upgraded in place
+    for encoding in ("json", "zstd"):
+        store = get_store(uri, encoding=encoding)
+        dataset = store.get(f"test_legacy_{encoding}")
+        legacy = dataset._make_table(
+            f"ftm_test_legacy_{encoding}", encoding, MetaData(), schema_column=False
+        )
+        legacy.create(store.engine)
+        dataset.put({"id": "p1", "schema": "Person"})
+        dataset.put({"id": "c1", "schema": "Company"}, fragment="1")
+        assert not dataset.has_schema_column
+        assert dataset.encoding == encoding
+        assert [e.id for e in dataset.iterate(schema="Company")] == ["c1"]
+        # committed in batches
+        assert dataset.migrate(batch_size=1) == 2
+        assert dataset.has_schema_column
+        assert [e.id for e in dataset.iterate(schema="Company")] == ["c1"]
+        assert dataset.migrate() == 0
+        # an interrupted upgrade continues with the missing values
+        with store.engine.begin() as conn:
+            conn.execute(
+                dataset.table.update()
+                .where(dataset.table.c.id == "c1")
+                .values(schema=None)
+            )
+        assert dataset.migrate() == 1
+        assert [e.id for e in dataset.iterate(schema="Company")] == ["c1"]
+        dataset.put({"id": "c2", "schema": "Company"})
+        assert list(dataset.get_sorted_ids(schema="Company")) == ["c1", "c2"]
+        assert dataset.migrate(encoding) == 3
+        assert list(dataset.get_sorted_ids(schema="Company")) == ["c1", "c2"]
+        assert len(inspect(store.engine).get_indexes(dataset.table.name)) == 2
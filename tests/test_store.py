@@ -1,11 +1,24 @@
-from followthemoney import EntityProxy, StatementEntity
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from followthemoney import EntityProxy, Statement, StatementEntity
+from sqlalchemy import func, select
 
 from ftmq.query import Query
 from ftmq.store import MemoryStore, Store, get_store
 from ftmq.store.aleph import AlephStore, parse_uri
 from ftmq.store.base import get_resolver
 from ftmq.store.fragments import get_fragments
-from ftmq.store.lake import LakeStore
+from ftmq.store.lake import (
+    CompactionPolicy,
+    DuckDBSettings,
+    FederatedLakeStore,
+    LakeStore,
+    ReadOnlyError,
+    default_view_sql,
+    get_id_hashes,
+)
 from ftmq.store.level import LevelDBStore
 from ftmq.store.sql import SQLStore
 from ftmq.util import get_scope_dataset, make_dataset
@@ -286,6 +299,25 @@ def test_store_sql_sqlite(tmp_path, proxies):
     assert _run_store_test(SQLStore, proxies, test_pop=False, uri=uri)  # FIXME
 
 
+def test_store_sql_postgres_copy(proxies):
+    uri = os.environ.get("TESTING_FRAGMENTS_PSQL_URI")
+    if not uri:
+        print("Skipping psql test (no `TESTING_FRAGMENTS_PSQL_URI` env)")
+        return
+    uri = uri.replace("postgresql://", "postgresql+psycopg://", 1)
+    store = SQLStore(linker=get_resolver(), uri=uri)
+    with store.writer(copy=True) as bulk:
+        assert bulk.copy
+        for _ in range(2):  # conflicts are merged
+            for proxy in proxies:
+                bulk.add_entity(proxy)
+    assert store.get_scope().leaf_names == {"donations", "eu_authorities"}
+    assert len(list(store.iterate())) == 625
+    with store.engine.connect() as conn:
+        conn.execute(store.table.delete())
+        conn.commit()
+
+
 def test_store_lake(tmp_path, proxies):
     assert _run_store_test_implicit(LakeStore, proxies, uri=tmp_path)
     assert _run_store_test(LakeStore, proxies, uri=tmp_path)
@@ -437,3 +469,516 @@ def test_store_fragments_to_lake(tmp_path):
     entities = list(lake.iterate())
     assert len(entities) == 2
     assert lake.get_origins() == {"ingest", "source1", "source2"}
+
+
+def test_store_lake_parallel_flush(tmp_path, proxies):
+    lake = LakeStore(uri=tmp_path / "parallel", dataset="test")
+    with lake.writer(flush_workers=1) as bulk:
+        for proxy in proxies:
+            bulk.add_entity(proxy)
+    assert set(bulk.flush_timings) == {"thing", "interval"}
+
+    lake = LakeStore(uri=tmp_path / "parallel2", dataset="test")
+    with lake.writer(flush_workers=4) as bulk:
+        for proxy in proxies:
+            bulk.add_entity(proxy)
+    assert set(bulk.flush_timings) == {"thing", "interval"}
+    assert all(t > 0 for t in bulk.flush_timings.values())
+    assert len(list(lake.iterate())) == 474 + 151
+
+
+def test_store_lake_arrow_statements(tmp_path, eu_authorities):
+    from sqlalchemy import select
+
+    from ftmq.store.lake import TABLE, LakeStatement, Row
+
+    lake = LakeStore(uri=tmp_path / "arrow", dataset="eu_authorities")
+    with lake.writer() as bulk:
+        for proxy in eu_authorities:
+            bulk.add_entity(proxy)
+        # the fixture has no timestamps, add one with sub-second precision
+        stmt = Statement(
+            entity_id="timestamped",
+            prop="name",
+            schema="Person",
+            value="Jane Doe",
+            dataset="eu_authorities",
+            first_seen="2024-01-02T03:04:05.123456",
+            last_seen="2024-02-03T04:05:06",
+        )
+        bulk.add_statement(stmt)
+
+    q = select(TABLE).order_by(TABLE.c.canonical_id)
+    from_rows = [LakeStatement.from_db_row(r) for r in lake._execute(q)]
+    from_batches = list(lake._iterate_stmts(q))
+    assert len(from_rows) == len(from_batches) > 0
+    for a, b in zip(from_rows, from_batches):
+        assert a.to_dict() == b.to_dict()
+        assert a.dedupe_key == b.dedupe_key
+    stamped = [s for s in from_batches if s.entity_id == "timestamped"]
+    assert len(stamped) == 1
+    assert stamped[0].first_seen == "2024-01-02T03:04:05"
+    assert stamped[0].last_seen == "2024-02-03T04:05:06"
+    entity = lake.default_view().get_entity("timestamped")
+    assert entity is not None
+    assert entity.first_seen == "2024-01-02T03:04:05"
+    assert entity.last_seen == "2024-02-03T04:05:06"
+
+    row = Row({"a": 1, "b": 2})
+    assert row.b == 2
+    assert row[0] == 1
+    assert list(row) == [1, 2]
+
+    assert lake.get_origins() == {"default"}
+    view = lake.default_view()
+    assert view.count(Query()) == 152
+    assert len(list(lake.iterate())) == 152
+
+
+def test_store_lake_pruning(tmp_path, proxies):
+    from ftmq.store.lake import ensure_partition_filters
+
+    lake = LakeStore(uri=tmp_path / "pruning")
+    with lake.writer() as bulk:
+        for proxy in proxies:
+            bulk.add_entity(proxy)
+    view = lake.view(get_scope_dataset("eu_authorities", "donations"))
+
+    metrics = view.pruning()
+    assert metrics.files_considered == 3
+    assert metrics.files_scanned == 3
+    q = Query().where(dataset="eu_authorities")
+    assert view.pruning(q).files_scanned == 1
+    q = Query().where(dataset="donations", schema="Payment")
+    assert view.pruning(q).files_scanned == 1
+    q = Query().where(dataset="donations", origin="other")
+    assert view.pruning(q).files_scanned == 0
+    q = Query().where(canonical_id="eu-authorities-satcen", dataset="eu_authorities")
+    assert view.pruning(q).files_scanned == 1
+    q = Query().where(canonical_id="zzz")  # outside of all min/max stats
+    assert view.pruning(q).files_scanned == 0
+    q = Query().where(origin__startswith="def")  # not prunable
+    assert view.pruning(q).files_scanned == 3
+
+    # partition predicates are on top level, also for sub-query clauses
+    q = Query().where(dataset="donations", schema="Payment", date__gte=2011)
+    sql = str(ensure_partition_filters(q))
+    assert "AND test_table.dataset IN (__[POSTCOMPILE_dataset_2]) ORDER BY" in sql
+    assert len(list(view.query(q))) == 21
+    q = Query().where(canonical_id="eu-authorities-satcen")
+    assert [e.id for e in view.query(q)] == ["eu-authorities-satcen"]
+
+
+def test_store_lake_deltatable_cache(tmp_path, eu_authorities):
+    uri = tmp_path / "cached"
+    lake = LakeStore(uri=uri, dataset="eu_authorities", refresh_interval=3600)
+    assert not lake.exists
+    assert lake.version is None
+    with lake.writer() as bulk:
+        bulk.add_entity(eu_authorities[0])
+    # own writes invalidate the handle
+    assert lake.exists
+    version = lake.version
+    assert lake.deltatable is lake.deltatable
+
+    # writes from another instance are picked up after refresh
+    other = LakeStore(uri=uri, dataset="eu_authorities")
+    with other.writer() as bulk:
+        bulk.add_entity(eu_authorities[1])
+    assert lake.version == version
+    lake.refresh()
+    assert lake.version > version
+    assert len(list(lake.iterate())) == 2
+
+    always = LakeStore(uri=uri, dataset="eu_authorities", refresh_interval=0)
+    version = always.version
+    with other.writer() as bulk:
+        bulk.add_entity(eu_authorities[2])
+    assert always.version > version
+
+
+def test_store_lake_changes(tmp_path, eu_authorities):
+    lake = LakeStore(uri=tmp_path / "changes", dataset="eu_authorities")
+    assert lake.changes(0)[0] is None
+    with lake.writer() as bulk:
+        for proxy in eu_authorities[:10]:
+            bulk.add_entity(proxy)
+    version, entities = lake.changes(-1)
+    assert len(list(entities)) == 10
+
+    changed = eu_authorities[10]
+    with lake.writer() as bulk:
+        bulk.add_entity(changed)
+    new_version, entities = lake.changes(version)
+    assert new_version > version
+    entities = list(entities)
+    assert [e.id for e in entities] == [changed.id]
+    # re-assembled from the complete current state
+    assert entities[0].to_dict()["properties"] == changed.to_dict()["properties"]
+
+    assert lake.changes(new_version)[0] == new_version
+    assert list(lake.changes(new_version)[1]) == []
+
+    lake.writer().pop(changed.id)
+    version, entities = lake.changes(new_version)
+    assert lake.get_changed_ids(new_version) == {changed.id}
+    assert list(entities) == []  # deleted entirely
+
+
+def test_store_lake_pop_many(tmp_path, eu_authorities):
+    lake = LakeStore(uri=tmp_path / "pop", dataset="eu_authorities")
+    with lake.writer() as bulk:
+        for proxy in eu_authorities[:10]:
+            bulk.add_entity(proxy)
+    ids = [p.id for p in eu_authorities[:10]]
+
+    version = lake.version
+    popped = lake.writer().pop_many([*ids[:3], "unknown", "it's"])
+    assert lake.version == version + 1  # one commit
+    assert len(popped) == 5
+    assert all(len(popped[i]) for i in ids[:3])
+    assert popped["unknown"] == []
+    assert {s.canonical_id for s in popped[ids[0]]} == {ids[0]}
+    assert len(list(lake.iterate())) == 7
+
+    # buffered pops are applied with one commit on flush
+    version = lake.version
+    with lake.writer(buffer_pops=True) as bulk:
+        assert len(bulk.pop(ids[3]))
+        assert len(bulk.pop(ids[4]))
+        assert bulk.pop(ids[4]) == []
+        assert lake.version == version
+        assert len(list(lake.iterate())) == 7
+    assert lake.version == version + 1
+    assert len(list(lake.iterate())) == 5
+
+
+def test_store_lake_stats_sidecar(tmp_path, proxies):
+    # opt-in
+    lake = LakeStore(uri=tmp_path / "no_stats")
+    with lake.writer() as bulk:
+        bulk.add_entity(proxies[0])
+    assert lake.get_stats_sidecar("eu_authorities") is None
+
+    lake = LakeStore(uri=tmp_path / "stats", linker=get_resolver(), stats_sidecars=True)
+    with lake.writer() as bulk:
+        for proxy in proxies:
+            bulk.add_entity(proxy)
+    sidecar = lake.get_stats_sidecar("donations")
+    assert sidecar is not None
+    assert sidecar.version == lake.version
+
+    scope = lake.get_scope()
+    view = lake.view(scope)
+    for q in (
+        Query(),
+        Query().where(dataset="donations"),
+        Query().where(dataset__in=["donations", "eu_authorities"]),
+    ):
+        q = view.ensure_scoped_query(q)
+        stats, scanned = view.stats(q), view.scan_stats(q)
+        assert stats.entity_count == scanned.entity_count
+        assert stats.countries == scanned.countries
+        assert (stats.start, stats.end) == (scanned.start, scanned.end)
+        for key in ("things", "intervals"):
+            a, b = getattr(stats, key), getattr(scanned, key)
+            assert a.total == b.total
+            assert {(s.name, s.count) for s in a.schemata} == {
+                (s.name, s.count) for s in b.schemata
+            }
+            assert {(c.code, c.count) for c in a.countries} == {
+                (c.code, c.count) for c in b.countries
+            }
+    assert view.stats().entity_count == 625
+    # other filters are scanned
+    q = Query().where(schema="Person")
+    assert view.stats(q).entity_count == view.count(q)
+
+    # stale after a write, re-computed by the writer
+    with lake.writer() as bulk:
+        bulk.pop(proxies[0].id)
+        assert lake.get_stats_sidecar("eu_authorities") is None
+    assert lake.view(scope).stats().entity_count == 624
+    assert lake.get_stats_sidecar("eu_authorities").stats.entity_count == 150
+
+    # carried over on optimize
+    lake.writer().optimize(vacuum=True)
+    sidecar = lake.get_stats_sidecar("eu_authorities")
+    assert sidecar is not None
+    assert sidecar.version == lake.version
+    assert lake.view(scope).stats().entity_count == 624
+
+
+def test_store_lake_compaction(tmp_path, eu_authorities):
+    lake = LakeStore(
+        uri=tmp_path / "compact", dataset="eu_authorities", stats_sidecars=True
+    )
+    for proxy in eu_authorities[:6]:
+        with lake.writer() as bulk:
+            bulk.add_entity(proxy)
+    assert len(lake.deltatable.file_uris()) == 6
+    stats = lake.view().stats()
+
+    policy = CompactionPolicy(max_files=10, max_small_files=10)
+    assert lake.get_compaction_candidates(policy) == (1, [])
+    metrics = lake.compact(policy)
+    assert metrics.partitions_compacted == 0
+
+    policy = CompactionPolicy(max_small_files=5)
+    _, candidates = lake.get_compaction_candidates(policy)
+    assert candidates == [
+        {"dataset": "eu_authorities", "bucket": "thing", "origin": "default"}
+    ]
+    metrics = lake.compact(policy)
+    assert metrics.partitions_compacted == 1
+    assert metrics.files_removed == 6
+    assert metrics.files_added == 1
+    assert len(lake.deltatable.file_uris()) == 1
+    assert lake.get_stats_sidecar("eu_authorities") is not None
+    assert lake.view().stats() == stats
+
+    # checked after each flush
+    lake = LakeStore(
+        uri=tmp_path / "compact", dataset="eu_authorities", compaction=policy
+    )
+    for proxy in eu_authorities[6:12]:
+        with lake.writer() as bulk:
+            bulk.add_entity(proxy)
+    assert len(lake.deltatable.file_uris()) < 6
+    assert len(list(lake.iterate())) == 12
+
+
+def test_store_lake_id_index(tmp_path, eu_authorities):
+    lake = LakeStore(uri=tmp_path / "index", dataset="eu_authorities")
+    filters = []
+    for ix in range(3):  # interleaved, so that the id ranges of the files overlap
+        with lake.writer() as bulk:
+            for proxy in eu_authorities[ix:30:3]:
+                bulk.add_entity(proxy)
+        # updated with the new files on each flush
+        index = lake.get_id_index()
+        assert index is not None
+        assert index.version == lake.version
+        assert len(index.files) == ix + 1
+        filters.append({p: f.bits for p, f in index.files.items()})
+    assert filters[0].items() <= filters[1].items() <= filters[2].items()
+    lake.update_index(rebuild=True)
+    index = lake.get_id_index()
+    assert {p: f.bits for p, f in index.files.items()} == filters[2]
+    # sized to the number of ids
+    assert {f.size for f in index.files.values()} == {100}
+    for proxy in eu_authorities[:30]:
+        hashes = get_id_hashes(proxy.id)
+        assert sum(f.contains(hashes) for f in index.files.values()) >= 1
+
+    view = lake.view()
+    proxy = eu_authorities[15]
+    q = Query().where(canonical_id=proxy.id)
+    assert view.pruning(q).files_scanned == 1
+    assert lake.get_lookup_files({}, {proxy.id})[0].endswith(".parquet")
+    entity = view.get_entity(proxy.id)
+    assert entity is not None
+    assert entity.to_dict()["properties"] == proxy.to_dict()["properties"]
+    assert view.get_entity("unknown") is None
+    ids = [p.id for p in eu_authorities[:30:7]]
+    assert {e.id for e in view.get_entities(ids)} == set(ids)
+
+    # unindexed files are read
+    lake.writer().pop(proxy.id)
+    assert view.get_entity(proxy.id) is None
+    assert view.get_entity(eu_authorities[14].id) is not None
+
+    # maintained on optimize
+    lake.writer().optimize(vacuum=True)
+    index = lake.get_id_index()
+    assert len(index.files) == 1
+    assert view.get_entity(eu_authorities[14].id) is not None
+
+    # custom views are not bypassed
+    lake = LakeStore(
+        uri=tmp_path / "index",
+        dataset="eu_authorities",
+        view_sqls={lake.table.name: lambda dt: default_view_sql(dt)},
+    )
+    assert lake.get_id_index() is None
+    assert lake.view().get_entity(eu_authorities[14].id) is not None
+
+
+def test_store_lake_upsert(tmp_path, eu_authorities):
+    def _count(lake: LakeStore) -> int:
+        return next(lake._execute_column(select(func.count()).select_from(lake.table)))
+
+    lake = LakeStore(uri=tmp_path / "upsert", dataset="eu_authorities")
+    for _ in range(2):
+        with lake.writer(upsert=True) as bulk:
+            for proxy in eu_authorities[:100]:
+                bulk.add_entity(proxy)
+    assert _count(lake) == sum(len(list(p.statements)) for p in eu_authorities[:100])
+    assert len(list(lake.iterate())) == 100
+
+    # existing statements are updated, new ones inserted
+    with lake.writer(upsert=True) as bulk:
+        for proxy in eu_authorities:
+            bulk.add_entity(proxy)
+    count = _count(lake)
+    assert count == sum(len(list(p.statements)) for p in eu_authorities)
+    assert len(list(lake.iterate())) == 151
+
+    # append mode duplicates
+    with lake.writer() as bulk:
+        bulk.add_entity(eu_authorities[0])
+    assert _count(lake) == count + len(list(eu_authorities[0].statements))
+
+
+def test_store_lake_duckdb_settings(tmp_path, eu_authorities):
+    settings = DuckDBSettings(
+        threads=2, memory_limit="1GB", temp_directory=str(tmp_path), max_cursors=2
+    )
+    lake = LakeStore(
+        uri=tmp_path / "duckdb", dataset="eu_authorities", duckdb_settings=settings
+    )
+    with lake.writer() as bulk:
+        for proxy in eu_authorities:
+            bulk.add_entity(proxy)
+    with lake.cursor() as cur:
+        res = cur.execute(
+            "SELECT current_setting('threads'), current_setting('temp_directory'), "
+            "current_setting('enable_object_cache')"
+        ).fetchone()
+        assert res == (2, str(tmp_path), True)
+    # raw config takes precedence
+    lake = LakeStore(
+        uri=tmp_path / "duckdb",
+        dataset="eu_authorities",
+        duckdb_settings=settings,
+        duckdb_config={"threads": "1"},
+    )
+    with lake.cursor() as cur:
+        assert cur.execute("SELECT current_setting('threads')").fetchone() == (1,)
+
+    # cursors are reused, also after streaming was stopped early
+    with lake.cursor() as cur:
+        pass
+    assert lake.view().get_entity(eu_authorities[0].id) is not None
+    with lake.cursor() as cur2:
+        assert cur2 is cur
+        # the temporary view of the point lookup is gone
+        q = f"SELECT count(DISTINCT canonical_id) FROM {lake.table.name}"
+        assert cur2.execute(q).fetchone() == (151,)
+
+    # bounded concurrency
+    view = lake.view()
+    ids = [p.id for p in eu_authorities[:20]]
+    with ThreadPoolExecutor(8) as pool:
+        res = list(pool.map(view.get_entity, ids))
+    assert [e.id for e in res] == ids
+    assert lake._cursors._idle.qsize() <= 2
+
+    # nested lookups while streaming don't wait for the pool
+    def _stream(ix):
+        for proxy in view.query(Query().where(schema="PublicBody")[ix : ix + 3]):
+            assert view.get_entity(proxy.id) is not None
+        return ix
+
+    with ThreadPoolExecutor(4) as pool:
+        assert list(pool.map(_stream, range(4))) == list(range(4))
+    assert lake._cursors._idle.qsize() <= 2
+    assert lake._cursors._depth == {}
+
+
+def test_store_lake_federated(tmp_path, eu_authorities, donations):
+    for name, proxies in (("eu_authorities", eu_authorities), ("donations", donations)):
+        lake = LakeStore(uri=tmp_path / name, dataset=name)
+        with lake.writer() as bulk:
+            for proxy in proxies:
+                bulk.add_entity(proxy)
+    empty = LakeStore(uri=tmp_path / "empty", dataset="empty")
+    store = FederatedLakeStore(
+        stores=[str(tmp_path / "eu_authorities"), str(tmp_path / "donations"), empty]
+    )
+    assert store.exists
+    assert store.get_scope().leaf_names == {"donations", "eu_authorities"}
+    view = store.view(store.get_scope())
+    assert view.count(view.ensure_scoped_query(Query())) == 625
+    assert len(list(store.iterate())) == 625
+
+    q = Query().where(dataset="donations", schema="Payment")
+    assert view.count(q) == len([p for p in donations if p.schema.name == "Payment"])
+    assert view.get_entity(eu_authorities[0].id).id == eu_authorities[0].id
+
+    stats = view.stats()
+    assert stats.entity_count == 625
+    assert {s.name for s in stats.things.schemata} >= {"PublicBody", "Company"}
+
+    q = Query().aggregate("sum", "amountEur", groups="beneficiary")
+    res = view.aggregations(q)
+    assert res["sum"]["amountEur"] > 0
+    metrics = view.pruning(Query().where(dataset="donations"))
+    assert metrics.files_considered == 3
+    assert metrics.files_scanned == 2
+
+    with pytest.raises(ReadOnlyError):
+        store.writer()
+    with pytest.raises(ReadOnlyError):
+        store.changes(0)
+    with pytest.raises(ReadOnlyError):
+        store.compact()
+    with pytest.raises(ReadOnlyError):
+        store.get_compaction_candidates()
+    with pytest.raises(ValueError):
+        FederatedLakeStore(stores=[])
+
+    # lakes created later join the union
+    store = FederatedLakeStore(stores=[str(tmp_path / "later")])
+    assert not store.exists
+    view = store.view(store.get_scope())
+    assert view.count(Query()) == 0
+    assert list(store.iterate()) == []
+    later = LakeStore(uri=tmp_path / "later", dataset="eu_authorities")
+    with later.writer() as bulk:
+        bulk.add_entity(eu_authorities[0])
+    store.refresh()
+    assert store.exists
+    assert [e.id for e in store.iterate()] == [eu_authorities[0].id]
+
+
+def test_store_arrow_export(tmp_path, eu_authorities):
+    import pyarrow.parquet as pq
+
+    from ftmq.arrow import STATEMENT_SCHEMA
+
+    lake = LakeStore(uri=tmp_path / "lake", dataset="eu_authorities")
+    with lake.writer() as bulk:
+        for proxy in eu_authorities:
+            bulk.add_entity(proxy)
+    memory = get_store("memory://", dataset="eu_authorities")
+    with memory.writer() as bulk:
+        for proxy in lake.iterate():
+            bulk.add_entity(proxy)
+
+    q = Query().where(schema="PublicBody", jurisdiction="eu")
+    statements = sum(len(list(p.statements)) for p in eu_authorities)
+    for store in (lake, memory):
+        view = store.default_view()
+        name = store.__class__.__name__
+        # long statement table
+        table = view.to_arrow(q).read_all()
+        assert table.schema == STATEMENT_SCHEMA
+        assert table.num_rows == statements
+        assert set(table.column("canonical_id").to_pylist()) == {
+            p.id for p in eu_authorities
+        }
+        uri = tmp_path / f"{name}.parquet"
+        assert view.to_parquet(uri, q) == statements
+        assert pq.read_table(uri).num_rows == statements
+        assert view.to_arrow(Query().where(schema="Person")).read_all().num_rows == 0
+
+        # wide table per schema
+        table = view.to_arrow(q, schema="PublicBody").read_all()
+        assert table.num_rows == 151
+        assert "jurisdiction" in table.schema.names
+        row = table.slice(0, 1).to_pylist()[0]
+        assert row["jurisdiction"] == ["eu"]
+        assert row["datasets"] == ["eu_authorities"]
+        assert view.to_parquet(tmp_path / name, wide=True) == 151
+        assert pq.read_table(tmp_path / name / "PublicBody.parquet").num_rows == 151